@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Assigns new regions to the clusters of an existing DGW run, without clustering them again.
+
+Each of the regions is assigned to the cluster, formed by cutting the dendrogram of the run,
+whose prototype is the closest to it in terms of DTW distance.
+"""
+import argparse
+import logging
+
+from dgw.cli import StoreFilenameAction, StoreUniqueFilenameAction
+from dgw.cli.configuration import load_configuration_from_file
+from dgw.cluster import assign_to_clusters
+from dgw.bin.worker import read_regions, read_datasets, serialise
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('configuration_file', metavar='dgw_config_file.dgw', type=argparse.FileType('r'),
+                        help='Configuration file of the DGW run whose clusters the regions will be assigned to')
+
+    input_group = parser.add_argument_group('Input arguments')
+    input_group.add_argument('-r', '--regions', metavar='regions_of_interest.bed', action=StoreFilenameAction,
+                             help='A BED file listing genome regions that will be assigned')
+    input_group.add_argument('-d', '--datasets', metavar='dataset.bam', nargs='+', action=StoreUniqueFilenameAction,
+                             help='Datasets to read the regions from. '
+                                  'Must be the same datasets, in the same order, as the ones the run was made on')
+    input_group.add_argument('-pd', '--processed-dataset', metavar='processed_dataset.pd',
+                             action=StoreFilenameAction,
+                             help='Dataset that has already been processed, e.g. by dgw-worker. Can be used instead of -d')
+
+    preprocessing_group = parser.add_argument_group('Preprocessing',
+                                                    'Should be the same as the ones the run was made with')
+    preprocessing_group.add_argument('-ext', '--extend_to', help='Extend reads to specified length', type=int,
+                                     default=200)
+    preprocessing_group.add_argument('-mp', '--min-pileup', metavar='H', type=int, default=10,
+                                     help='Only assign the regions that have at least one bin that contains H or more '
+                                          'reads.')
+    preprocessing_group.add_argument('--normalise-pileups', action='store_const', const=True, default=False,
+                                     help='Normalise the number of elements in the bins by dividing them by the number '
+                                          'of reads falling into the bin with the largest reads.')
+
+    cut_group = parser.add_mutually_exclusive_group(required=True)
+    cut_group.add_argument('--cut', '-c', type=float, default=None, help='Cut threshold to form the clusters at.')
+    cut_group.add_argument('--n-clusters', '-nc', type=int, default=None, help='Number of clusters to form.')
+
+    parser.add_argument('-p', '--prefix', help='Prefix of the output files generated', default='dgw_assign')
+    parser.add_argument('-n', '--n-processes', metavar='N', type=int,
+                        help='Use up to N processes. Defaults to the maximum number available.')
+    parser.add_argument('-v', '--verbose', action='store_const', const=True, default=False)
+
+    return parser
+
+def main():
+    parser = argument_parser()
+    args = parser.parse_args()
+
+    if args.datasets and args.processed_dataset:
+        parser.error('Must specify either --dataset or --processed_dataset only.')
+    elif not args.processed_dataset:
+        if not args.regions or not args.datasets:
+            parser.error('Must specify both --regions and --dataset')
+
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    configuration = load_configuration_from_file(args.configuration_file)
+    args.configuration_file.close()
+
+    if configuration.blank:
+        parser.error('Cannot assign regions to the clusters of a --blank run of DGW')
+
+    # The regions are read in the same way as in the run
+    args.resolution = configuration.resolution
+    args.use_strand_information = configuration.use_strand_information
+
+    if args.regions:
+        print '> Reading regions from {0!r} ....'.format(args.regions)
+        regions, _, _ = read_regions(args.regions, None, args.resolution)
+    else:
+        regions = None
+
+    print '> Reading dataset ...'
+    dataset, missing_regions, filtered_regions = read_datasets(args, regions)
+
+    if args.datasets:
+        if len(missing_regions) > 0:
+            print '> {0} regions were not found in the dataset'.format(len(missing_regions))
+        if len(filtered_regions) > 0:
+            print '> {0} regions were filtered out from dataset due to --min-pileup constraint'.format(
+                len(filtered_regions))
+
+        dataset = dataset.to_log_scale()
+        if args.normalise_pileups:
+            dataset = dataset.normalise_bin_heights()
+
+    print '> Loading the clustering from {0!r}'.format(args.configuration_file.name)
+    hc = configuration.create_hierarchical_clustering_object(load_warping_paths=False)
+
+    if args.cut is not None:
+        cut = args.cut
+    else:
+        cut = hc.distance_threshold_for_n_clusters(args.n_clusters)
+
+    print '> Assigning {0} regions to {1} clusters'.format(len(dataset), len(hc.cut(cut)))
+    assignments, warping_paths = assign_to_clusters(hc, dataset, cut, n_processes=args.n_processes,
+                                                    **configuration.dtw_kwargs)
+
+    assignments_filename = '{0}_assignments.csv'.format(args.prefix)
+    print '> Saving assignments to {0!r}'.format(assignments_filename)
+    assignments.index.name = 'region'
+    assignments.to_csv(assignments_filename)
+
+    warping_paths_filename = '{0}_warping_paths.pickle'.format(args.prefix)
+    print '> Saving warping paths to {0!r}'.format(warping_paths_filename)
+    serialise(warping_paths, warping_paths_filename)
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,9 @@ def argument_parser():
                         help='Do not start the interactive viewer, just save the output.'
                              'Requires output directory and --cut or --n-clusters set',
                         action='store_const', const=True, default=False)
+    parser.add_argument('-n', '--n-processes', metavar='N', type=int,
+                        help='Use up to N processes when computing the warping paths of runs made with '
+                             '--lazy-warping-paths. Defaults to the maximum number available.')
     parser.add_argument('-v', '--verbose', action='store_const', const=True, default=False)
 
     return parser
@@ -89,7 +92,8 @@ def main():
             highlight_colours[dataset.points_of_interest.values()[0].keys()[0]] = standard_highlight_colours.pop()
 
 
-    hc = configuration.create_hierarchical_clustering_object(regions=regions, dataset=dataset)
+    hc = configuration.create_hierarchical_clustering_object(regions=regions, dataset=dataset,
+                                                             n_processes=args.n_processes)
     configuration_basename = os.path.basename(args.configuration_file.name)
 
     cut_xdata = 0
@@ -8,22 +8,31 @@ Designed to be run on a multi-core machine with a lot of memory, e.g. a supercom
 """
 import argparse
 import logging
+import os
 from math import factorial
 import random
+import tempfile
 import cPickle as pickle
 from datetime import datetime
+from itertools import izip
 from multiprocessing import cpu_count
 
 import fastcluster
 import numpy as np
 import pandas as pd
 
-from dgw.cluster import HierarchicalClustering, compute_paths
+from dgw.cluster import HierarchicalClustering, compute_paths, compute_paths_by_composition, knn_distances, \
+    sparse_single_linkage, coarse_to_fine_linkage, nn_chain_linkage, LazyWarpingPaths
 from dgw.data.containers import Regions
 from dgw.data.parsers import read_bam, HighestPileUpFilter
 from dgw.data.parsers.pois import from_simple
-from dgw.dtw.parallel import parallel_pdist
+from dgw.dtw.parallel import parallel_pdist, parallel_pdist_update, subset_condensed_distances, \
+    normalise_condensed_distances, combinations_count
+from dgw.dtw.shared import as_shared_dataset
+from dgw.dtw.utilities import _strip_nans
+from dgw.dtw.cache import DistanceCache
 from dgw.cli import StoreFilenameAction, StoreUniqueFilenameAction, Configuration
+from dgw.cli.configuration import load_configuration_from_file
 
 
 def argument_parser():
@@ -82,9 +91,56 @@ def argument_parser():
                         help='Do a blank run - just process the dataset.but do not calculate the pairwise distances')
 
     dgw_options_group.add_argument('-n', '--n-processes', metavar='N', type=int,
-                        help='Use up to N process when calculating pairwise distances.'
+                        help='Use up to N process when reading the datasets and calculating pairwise distances.'
                              ' Defaults to the maximum number available.')
 
+    dgw_options_group.add_argument('--previous-run', metavar='previous_config.dgw', action=StoreFilenameAction,
+                        help='Configuration file of a previous run with the same DTW parameters, that was run with '
+                             '--output-pairwise-distances. Only the distances involving regions that are not in the '
+                             'previous run will be computed.')
+
+    dgw_options_group.add_argument('--distance-cache', metavar='distances.sqlite',
+                        help='File to store the computed DTW distances in, so they can be reused by other runs '
+                             'that share some of the regions. Created if it does not exist.')
+
+    dgw_options_group.add_argument('--deduplicate', action='store_const', const=True, default=False,
+                        help='Compute the DTW distances only once for the regions whose processed data is identical, '
+                             'e.g. flat low-coverage regions. Distances between such regions are set to zero.')
+
+    dgw_options_group.add_argument('--knn', metavar='K', type=int, default=None,
+                        help='Approximate clustering for large sets of regions. Compute the DTW distances between '
+                             'each region and its K nearest neighbours only, and build the dendrogram using single '
+                             'linkage on these distances, instead of complete linkage on all pairwise distances.')
+
+    dgw_options_group.add_argument('--low-memory-linkage', action='store_const', const=True, default=False,
+                        help='Compute the linkage matrix in place, on a memory-mapped working copy of the pairwise '
+                             'distance matrix stored next to the output files, using the nearest-neighbour chain '
+                             'algorithm in parallel. Slower than the default, but the distance matrix does not need '
+                             'to be kept in memory while the linkage is computed.')
+    dgw_options_group.add_argument('--single-precision-linkage', action='store_const', const=True, default=False,
+                        help='Store the working copy of the distances of --low-memory-linkage in single precision, '
+                             'halving its size.')
+
+    dgw_options_group.add_argument('--coarse-to-fine', metavar='F', type=int, default=None,
+                        help='Two-stage clustering for large sets of regions. Cluster the regions at F times coarser '
+                             'resolution first, and compute the exact distances only between the regions in the same '
+                             'group of the coarse dendrogram. See --max-group-size.')
+    dgw_options_group.add_argument('--max-group-size', metavar='N', type=int, default=1000,
+                        help='Maximum number of regions in a group of the coarse dendrogram when --coarse-to-fine '
+                             'is set.')
+
+    dgw_options_group.add_argument('--compose-warping-paths', metavar='T', nargs='?', type=float, const=np.inf,
+                        default=None,
+                        help='Derive the warping paths of the regions to the prototypes of the nodes above them by '
+                             'composing the paths between the prototypes of child and parent nodes, rather than '
+                             'running DTW for each of them. If T is given, the paths of the nodes at or above '
+                             'the cut distance T are still computed exactly.')
+
+    dgw_options_group.add_argument('--lazy-warping-paths', action='store_const', const=True, default=False,
+                        help='Do not compute the warping paths of all the nodes up front. '
+                             'dgw-explorer will compute them for the nodes it needs, and store them in '
+                             '{prefix}_warping_paths directory to be reused in the later sessions.')
+
     dgw_options_group.add_argument('--output-raw-dataset', action='store_const', const=True, default=False,
                         help='Output raw dataset into format readable by DGW')
 
@@ -104,7 +160,13 @@ def argument_parser():
 
 
     preprocessing_group.add_argument('--output-pairwise-distances', action='store_const', const=True, default=False,
-                        help='If provided, DGW will output the intermediate pairwise distance matrix computed.')
+                        help='If provided, DGW will output the intermediate pairwise distance matrix computed, '
+                             'as well as the raw, not length-normalised, distances.')
+    preprocessing_group.add_argument('--raw-pairwise-distances', metavar='raw_pairwise_distances.npy',
+                        action=StoreFilenameAction,
+                        help='Raw pairwise distances output by a previous run on the same processed dataset with the '
+                             'same DTW parameters. The distances will not be computed again, which allows changing '
+                             '--no-length-normalisation without rerunning DTW.')
 
 
 
@@ -149,7 +211,8 @@ def read_datasets(args, regions):
                         extend_to=args.extend_to,
                         data_filters=data_filters,
                         output_removed_indices=True,
-                        reverse_negative_strand_regions=args.use_strand_information)
+                        reverse_negative_strand_regions=args.use_strand_information,
+                        n_processes=args.n_processes)
     else:
         processed_dataset_file = args.processed_dataset
         logging.debug('Reading processed dataset {0!r}'.format(processed_dataset_file))
@@ -172,6 +235,79 @@ def deserialise(filename):
     finally:
         f.close()
 
+def load_previous_run(parser, previous_run_filename, configuration):
+    """
+    Loads the configuration of the previous run and makes sure its pairwise distances can be reused in this one.
+
+    :param parser: argument parser to report the errors to
+    :param previous_run_filename: configuration file of the previous run
+    :param configuration: configuration of the current run
+    :return:
+    """
+    previous_configuration = load_configuration_from_file(previous_run_filename)
+
+    if previous_configuration.blank or previous_configuration.pairwise_distances_filename is None:
+        parser.error('The previous run {0!r} did not output pairwise distances. '
+                     'Rerun it with --output-pairwise-distances'.format(previous_run_filename))
+    if previous_configuration.dtw_kwargs != configuration.dtw_kwargs:
+        parser.error('The previous run used different DTW parameters: {0!r}, cannot reuse its distances with {1!r}'
+                     .format(previous_configuration.dtw_kwargs, configuration.dtw_kwargs))
+    if previous_configuration.resolution != configuration.resolution:
+        parser.error('The previous run used different resolution: {0}, cannot reuse its distances with {1}'
+                     .format(previous_configuration.resolution, configuration.resolution))
+
+    return previous_configuration
+
+def reuse_previous_distances(dataset, previous_configuration):
+    """
+    Reorders the dataset so the regions that were already processed in the previous run come first,
+    and returns the pairwise distances between these regions from the previous run.
+
+    :param dataset: dataset of the current run
+    :param previous_configuration: configuration of the previous run, see `load_previous_run`
+    :return: the reordered dataset, the condensed distance matrix of its regions that were in the previous run,
+             and whether the distances are raw (not normalised) DTW costs
+    """
+    previous_dataset = previous_configuration.load_dataset()
+
+    current_items = set(dataset.items)
+    previous_items = set(previous_dataset.items)
+    kept_items = [ix for ix in previous_dataset.items if ix in current_items]
+    new_items = [ix for ix in dataset.items if ix not in previous_items]
+
+    # Compare the regions one by one, so neither of the datasets is copied
+    previous_values = previous_dataset.values
+    current_values = dataset.shared_dataset
+    if current_values is None:
+        current_values = dataset.values
+
+    for previous_position, current_position in izip(previous_dataset.items.get_indexer(kept_items),
+                                                    dataset.items.get_indexer(kept_items)):
+        if not np.array_equal(_strip_nans(previous_values[previous_position]),
+                              _strip_nans(current_values[current_position])):
+            raise Exception('The data of the regions shared with the previous run differs from the data in this run. '
+                            'Make sure the same datasets and preprocessing options are used')
+    del previous_values, current_values
+
+    print '> {0} regions are reused from the previous run, {1} of its regions were dropped, ' \
+          '{2} regions are new'.format(len(kept_items), len(previous_items) - len(kept_items), len(new_items))
+
+    raw_distances_filename = previous_configuration.raw_pairwise_distances_filename
+    if raw_distances_filename is not None and os.path.exists(raw_distances_filename):
+        previous_distances = np.load(raw_distances_filename)
+        raw = True
+    else:
+        # Runs before the raw distances were stored
+        previous_distances = np.load(previous_configuration.pairwise_distances_filename)
+        raw = False
+
+    previous_distances = subset_condensed_distances(previous_distances,
+                                                    previous_dataset.items.get_indexer(kept_items))
+
+    # Reorder the dataset without copying its values in shared memory
+    dataset = dataset.take(dataset.items.get_indexer(kept_items + new_items))
+    return dataset, previous_distances, raw
+
 def binomial_coefficent(n, k):
     return factorial(n) / (factorial(k) * factorial(n-k))
 
@@ -216,8 +352,55 @@ def main():
     if args.use_strand_information:
         args.no_reverse = True
 
+    if args.lazy_warping_paths and args.compose_warping_paths is not None:
+        parser.error('--lazy-warping-paths cannot be used with --compose-warping-paths')
+
+    if args.knn is not None:
+        if args.knn < 1:
+            parser.error('--knn must be at least 1')
+        if args.previous_run or args.raw_pairwise_distances or args.output_pairwise_distances:
+            parser.error('--knn cannot be used with --previous-run, --raw-pairwise-distances '
+                         'or --output-pairwise-distances, as it does not compute all pairwise distances')
+        if args.distance_cache or args.deduplicate:
+            parser.error('--knn cannot be used with --distance-cache or --deduplicate')
+
+    if args.coarse_to_fine is not None:
+        if args.coarse_to_fine < 1:
+            parser.error('--coarse-to-fine must be at least 1')
+        if args.knn is not None:
+            parser.error('--coarse-to-fine cannot be used with --knn')
+        if args.previous_run or args.raw_pairwise_distances or args.output_pairwise_distances:
+            parser.error('--coarse-to-fine cannot be used with --previous-run, --raw-pairwise-distances '
+                         'or --output-pairwise-distances, as it does not compute all pairwise distances')
+        if args.distance_cache or args.deduplicate:
+            parser.error('--coarse-to-fine cannot be used with --distance-cache or --deduplicate')
+        if args.no_length_normalisation:
+            parser.error('--coarse-to-fine cannot be used with --no-length-normalisation, as the DTW costs at the '
+                         'coarse resolution are not comparable to the exact ones unless they are normalised')
+
+    if args.low_memory_linkage and (args.knn is not None or args.coarse_to_fine is not None):
+        parser.error('--low-memory-linkage cannot be used with --knn or --coarse-to-fine, '
+                     'as they do not compute the full pairwise distance matrix')
+    if args.single_precision_linkage and not args.low_memory_linkage:
+        parser.error('--single-precision-linkage can only be used with --low-memory-linkage')
+
+    if args.previous_run:
+        if args.blank:
+            parser.error('--previous-run cannot be used with --blank')
+        if args.deduplicate:
+            parser.error('--previous-run cannot be used with --deduplicate')
+        if args.raw_pairwise_distances:
+            parser.error('--previous-run cannot be used with --raw-pairwise-distances')
+        # The enlarged matrix should be reusable by the subsequent runs
+        args.output_pairwise_distances = True
+
     configuration = Configuration(args)
 
+    if args.previous_run:
+        previous_configuration = load_previous_run(parser, args.previous_run, configuration)
+    else:
+        previous_configuration = None
+
     # --- pre-processing ------------------------
     if args.regions:
         print '> Reading regions from {0!r} ....'.format(args.regions)
@@ -330,6 +513,15 @@ def main():
     else:
         print "> Not converting dataset to log scale as processed dataset already provided"
 
+    if previous_configuration is not None:
+        print '> Reading previous run from {0!r}'.format(args.previous_run)
+        dataset, previous_distances, previous_distances_are_raw = reuse_previous_distances(dataset,
+                                                                                           previous_configuration)
+        if regions is not None:
+            regions = regions.ix[dataset.items]
+    else:
+        previous_distances = None
+
     # --- Serialise the regions as they will be needed in explorer ----------
     if regions is not None:
         print '> Serialising regions to {0}'.format(configuration.parsed_regions_filename)
@@ -351,15 +543,63 @@ def main():
         if args.no_dtw:
             print '> Not using DTW as --no-dtw option is set'
 
+        # Place the dataset into shared memory once, so it can be reused by all parallel stages below.
+        # Datasets read from BAM files are already there
+        shared_dataset = as_shared_dataset(dataset)
+
+        if args.distance_cache:
+            print '> Using distance cache {0!r}'.format(args.distance_cache)
+            distance_cache = DistanceCache(args.distance_cache)
+        else:
+            distance_cache = None
+
         logging.debug('Running DTW with the following kwargs: {0!r}'.format(configuration.dtw_kwargs))
+        # Compute the raw DTW costs, these can be normalised without running DTW again
+        raw_dtw_kwargs = dict(configuration.dtw_kwargs, normalise=False)
+        raw_dm = None
+
         start = datetime.now()
-        dm = parallel_pdist(dataset, args.n_processes, **configuration.dtw_kwargs)
+        if args.knn is not None:
+            print '> Computing the distances to the {0} nearest neighbours of each region only, ' \
+                  'as --knn is set'.format(args.knn)
+            knn_rows, knn_cols, knn_dm = knn_distances(shared_dataset, args.knn, n_processes=args.n_processes,
+                                                       **configuration.dtw_kwargs)
+        elif args.coarse_to_fine is not None:
+            print '> Clustering at {0} times coarser resolution first, and computing the exact distances only ' \
+                  'within the groups of at most {1} regions, as --coarse-to-fine is set'.format(args.coarse_to_fine,
+                                                                                               args.max_group_size)
+            linkage = coarse_to_fine_linkage(shared_dataset, args.coarse_to_fine, args.max_group_size,
+                                             n_processes=args.n_processes, **configuration.dtw_kwargs)
+        elif args.raw_pairwise_distances:
+            print '> Reading raw pairwise distances from {0!r}'.format(args.raw_pairwise_distances)
+            raw_dm = np.load(args.raw_pairwise_distances)
+            if len(raw_dm) != combinations_count(len(dataset)):
+                parser.error('The raw pairwise distances provided do not match the dataset. '
+                             'Expected {0} distances, got {1}'.format(combinations_count(len(dataset)), len(raw_dm)))
+        elif previous_distances is not None:
+            print '> Reusing {0} pairwise distances from the previous run'.format(len(previous_distances))
+            if previous_distances_are_raw:
+                raw_dm = parallel_pdist_update(shared_dataset, previous_distances, args.n_processes,
+                                               distance_cache=distance_cache, **raw_dtw_kwargs)
+            else:
+                dm = parallel_pdist_update(shared_dataset, previous_distances, args.n_processes,
+                                           distance_cache=distance_cache, **configuration.dtw_kwargs)
+        else:
+            raw_dm = parallel_pdist(shared_dataset, args.n_processes, distance_cache=distance_cache,
+                                    deduplicate=args.deduplicate, **raw_dtw_kwargs)
+
+        if raw_dm is not None:
+            if configuration.dtw_kwargs['normalise']:
+                dm = normalise_condensed_distances(raw_dm, shared_dataset.lengths)
+            else:
+                dm = raw_dm
         end = datetime.now()
 
         delta = end - start
         print '> Pairwise distances calculation took {0} s'.format(delta.total_seconds())
 
-        if args.random_sample:
+        if args.random_sample and previous_distances is None and not args.raw_pairwise_distances \
+                and args.knn is None and args.coarse_to_fine is None:
             multiplier = binomial_coefficent(total_regions, 2) / float(binomial_coefficent(args.random_sample, 2))
             print '> Expected calculation duration if random-sample was not used: {0} s'\
                    .format(delta.total_seconds() * multiplier)
@@ -370,9 +610,43 @@ def main():
             print '> Saving the pairwise distance matrix to {0!r}'.format(configuration.pairwise_distances_filename)
             np.save(configuration.pairwise_distances_filename, dm)
 
+        if configuration.raw_pairwise_distances_filename:
+            if raw_dm is not None:
+                print '> Saving the raw pairwise distance matrix to {0!r}'.format(
+                    configuration.raw_pairwise_distances_filename)
+                np.save(configuration.raw_pairwise_distances_filename, raw_dm)
+            else:
+                # Only the normalised distances are known, e.g. when they were reused from a run that did not
+                # store the raw ones, so make sure the configuration does not point to a file that does not exist
+                configuration.discard_filename('raw_pairwise_distances')
+
         # Linkage matrix
-        print '> Computing linkage matrix'
-        linkage = fastcluster.complete(dm)
+        if args.knn is not None:
+            print '> Computing linkage matrix'
+            linkage = sparse_single_linkage(len(dataset), knn_rows, knn_cols, knn_dm)
+        elif args.coarse_to_fine is None:
+            print '> Computing linkage matrix'
+            if args.low_memory_linkage:
+                # The linkage overwrites the distances it is given, so it is computed on a working copy of them
+                # that is memory-mapped from disk. The matrices are saved by now, and can be released from memory
+                dtype = np.float32 if args.single_precision_linkage else dm.dtype
+                working_file, working_filename = tempfile.mkstemp(suffix='.npy', prefix='dgw-linkage-',
+                                                                  dir=configuration.directory or None)
+                os.close(working_file)
+                try:
+                    working_dm = np.lib.format.open_memmap(working_filename, mode='w+', dtype=dtype, shape=dm.shape)
+                    working_dm[:] = dm
+                    del working_dm
+                    dm = raw_dm = None
+
+                    working_dm = np.load(working_filename, mmap_mode='r+')
+                    linkage = nn_chain_linkage(working_dm, method='complete', copy=False,
+                                               n_threads=args.n_processes)
+                    del working_dm
+                finally:
+                    os.remove(working_filename)
+            else:
+                linkage = fastcluster.complete(dm)
 
         print '> Saving linkage matrix to {0!r}'.format(configuration.linkage_filename)
         np.save(configuration.linkage_filename, linkage)
@@ -380,17 +654,33 @@ def main():
         print '> Computing prototypes'
         # Hierarchical clustering object to compute the prototypes
         hc = HierarchicalClustering(dataset, regions, linkage, dtw_function=configuration.dtw_function,
-                                    prototyping_method=configuration.prototyping_method)
+                                    prototyping_method=configuration.prototyping_method,
+                                    n_processes=args.n_processes)
         prototypes = hc.extract_prototypes()
         print '> Saving prototypes to {0!r}'.format(configuration.prototypes_filename)
         serialise(prototypes, configuration.prototypes_filename)
 
-        print '> Computing warping paths'
         nodes = hc.tree_nodes_list
-        paths = compute_paths(dataset, nodes, hc.num_obs, n_processes=args.n_processes,
-                              **configuration.dtw_kwargs)
-        print '> Saving warping paths to {0!r}'.format(configuration.warping_paths_filename)
-        serialise(paths, configuration.warping_paths_filename)
+        if args.lazy_warping_paths:
+            print '> Not computing warping paths as --lazy-warping-paths is set. ' \
+                  'They will be stored in {0!r} once computed'.format(configuration.warping_paths_cache_directory)
+            # Make sure the paths cached by a previous run with the same prefix are not used for this one
+            LazyWarpingPaths(configuration.warping_paths_cache_directory, configuration.dtw_kwargs).reset(hc)
+            paths = None
+        elif args.compose_warping_paths is not None:
+            print '> Computing warping paths'
+            print '> Composing the warping paths of the nodes below distance {0}'.format(args.compose_warping_paths)
+            paths = compute_paths_by_composition(shared_dataset, nodes, hc.num_obs,
+                                                 exact_threshold=args.compose_warping_paths,
+                                                 n_processes=args.n_processes, **configuration.dtw_kwargs)
+        else:
+            print '> Computing warping paths'
+            paths = compute_paths(shared_dataset, nodes, hc.num_obs, n_processes=args.n_processes,
+                                  **configuration.dtw_kwargs)
+
+        if paths is not None:
+            print '> Saving warping paths to {0!r}'.format(configuration.warping_paths_filename)
+            serialise(paths, configuration.warping_paths_filename)
     else:
         print '> Skipping pairwise distances step because of --blank option set'
 
@@ -2,7 +2,7 @@ import json
 import os
 import cPickle as pickle
 import dgw
-from dgw.cluster import add_path_data
+from dgw.cluster import add_path_data, LazyWarpingPaths
 from ..dtw.distance import parametrised_dtw_wrapper
 import numpy as np
 
@@ -48,9 +48,11 @@ class Configuration(object):
 
     DEFAULT_FILENAMES = {
         'pairwise_distances': '{prefix}_pairwise_distances.npy',
+        'raw_pairwise_distances': '{prefix}_raw_pairwise_distances.npy',
         'linkage': '{prefix}_linkage.npy',
         'prototypes': '{prefix}_prototypes.pickle',
         'warping_paths': '{prefix}_warping_paths.pickle',
+        'warping_paths_cache': '{prefix}_warping_paths',
         'config': '{prefix}_config.dgw',
         'missing_regions': '{prefix}_missing_regions.bed',
         'filtered_regions': '{prefix}_filtered_regions.bed',
@@ -114,10 +116,14 @@ class Configuration(object):
         if not args.blank:
             if args.output_pairwise_distances:
                 self._save_default_filename('pairwise_distances', prefix)
+                self._save_default_filename('raw_pairwise_distances', prefix)
 
             self._save_default_filename('linkage', prefix)
             self._save_default_filename('prototypes', prefix)
-            self._save_default_filename('warping_paths', prefix)
+            if args.lazy_warping_paths:
+                self._save_default_filename('warping_paths_cache', prefix)
+            else:
+                self._save_default_filename('warping_paths', prefix)
 
         if args.regions:
             self._save_default_filename('regions', prefix)
@@ -139,6 +145,14 @@ class Configuration(object):
     def _save_default_filename(self, file_type, prefix):
         self.FILENAMES[file_type] = self.DEFAULT_FILENAMES[file_type].format(prefix=prefix)
 
+    def discard_filename(self, file_type):
+        """
+        Removes the filename of a file that was not output after all, so the configuration does not point to it.
+
+        :param file_type: type of the file, e.g. `raw_pairwise_distances`
+        """
+        self.FILENAMES.pop(file_type, None)
+
     def set_ignore_directory(self, value):
         self._ignore_directory = value
 
@@ -152,6 +166,10 @@ class Configuration(object):
     def pairwise_distances_filename(self):
         return self._get_filename('pairwise_distances')
 
+    @property
+    def raw_pairwise_distances_filename(self):
+        return self._get_filename('raw_pairwise_distances')
+
     @property
     def linkage_filename(self):
         return self._get_filename('linkage')
@@ -164,6 +182,10 @@ class Configuration(object):
     def warping_paths_filename(self):
         return self._get_filename('warping_paths')
 
+    @property
+    def warping_paths_cache_directory(self):
+        return self._get_filename('warping_paths_cache')
+
     @property
     def configuration_filename(self):
         return self._get_filename('config')
@@ -265,7 +287,8 @@ class Configuration(object):
     def load_warping_paths(self):
         return strict_load(self.warping_paths_filename)
 
-    def create_hierarchical_clustering_object(self, dataset=None, regions=None):
+    def create_hierarchical_clustering_object(self, dataset=None, regions=None, n_processes=None,
+                                              load_warping_paths=True):
         if self.blank:
             raise Exception('Cannot create HierarchicalClustering object from a blank runk')
 
@@ -278,12 +301,21 @@ class Configuration(object):
         prototypes = self.load_prototypes()
         dtw_function = self.dtw_function
         prototyping_method = self.prototyping_method
-        warping_paths = self.load_warping_paths()
 
         hc = dgw.cluster.analysis.HierarchicalClustering(dataset, regions, linkage_matrix=linkage, prototypes=prototypes,
                                                          dtw_function=dtw_function,
                                                          prototyping_method=prototyping_method)
-        add_path_data(hc.tree_nodes_list, hc.num_obs, warping_paths)
+
+        if not load_warping_paths:
+            return hc
+
+        if self.warping_paths_filename is not None:
+            warping_paths = self.load_warping_paths()
+            add_path_data(hc.tree_nodes_list, hc.num_obs, warping_paths)
+        else:
+            # Warping paths were not computed by the worker, compute them as needed
+            hc.lazy_warping_paths = LazyWarpingPaths(self.warping_paths_cache_directory, self.dtw_kwargs,
+                                                     n_processes=n_processes)
 
         return hc
 
@@ -1 +1,6 @@
-from analysis import *
\ No newline at end of file
+from analysis import *
+from assignment import *
+from sparse import *
+from coarse import *
+from kmedoids import *
+from linkage import *
\ No newline at end of file
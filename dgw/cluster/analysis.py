@@ -1,13 +1,20 @@
 from collections import defaultdict
+from functools import partial
+from itertools import izip
+import os
+import cPickle as pickle
+import hashlib
+import json
+import tempfile
 from logging import debug
-from math import floor
 import scipy.cluster.hierarchy as hierarchy
 import pandas as pd
 import numpy as np
 from ..data.containers import AlignmentsData
-from ..dtw.distance import dtw_std, dtw_path_is_reversed, warping_conservation_vector
-from ..dtw import transformations, dtw_projection, no_nans_len
-from ..dtw.parallel import parallel_dtw_paths
+from ..dtw.distance import dtw_std, dtw_path_is_reversed, warping_conservation_vectors
+from ..dtw import transformations, dtw_projection_batch, no_nans_len
+from ..dtw.parallel import parallel_dtw_paths, WorkerPool
+from ..dtw.shared import SharedDataset, as_shared_dataset
 import gzip
 import scipy.stats
 
@@ -19,14 +26,330 @@ def compute_paths(data, dtw_nodes_list, n, n_processes=None, *dtw_args, **dtw_kw
     paths = parallel_dtw_paths(data, non_leaf_nodes, n_processes=n_processes, *dtw_args, **dtw_kwargs)
     return paths
 
-def _to_dtw_tree(linkage, hierarchical_clustering_object, prototypes, prototyping_function='mean'):
+class _Alignment(object):
+    """
+    Stand-in for `DTWClusterNode` for `parallel_dtw_paths`: aligns the sequences in `index` to the `prototype`
+    """
+    def __init__(self, id, index, prototype):
+        self.id = id
+        self.index = index
+        self.prototype = prototype
+
+def compute_paths_by_composition(data, dtw_nodes_list, n, exact_threshold=None, n_processes=None,
+                                 *dtw_args, **dtw_kwargs):
+    """
+    Computes the warping paths between the items and the prototypes of the nodes that contain them,
+    just like `compute_paths`, but without running DTW between every item and every node above it.
+
+    Only the paths between the prototype of each node and the prototype of its parent are computed.
+    The path of an item to a node is then composed from the path of the item to the child of the node,
+    and the path of the child to the node, see `dgw.dtw.transformations.compose_warping_paths`.
+    The composed paths approximate the paths that DTW would find.
+
+    :param data: `AlignmentsData` or `SharedDataset` of the items in the tree
+    :param dtw_nodes_list: list of `DTWClusterNode` objects in the order `HierarchicalClustering.tree_nodes_list`
+    :param n: number of leaf nodes
+    :param exact_threshold: paths of the nodes with distance at or above this threshold are computed exactly
+    :param n_processes: number of processes to use
+    :param dtw_args: args to pass to dtw
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: dictionary of dictionaries {node.id: {item: path}}
+    """
+    dataset = as_shared_dataset(data)
+    non_leaf_nodes = dtw_nodes_list[n:]
+
+    if exact_threshold is not None:
+        exact_nodes = [node for node in non_leaf_nodes if node.dist >= exact_threshold]
+    else:
+        exact_nodes = []
+    exact_node_ids = set([node.id for node in exact_nodes])
+
+    positions = {}
+    for position, node in enumerate(dtw_nodes_list):
+        positions[id(node)] = position
+
+    # Align the children of each of the remaining nodes to the node's prototype
+    sequences = [dataset[i] for i in xrange(n)]
+    sequence_positions = range(n)
+    for position in xrange(n, len(dtw_nodes_list) - 1):
+        sequences.append(dtw_nodes_list[position].prototype.values)
+        sequence_positions.append(position)
+    children = SharedDataset.from_sequences(sequences, items=sequence_positions)
+
+    alignments = []
+    for node in non_leaf_nodes:
+        if node.id not in exact_node_ids:
+            alignments.append(_Alignment(node.id, [positions[id(node.get_left())], positions[id(node.get_right())]],
+                                         node.prototype))
+
+    debug('Computing {0} exact and {1} child-to-parent path sets'.format(len(exact_nodes), len(alignments)))
+    paths = parallel_dtw_paths(dataset, exact_nodes, n_processes=n_processes, *dtw_args, **dtw_kwargs)
+    child_paths = parallel_dtw_paths(children, alignments, n_processes=n_processes, *dtw_args, **dtw_kwargs)
+    del children
+
+    # Nodes are ordered so the children always come before their parents
+    for node in non_leaf_nodes:
+        if node.id in exact_node_ids:
+            continue
+
+        node_paths = {}
+        for child in [node.get_left(), node.get_right()]:
+            child_to_node = child_paths[node.id][positions[id(child)]]
+            if child.is_leaf():
+                node_paths[child.id] = child_to_node
+            else:
+                for ix, item_to_child in paths[child.id].iteritems():
+                    node_paths[ix] = transformations.compose_warping_paths(item_to_child, child_to_node)
+        paths[node.id] = node_paths
+
+    return paths
+
+def _prototype_worker(prototyping_function, merge):
+    left_prototype, right_prototype, left_count, right_count = merge
+    return prototyping_function(left_prototype, right_prototype, left_count, right_count)
+
+def parallel_prototypes(linkage, leaf_prototypes, prototyping_function, n_processes=None):
+    """
+    Computes the prototypes of all the merges in the linkage matrix in parallel.
+
+    A merge is scheduled as soon as the prototypes of both of its children are known, therefore
+    the merges in independent subtrees are computed at the same time.
+
+    :param linkage: linkage matrix
+    :param leaf_prototypes: prototypes of the original observations, e.g. rows of `AlignmentsData.values`
+    :param prototyping_function: "reduce" function for prototype calculation, see `_to_dtw_tree`
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :return: dictionary `{node_id: prototype}` of the non-leaf nodes
+    """
+    n = linkage.shape[0] + 1
+
+    def _count(node_id):
+        return 1 if node_id < n else int(linkage[node_id - n, 3])
+
+    def _prototype(node_id):
+        return leaf_prototypes[node_id] if node_id < n else prototypes[node_id]
+
+    def _merge(node_id):
+        left, right = int(linkage[node_id - n, 0]), int(linkage[node_id - n, 1])
+        return _prototype(left), _prototype(right), _count(left), _count(right)
+
+    parents = {}
+    for i in xrange(n - 1):
+        parents[int(linkage[i, 0])] = parents[int(linkage[i, 1])] = i + n
+
+    prototypes = {}
+    pool = WorkerPool(partial(_prototype_worker, prototyping_function), n_processes=n_processes)
+    with pool:
+        # Merges of two leaves can start straight away
+        for i in xrange(n - 1):
+            if linkage[i, 0] < n and linkage[i, 1] < n:
+                pool.submit(i + n, _merge(i + n))
+
+        for node_id, prototype in pool.completed():
+            prototypes[node_id] = prototype
+
+            try:
+                parent = parents[node_id]
+            except KeyError:
+                continue  # Root node
+
+            left, right = int(linkage[parent - n, 0]), int(linkage[parent - n, 1])
+            if (left < n or left in prototypes) and (right < n or right in prototypes):
+                pool.submit(parent, _merge(parent))
+
+    return prototypes
+
+def mean_prototypes(linkage, leaf_prototypes):
+    """
+    Computes the mean prototypes of all the merges in the linkage matrix.
+
+    Each node keeps the sum of the values of the leaves under it, and the number of non-NaN values in each bin,
+    therefore the prototype of a merge is computed from the two children only.
+    Bins that are NaN in all of the leaves under the node (i.e. beyond the end of all of the sequences) remain NaN.
+
+    :param linkage: linkage matrix
+    :param leaf_prototypes: three-dimensional array of the NaN-padded original observations,
+                            e.g. `AlignmentsData.values`
+    :return: list of `n-1` prototypes of the non-leaf nodes, in the order of their ids
+    """
+    n = linkage.shape[0] + 1
+
+    sums = {}
+    counts = {}
+
+    def _sum_and_count(node_id):
+        if node_id < n:
+            values = leaf_prototypes[node_id]
+            not_nan = ~np.isnan(values)
+            return np.where(not_nan, values, 0), not_nan.astype(int)
+        else:
+            # Every node is merged only once, so there is no need to keep the sums of its children around
+            return sums.pop(node_id), counts.pop(node_id)
+
+    prototypes = [None] * (n - 1)
+    for i in xrange(n - 1):
+        left_sum, left_count = _sum_and_count(int(linkage[i, 0]))
+        right_sum, right_count = _sum_and_count(int(linkage[i, 1]))
+
+        node_sum = left_sum + right_sum
+        node_count = left_count + right_count
+        sums[i + n] = node_sum
+        counts[i + n] = node_count
+
+        with np.errstate(invalid='ignore'):
+            prototypes[i] = node_sum / node_count
+
+    return prototypes
+
+class _CompactTree(object):
+    """
+    Compact representation of the tree the `DTWClusterNode`s are views of.
+
+    The leaves are ordered the way the dendrogram traverses them (left subtree first), so each of the nodes
+    covers a contiguous `[start, end)` range of the leaf order. The prototypes of non-leaf nodes are packed
+    into a single array, node `i + n` owning the rows `[offsets[i], offsets[i] + lengths[i])` of it.
+
+    Each node also keeps the smallest distance of its ancestors, so the clusters formed by cutting the tree at
+    any threshold can be found without walking the tree.
+
+    Nodes are addressed by their position in `HierarchicalClustering.tree_nodes_list`,
+    which is the same as the id of the non-leaf nodes in the linkage matrix.
+    """
+    _hierarchical_clustering_object = None
+    _n = None
+    _leaf_order = None
+    _starts = None
+    _ends = None
+    _distances = None
+    _min_ancestor_distances = None
+
+    _prototype_values = None
+    _prototype_offsets = None
+    _prototype_lengths = None
+
+    def __init__(self, linkage, hierarchical_clustering_object):
+        self._hierarchical_clustering_object = hierarchical_clustering_object
+
+        n = linkage.shape[0] + 1
+        self._n = n
+
+        counts = np.ones(2 * n - 1, dtype=int)
+        counts[n:] = linkage[:, 3]
+        children = linkage[:, :2].astype(int)
+
+        distances = np.zeros(2 * n - 1)
+        distances[n:] = linkage[:, 2]
+
+        # Parents always come after their children, so go from the root down
+        starts = np.zeros(2 * n - 1, dtype=int)
+        min_ancestor_distances = np.empty(2 * n - 1)
+        min_ancestor_distances[-1] = np.inf
+        for i in xrange(n - 2, -1, -1):
+            left, right = children[i]
+            starts[left] = starts[i + n]
+            starts[right] = starts[i + n] + counts[left]
+            min_ancestor_distances[left] = min_ancestor_distances[right] = min(min_ancestor_distances[i + n],
+                                                                               distances[i + n])
+
+        self._leaf_order = np.empty(n, dtype=int)
+        self._leaf_order[starts[:n]] = np.arange(n)
+        self._starts = starts
+        self._ends = starts + counts
+        self._distances = distances
+        self._min_ancestor_distances = min_ancestor_distances
+
+    @property
+    def leaf_order(self):
+        """
+        Positions of the leaves in the order of dendrogram traversal
+        """
+        return self._leaf_order
+
+    def index(self, position):
+        """
+        Returns the labels of the items under the node at the position provided, in leaf order
+        """
+        labels = self._hierarchical_clustering_object.data.items
+        return labels[self._leaf_order[self._starts[position]:self._ends[position]]]
+
+    def cluster_roots(self, t):
+        """
+        Returns the positions of the roots of the clusters formed by cutting the tree at threshold `t`, in leaf order.
+
+        A node is a root of a cluster if its distance is below the threshold, and the distances of all of its
+        ancestors are not, which also holds for the linkages that are not monotonic.
+
+        :param t: threshold to cut the tree at
+        """
+        roots = np.nonzero((self._distances < t) & (t <= self._min_ancestor_distances))[0]
+        return roots[np.argsort(self._starts[roots], kind='mergesort')]
+
+    def cluster_labels(self, roots):
+        """
+        Returns the number of the cluster each of the items belongs to, in the order of the data items.
+
+        :param roots: positions of the roots of the clusters, these must cover each of the leaves exactly once.
+                      The clusters are numbered from 1 in the order of this list.
+        """
+        roots = np.asarray(roots, dtype=int)
+        order = np.argsort(self._starts[roots], kind='mergesort')
+        counts = self._ends[roots] - self._starts[roots]
+        if counts.sum() != self._n:
+            raise ValueError('Clusters do not cover each of the items exactly once')
+
+        labels = np.empty(self._n, dtype=int)
+        labels[self._leaf_order] = np.repeat(order + 1, counts[order])
+        return labels
+
+    def set_prototypes(self, prototypes):
+        """
+        Packs the prototypes of the non-leaf nodes into a single array.
+
+        :param prototypes: list of `n-1` two-dimensional prototypes of the non-leaf nodes, in the order of their ids
+        """
+        ndim = self._hierarchical_clustering_object.data.number_of_datasets
+        prototypes = [np.asarray(prototype, dtype=float).reshape(-1, ndim) for prototype in prototypes]
+
+        self._prototype_lengths = np.array([len(prototype) for prototype in prototypes], dtype=int)
+        self._prototype_offsets = np.concatenate(([0], np.cumsum(self._prototype_lengths)[:-1])).astype(int)
+        if prototypes:
+            self._prototype_values = np.concatenate(prototypes)
+        else:
+            self._prototype_values = np.empty((0, ndim))
+
+    def prototype_values(self, position):
+        """
+        Returns the prototype of the node as an array, without copying it
+        """
+        if position < self._n:
+            return self._hierarchical_clustering_object.data.values[position]
+
+        offset = self._prototype_offsets[position - self._n]
+        return self._prototype_values[offset:offset + self._prototype_lengths[position - self._n]]
+
+    def prototype(self, position):
+        """
+        Returns the prototype of the node as `pd.DataFrame`
+        """
+        data = self._hierarchical_clustering_object.data
+        if position < self._n:
+            return data.ix[data.items[position]]
+        else:
+            return pd.DataFrame(self.prototype_values(position), columns=data.dataset_axis)
+
+def _to_dtw_tree(linkage, hierarchical_clustering_object, prototypes, prototyping_function='mean', n_processes=1):
     """
     Converts a hierarchical clustering linkage matrix `linkage` to hierarchy of `DTWClusterNode`s.
     This is a modification of `scipy.cluster.hierarchy.to_tree` function and the code is mostly taken from it.
 
+    The nodes are lightweight views of a `_CompactTree`, their indices and prototypes are only
+    created when they are accessed.
+
     :param linkage: linkage matrix to convert to the DTW Tree
     :param hierarchical_clustering_object: hierarchical clustering object to work with
     :param prototyping_function: "reduce" function for prototype calculation, or "mean" to simply use data mean
+    :param n_processes: number of processes to compute the prototypes on, see `parallel_prototypes`.
+                        The prototypes are computed serially if set to 1.
     """
 
     # Validation
@@ -35,18 +358,48 @@ def _to_dtw_tree(linkage, hierarchical_clustering_object, prototypes, prototypin
 
     data = hierarchical_clustering_object.data
     labels = data.items
-    values = data.ix
 
     n = linkage.shape[0] + 1
+    tree = _CompactTree(linkage, hierarchical_clustering_object)
+
+    def _count(node_id):
+        return 1 if node_id < n else int(linkage[node_id - n, 3])
+
+    # Compute the prototypes of non-leaf nodes first
+    node_prototypes = [None] * (n - 1)
+    if prototypes:
+        for i in xrange(n - 1):
+            node_prototypes[i] = prototypes[i + n]
+
+    elif callable(prototyping_function) and n_processes != 1 and n > 1:
+        parallel_ans = parallel_prototypes(linkage, data.values, prototyping_function, n_processes=n_processes)
+        for i in xrange(n - 1):
+            node_prototypes[i] = parallel_ans[i + n]
+        del parallel_ans
+
+    elif callable(prototyping_function):
+        leaf_values = data.values
+
+        def _prototype(node_id):
+            return leaf_values[node_id] if node_id < n else node_prototypes[node_id - n]
+
+        for i in xrange(n - 1):
+            fi = int(linkage[i, 0])
+            fj = int(linkage[i, 1])
+            node_prototypes[i] = prototyping_function(_prototype(fi), _prototype(fj), _count(fi), _count(fj))
+
+    elif prototyping_function == 'mean':
+        node_prototypes = mean_prototypes(linkage, data.values)
+
+    tree.set_prototypes(node_prototypes)
 
     # Create a list full of None's to store the node objects
     d = [None] * (n * 2 - 1)
 
     # Create the nodes corresponding to the n original objects.
     for i in xrange(0, n):
-        index = labels[i]
-        d[i] = DTWClusterNode(id=index, hierarchical_clustering_object=hierarchical_clustering_object,
-                              prototype=values[index])
+        d[i] = DTWClusterNode(id=labels[i], hierarchical_clustering_object=hierarchical_clustering_object,
+                              prototype=None, tree=tree, position=i)
 
     nd = None
 
@@ -58,39 +411,150 @@ def _to_dtw_tree(linkage, hierarchical_clustering_object, prototypes, prototypin
         assert(fj <= i + n)
 
         id = i + n
-        left = d[fi]
-        right = d[fj]
-        dist = linkage[i, 2]
+        nd = DTWClusterNode(id=id, hierarchical_clustering_object=hierarchical_clustering_object,
+                            prototype=None,
+                            left=d[fi], right=d[fj],
+                            dist=linkage[i, 2], tree=tree, position=id)
 
-        if prototypes:
-            prototype = prototypes[id]
+        assert(linkage[i, 3] == nd.count)
+        d[n + i] = nd
 
-            nd = DTWClusterNode(id=id, hierarchical_clustering_object=hierarchical_clustering_object,
-                                prototype=prototype,
-                                left=left, right=right,
-                                dist=linkage[i, 2])
+    return nd, d
 
-        elif callable(prototyping_function):
-            prototype = prototyping_function(left.prototype.values, right.prototype.values, left.count, right.count)
+class LazyWarpingPaths(object):
+    """
+    Computes the warping paths of the nodes only when they are first needed, see `DTWClusterNode.warping_paths`.
 
-            nd = DTWClusterNode(id=id, hierarchical_clustering_object=hierarchical_clustering_object,
-                                prototype=prototype,
-                                left=left, right=right,
-                                dist=linkage[i, 2])
+    The computed paths are saved to a file per node in `directory`, so they are not computed again
+    the next time the same run is explored.
+    The directory also stores a fingerprint of the run (see `LazyWarpingPaths.fingerprint`), the cached paths
+    are discarded if they were computed for a different tree, dataset or DTW parameters.
+    """
+    FINGERPRINT_FILENAME = 'fingerprint'
 
-        elif prototyping_function == 'mean':
-            nd = DTWClusterNode(id=id, hierarchical_clustering_object=hierarchical_clustering_object,
-                                prototype=None,
-                                left=left, right=right,
-                                dist=linkage[i, 2])
+    _directory = None
+    _dtw_kwargs = None
+    _n_processes = None
+    _shared_datasets = None
+    _checked_fingerprints = None
 
-            # A bit hacky, but does job. Doing this as to get to use nd.data
-            nd._prototype = nd.data.mean()
+    def __init__(self, directory, dtw_kwargs, n_processes=None):
+        """
+        :param directory: directory to store the computed paths in. Created if it does not exist
+        :param dtw_kwargs: kwargs of DTW, the same as the ones the tree was computed with
+        :param n_processes: number of processes to compute the paths on
+        """
+        self._directory = directory
+        self._dtw_kwargs = dtw_kwargs
+        self._n_processes = n_processes
+        self._shared_datasets = {}
+        self._checked_fingerprints = set()
 
-        assert(linkage[i, 3] == nd.count)
-        d[n + i] = nd
+    @property
+    def directory(self):
+        return self._directory
 
-    return nd, d
+    def filename(self, node):
+        return os.path.join(self._directory, 'node-{0}.pickle'.format(node.id))
+
+    def fingerprint(self, hierarchical_clustering):
+        """
+        Returns the digest of the DTW parameters, the linkage matrix and the items of the clustering provided.
+        The cached paths are valid only for the clustering with the same fingerprint.
+
+        :type hierarchical_clustering: HierarchicalClustering
+        """
+        digest = hashlib.sha1(json.dumps(self._dtw_kwargs, sort_keys=True, default=repr))
+        digest.update(np.ascontiguousarray(hierarchical_clustering.linkage, dtype=float).tostring())
+        digest.update(repr(list(hierarchical_clustering.data.items)))
+        return digest.hexdigest()
+
+    def _stored_fingerprint(self):
+        try:
+            f = open(os.path.join(self._directory, self.FINGERPRINT_FILENAME))
+        except IOError:
+            return None
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+
+    def reset(self, hierarchical_clustering):
+        """
+        Removes all of the paths cached in the directory, and marks it as belonging to the clustering provided.
+
+        :type hierarchical_clustering: HierarchicalClustering
+        """
+        if os.path.isdir(self._directory):
+            for filename in os.listdir(self._directory):
+                if filename == self.FINGERPRINT_FILENAME or filename.startswith('node-'):
+                    os.remove(os.path.join(self._directory, filename))
+        else:
+            os.makedirs(self._directory)
+
+        fingerprint = self.fingerprint(hierarchical_clustering)
+        f = open(os.path.join(self._directory, self.FINGERPRINT_FILENAME), 'w')
+        try:
+            f.write(fingerprint)
+        finally:
+            f.close()
+        self._checked_fingerprints.add(id(hierarchical_clustering))
+
+    def _ensure_fingerprint_matches(self, hierarchical_clustering):
+        if id(hierarchical_clustering) in self._checked_fingerprints:
+            return
+
+        if self._stored_fingerprint() != self.fingerprint(hierarchical_clustering):
+            debug('Warping paths cached in {0!r} belong to a different run, discarding them'.format(self._directory))
+            self.reset(hierarchical_clustering)
+        self._checked_fingerprints.add(id(hierarchical_clustering))
+
+    def _shared_dataset(self, data):
+        # Copy the data to shared memory only once per dataset
+        try:
+            return self._shared_datasets[id(data)]
+        except KeyError:
+            shared_dataset = as_shared_dataset(data)
+            self._shared_datasets[id(data)] = shared_dataset
+            return shared_dataset
+
+    def paths_for(self, node, data):
+        """
+        Returns the warping paths of the items in the node to its prototype, computing them if they are not cached.
+
+        :param node: the node to compute the paths for
+        :type node: DTWClusterNode
+        :param data: the dataset the node is in
+        :return: dictionary {item: path}
+        """
+        self._ensure_fingerprint_matches(node._hierarchical_clustering_object)
+
+        filename = self.filename(node)
+        if os.path.exists(filename):
+            debug('Reading warping paths of node {0} from {1!r}'.format(node.id, filename))
+            f = open(filename, 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+
+        debug('Computing warping paths of node {0}'.format(node.id))
+        paths = parallel_dtw_paths(self._shared_dataset(data), [node], n_processes=self._n_processes,
+                                   **self._dtw_kwargs)[node.id]
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        # Write to a temporary file first, so other sessions never see a partially written file
+        handle, temporary_filename = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        f = os.fdopen(handle, 'wb')
+        try:
+            pickle.dump(paths, f, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temporary_filename, filename)
+
+        return paths
 
 def add_path_data(dtw_nodes, n, paths):
     """
@@ -117,13 +581,24 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
     _points_of_interest_histogram = None
     _warping_conservation_data = None
 
-    def __init__(self, hierarchical_clustering_object, id, prototype, left=None, right=None, dist=0, count=1):
+    _tree = None
+    _position = None
+
+    def __init__(self, hierarchical_clustering_object, id, prototype, left=None, right=None, dist=0, count=1,
+                 tree=None, position=None, index=None):
         hierarchy.ClusterNode.__init__(self, id, left=left, right=right, dist=dist, count=count)
-        if not isinstance(prototype, pd.DataFrame):
+        if prototype is not None and not isinstance(prototype, pd.DataFrame):
             prototype = pd.DataFrame(prototype, columns=hierarchical_clustering_object.data.dataset_axis)
         self._prototype = prototype
         self._hierarchical_clustering_object = hierarchical_clustering_object
-        self._index = pd.Index(self.__get_item_ids())
+
+        # Nodes that are part of a `_CompactTree` create their index and prototype on demand
+        self._tree = tree
+        self._position = position
+        if index is not None:
+            self._index = index
+        elif tree is None:
+            self._index = pd.Index(self.__get_item_ids())
 
         # Assume no points of interest. TODO: Add  way to specify those
         self._points_of_interest = {}
@@ -138,17 +613,28 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
         else:
             return self.get_left().index | self.get_right().index
 
+    @property
+    def position(self):
+        """
+        Position of the node in `HierarchicalClustering.tree_nodes_list`
+        """
+        return self._position
+
     @property
     def prototype(self):
+        if self._prototype is None and self._tree is not None:
+            self._prototype = self._tree.prototype(self._position)
         return self._prototype
 
     @property
     def index(self):
+        if self._index is None and self._tree is not None:
+            self._index = self._tree.index(self._position)
         return self._index
 
     def reindex(self, new_index):
         # Make sure they are the same elements just in different order
-        assert(len(new_index & self._index) == len(self._index) == len(new_index))
+        assert(len(new_index & self.index) == len(self.index) == len(new_index))
         self._index = new_index
         return self._index
 
@@ -171,22 +657,42 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
             self._projected_data = self.__project_items_onto_prototype()
 
     def _calculate_histogram(self, points_of_interest, number_of_bins, lengths=None):
+        """
+        Counts the number of items that have a point of interest in each of the bins.
+
+        Each point is rescaled to the range of bins it covers, `[floor(p * ratio), floor((p + 1) * ratio))`,
+        and the ranges of all the items are then accumulated at once in a difference array.
 
-        histogram = defaultdict(lambda: np.zeros(number_of_bins))
+        :param points_of_interest: dictionary `{item: {poi_name: points}}`
+        :param number_of_bins: number of bins in the histogram
+        :param lengths: lengths of the items, points are rescaled to `number_of_bins` if provided
+        :return: `pd.DataFrame` of histograms, one column per `poi_name`
+        """
+        points = defaultdict(list)
+        ratios = defaultdict(list)
         for ix, poi in points_of_interest.iteritems():
             if lengths is not None:
                 scaling_ratio = float(number_of_bins) / lengths[ix]
             else:
                 scaling_ratio = 1
 
-            for poi_name, points in poi.iteritems():
-                current_histogram = histogram[poi_name]
-                for point in set(points):
-                    min_rescaled = int(floor(point * scaling_ratio))
-                    max_rescaled = int(floor((point + 1) * scaling_ratio))
-                    for rescaled_point in xrange(min_rescaled, max_rescaled):
-                        assert rescaled_point <= number_of_bins
-                        current_histogram[rescaled_point] += 1
+            for poi_name, item_points in poi.iteritems():
+                item_points = np.unique(np.asarray(item_points))
+                points[poi_name].append(item_points)
+                ratios[poi_name].append(np.repeat(float(scaling_ratio), len(item_points)))
+
+        histogram = {}
+        for poi_name in points:
+            poi_points = np.concatenate(points[poi_name])
+            poi_ratios = np.concatenate(ratios[poi_name])
+
+            min_rescaled = np.floor(poi_points * poi_ratios).astype(int)
+            max_rescaled = np.floor((poi_points + 1) * poi_ratios).astype(int)
+            assert np.all(max_rescaled <= number_of_bins)
+
+            deltas = np.bincount(min_rescaled, minlength=number_of_bins + 1) - \
+                     np.bincount(max_rescaled, minlength=number_of_bins + 1)
+            histogram[poi_name] = np.cumsum(deltas)[:number_of_bins].astype(float)
 
         return pd.DataFrame(histogram)
 
@@ -213,7 +719,10 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
     @property
     def warping_paths(self):
         if not self._warping_paths:
-            raise Exception('Warping paths not computed')
+            lazy_warping_paths = self._hierarchical_clustering_object.lazy_warping_paths
+            if lazy_warping_paths is None:
+                raise Exception('Warping paths not computed')
+            self._warping_paths = lazy_warping_paths.paths_for(self, self._hierarchical_clustering_object.data)
 
         return self._warping_paths
 
@@ -415,36 +924,22 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
 
 
     def save_warping_conservation_data_to_file(self, filename):
-        data = self.data
-        index = data.items
         conservation_data = self.warping_conservation_data
+        index = conservation_data.index
+        values = conservation_data.values
+
+        # Conserved regions are the runs of non-zero values, 1e-6 to deal with floating-point issues
+        padded = np.zeros((values.shape[0], values.shape[1] + 2), dtype=int)
+        padded[:, 1:-1] = values >= 1e-6
+        boundaries = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(boundaries == 1)
+        _, ends = np.nonzero(boundaries == -1)
 
         f = gzip.open(filename, 'w')
         f.write('#{0}\t{1}\t{2}\t{3}\n'.format('index', 'start_bin', 'end_bin', 'conservation_coefficient'))
         try:
-            for ix in index:
-                conservation_vector = conservation_data.ix[ix]
-                start_i = None
-                current_value = None
-                for i in xrange(len(conservation_vector)):
-                    value = conservation_vector[i]
-                    if value < 1e-6:
-                        if start_i is not None: # 1e-6 to deal with floating-point issues
-                            # If were at zero, some conserved region finishes here
-                            f.write('{0}\t{1}\t{2}\t{3}\n'.format(ix, start_i, i, current_value))
-                            start_i = None
-                            current_value = None
-                        else:
-                            pass # Nothing to do here
-                    elif start_i is None:
-                        start_i = i
-                        current_value = value
-                    else:
-                        try:
-                            assert(abs(value - current_value) < 1e-6)
-                        except AssertionError:
-                            debug(value, current_value)
-                            raise
+            for row, start_i, end_i in izip(rows, starts, ends):
+                f.write('{0}\t{1}\t{2}\t{3}\n'.format(index[row], start_i, end_i, values[row, start_i]))
         finally:
             f.close()
 
@@ -460,17 +955,10 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
 
             warping_paths = self.warping_paths
 
-            columns = data.dataset_axis
-
-            projections = {}
-            for ix in data.items:
-                item = data.ix[ix]
-
-                projection = dtw_projection(item, prototype, path=warping_paths[ix])
-                df = pd.DataFrame(projection, index=range(len(prototype)), columns=columns)
-                projections[ix] = df
-            panel = pd.Panel(projections)
-            panel = panel.ix[self.data.items]
+            projections = dtw_projection_batch(data.values, prototype,
+                                               [warping_paths[ix] for ix in data.items])
+            panel = pd.Panel(projections, items=data.items, major_axis=range(len(prototype)),
+                             minor_axis=data.dataset_axis)
             ad = AlignmentsData(panel, self.data.resolution)
             return ad
 
@@ -480,10 +968,7 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
             conservation_data = [np.ones(no_nans_len(self.prototype)-1)]
         else:
             warping_paths = self.warping_paths
-            conservation_data = []
-            for ix in data.items:
-                path = warping_paths[ix]
-                conservation_data.append(warping_conservation_vector(path))
+            conservation_data = warping_conservation_vectors([warping_paths[ix] for ix in data.items])
 
         return pd.DataFrame(conservation_data, index=self.index)
 
@@ -505,11 +990,15 @@ class DTWClusterNode(object, hierarchy.ClusterNode):
         else:
             points_of_interest = self.points_of_interest
             warping_paths = self.warping_paths
+
+            # Map the points of all the items at once
+            keys = [(ix, j) for ix, pois in points_of_interest.iteritems() for j in pois]
+            mapped_points = transformations.points_mapped_to_batch([points_of_interest[ix][j] for ix, j in keys],
+                                                                   [warping_paths[ix] for ix, _ in keys])
+
             tracked_points = defaultdict(lambda: {})
-            for ix, pois in points_of_interest.iteritems():
-                for j, poi in pois.iteritems():
-                    mapped_points = transformations.points_mapped_to(poi, warping_paths[ix])
-                    tracked_points[ix][j] = mapped_points
+            for (ix, j), points in izip(keys, mapped_points):
+                tracked_points[ix][j] = points
 
             return tracked_points
 
@@ -625,12 +1114,16 @@ class HierarchicalClustering(object):
     __dtw_args = None
     __dtw_kwargs = None
     _regions = None
+    _lazy_warping_paths = None
 
     __tree = None
     __tree_nodes_list = None
+    _compact_tree = None
+    _max_distances = None
 
 
-    def __init__(self, data, regions, linkage_matrix, dtw_function=dtw_std, prototypes=None, prototyping_method='psa'):
+    def __init__(self, data, regions, linkage_matrix, dtw_function=dtw_std, prototypes=None, prototyping_method='psa',
+                 n_processes=1):
         """
         Initialises hierarchical clustering analyser.
         Handles linkage calculation, dendrogram plotting and prototype generation.
@@ -659,6 +1152,7 @@ class HierarchicalClustering(object):
         :param dtw_function: DTW calculation function
         :param prototypes: cluster node prototypes (will be computed if None)
         :param prototyping_method: Averaging method either 'psa', 'standard', 'standard-unweighted', 'mean'
+        :param n_processes: number of processes to compute the prototypes on. Set to None to use all CPU cores.
         :return:
         """
         if not isinstance(data, AlignmentsData):
@@ -674,9 +1168,10 @@ class HierarchicalClustering(object):
 
         self.__dtw_function = dtw_function
 
-        tree, tree_nodes = self.__dtw_tree_from_linkage(linkage_matrix, prototypes, prototyping_method)
+        tree, tree_nodes = self.__dtw_tree_from_linkage(linkage_matrix, prototypes, prototyping_method, n_processes)
         self.__tree = tree
         self.__tree_nodes_list = tree_nodes
+        self._compact_tree = tree._tree
 
     def extract_prototypes(self):
         prototypes = {}
@@ -686,12 +1181,13 @@ class HierarchicalClustering(object):
 
         return prototypes
 
-    def __dtw_tree_from_linkage(self, linkage, prototypes,  method):
+    def __dtw_tree_from_linkage(self, linkage, prototypes,  method, n_processes=1):
         """
         Computes a prototyped tree from linkage matrix
         :param linkage: linkage matrix
         :param prototypes: possibly precomputed prototypes
         :param method: prototyping method
+        :param n_processes: number of processes to compute the prototypes on
         :return:
         """
 
@@ -712,7 +1208,7 @@ class HierarchicalClustering(object):
             raise ValueError('Incorrect method supplied: '
                              'only \'psa\', \'standard\' or \'standard-unweighted\' supported')
 
-        return _to_dtw_tree(linkage, self, prototypes, averaging_func)
+        return _to_dtw_tree(linkage, self, prototypes, averaging_func, n_processes=n_processes)
 
     @property
     def data(self):
@@ -730,6 +1226,17 @@ class HierarchicalClustering(object):
     def dtw_function(self):
         return self.__dtw_function
 
+    @property
+    def lazy_warping_paths(self):
+        """
+        `LazyWarpingPaths` object that computes the warping paths of the nodes that do not have them set, or None
+        """
+        return self._lazy_warping_paths
+
+    @lazy_warping_paths.setter
+    def lazy_warping_paths(self, value):
+        self._lazy_warping_paths = value
+
     @property
     def condensed_distance_matrix(self):
         return self._condensed_distance_matrix
@@ -761,13 +1268,42 @@ class HierarchicalClustering(object):
         if n_clusters == 1:
             return np.inf
         else:
-            max_distances = np.empty(self.num_obs, dtype=np.double)
-            get_max_dist_for_each_cluster(linkage, max_distances, n)
+            if self._max_distances is None:
+                max_distances = np.empty(self.num_obs, dtype=np.double)
+                get_max_dist_for_each_cluster(linkage, max_distances, n)
+                self._max_distances = max_distances
 
-            threshold = max_distances[-n_clusters]
+            threshold = self._max_distances[-n_clusters]
 
             return threshold
 
+    def flat_clusters(self, thresholds=None, n_clusters=None):
+        """
+        Returns the cluster assignments of the items for many cuts of the dendrogram at once.
+        Either `thresholds` or `n_clusters` should be provided.
+
+        The clusters in each of the cuts are numbered from 1 in the order they appear on the dendrogram.
+
+        :param thresholds: list of distance thresholds to cut the dendrogram at, see `HierarchicalClustering.cut`
+        :param n_clusters: list of numbers of clusters to form, see `distance_threshold_for_n_clusters`
+        :return: `pd.DataFrame` indexed by the data items, with a column of cluster numbers for each of the cuts
+        """
+        if (thresholds is None) == (n_clusters is None):
+            raise ValueError('Provide either thresholds or n_clusters')
+
+        if thresholds is not None:
+            columns = list(thresholds)
+        else:
+            columns = list(n_clusters)
+            thresholds = [self.distance_threshold_for_n_clusters(k) for k in columns]
+
+        tree = self._compact_tree
+        assignments = {}
+        for column, t in izip(columns, thresholds):
+            assignments[column] = tree.cluster_labels(tree.cluster_roots(t))
+
+        return pd.DataFrame(assignments, index=self.data.items, columns=columns)
+
     @property
     def num_obs(self):
         return self.data.number_of_items
@@ -833,18 +1369,9 @@ class HierarchicalClustering(object):
         """
 
         self._distance_threshold = t
-        root = self.as_tree()
 
-        queue = set([root])
-
-        clusters = set()
-        while queue:
-            current_node = queue.pop()
-            if current_node.dist >= t:
-                queue.add(current_node.get_right())
-                queue.add(current_node.get_left())
-            else:
-                clusters.add(current_node)
+        tree_nodes_list = self.tree_nodes_list
+        clusters = [tree_nodes_list[position] for position in self._compact_tree.cluster_roots(t)]
         return ClusterAssignments(self, clusters, t)
 
     def cut_and_resort(self, cut_threshold, index):
@@ -856,16 +1383,18 @@ class HierarchicalClustering(object):
         """
         cluster_assignments = self.cut(cut_threshold)
 
+        index = pd.Index(index)
+        positions = self.data.items.get_indexer(index)
+        if np.any(positions < 0):
+            raise ValueError('Index contains items that are not in the data')
 
-        already_asigned_indices = pd.Index([])
-        for cluster in cluster_assignments:
-            cluster_index = cluster.index
-            sub_index = pd.Index([i for i in index if i in cluster_index])
-            cluster.reindex(sub_index)
+        # Group the index by cluster, keeping the order within each of the clusters
+        labels = cluster_assignments.flatten().values[positions]
+        order = np.argsort(labels, kind='mergesort')
+        boundaries = np.searchsorted(labels[order], np.arange(1, len(cluster_assignments) + 2))
 
-            if len(already_asigned_indices & sub_index):
-                raise Exception("There is some overlap between cluster cuts. There shouldn't be")
-            already_asigned_indices =  (already_asigned_indices | sub_index)
+        for i, cluster in enumerate(cluster_assignments):
+            cluster.reindex(index[order[boundaries[i]:boundaries[i + 1]]])
 
         return cluster_assignments
 
@@ -926,26 +1455,16 @@ class ClusterAssignments(object):
         Flattens the data into a `pd.Series` object that gives a cluster number to every element in original data.
         :return:
         """
-        buffer = np.empty(self._hierarchical_clustering_object.num_obs)
-
-        for i, cluster in enumerate(self.clusters):
-            queue = set([cluster.root])
-
-            while queue:
-                node = queue.pop()
-
-                if node.is_leaf():
-                    buffer[node.id] = i + 1
-                else:
-                    queue.add(node.get_left())
-                    queue.add(node.get_right())
+        hierarchical_clustering_object = self.hierarchical_clustering_object
+        labels = hierarchical_clustering_object._compact_tree.cluster_labels([cluster.position
+                                                                             for cluster in self.clusters])
 
-        return pd.Series(buffer, index=self.hierarchical_clustering_object.data.index)
+        return pd.Series(labels, index=hierarchical_clustering_object.data.items)
 
     @property
     def clusters(self):
         """
-        Returns the data clusters in decreasing number of elements
+        Returns the data clusters in the order they appear on the dendrogram
         :return:
         """
         return self._clusters
@@ -0,0 +1,136 @@
+"""
+Assignment of new regions to the clusters of an existing clustering, without clustering them again.
+"""
+from functools import partial
+from logging import debug
+import numpy as np
+import pandas as pd
+
+from ..dtw.distance import dtw_std
+from ..dtw.lower_bounds import dtw_lower_bounds, bounding_boxes
+from ..dtw.parallel import WorkerPool
+from ..dtw.shared import SharedDataset, as_shared_dataset
+
+__all__ = ['assign_to_prototypes', 'assign_to_clusters']
+
+def _assignment_worker(dataset, prototypes, boxes, compute_paths, dtw_kwargs, indices):
+    """
+    Finds the closest prototype for each of the sequences in the dataset at the indices provided.
+
+    The prototypes are tried in the increasing order of the lower bounds of their distances,
+    and the search is abandoned as soon as the next lower bound is above the best distance found.
+    """
+    results = []
+    for i in indices:
+        sequence = dataset[i]
+        bounds = dtw_lower_bounds(sequence, prototypes, boxes, **dtw_kwargs)
+        order = np.argsort(bounds, kind='mergesort')
+
+        best = None
+        best_distance = np.inf
+        n_computed = 0
+        for candidate in order:
+            if bounds[candidate] > best_distance:
+                break
+
+            distance = dtw_std(sequence, prototypes[candidate], dist_only=True, **dtw_kwargs)
+            n_computed += 1
+            # Resolve the ties the same way as np.argmin over all of the distances would
+            if distance < best_distance or (distance == best_distance and candidate < best):
+                best = candidate
+                best_distance = distance
+
+        if best is None:
+            # None of the distances were finite
+            best = order[0]
+
+        if compute_paths:
+            distance, _, path = dtw_std(sequence, prototypes[best], dist_only=False, **dtw_kwargs)
+        else:
+            distance, path = best_distance, None
+        results.append((i, best, distance, path, n_computed))
+
+    return results
+
+def assign_to_prototypes(data, prototypes, n_processes=None, compute_paths=True, **dtw_kwargs):
+    """
+    Assigns each of the items in the data to the prototype it is closest to in terms of DTW distance.
+
+    Lower bounds of the distances (see `dgw.dtw.lower_bounds.dtw_lower_bounds`) are used to avoid computing DTW
+    for the prototypes that cannot be the closest ones.
+
+    :param data: `AlignmentsData` of the items to assign, or `SharedDataset` created from it
+    :param prototypes: list of prototypes to assign the items to
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param compute_paths: if set to false, the warping paths are not computed and `None` is returned instead of them
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: `pd.DataFrame` indexed by the items, with the position of the closest prototype in `prototypes`
+             (column `prototype`), the distance to it (`distance`) and the number of DTW distances computed
+             to find it (`n_dtw_computed`), and a dictionary `{item: path}` of the warping paths
+             between the items and the prototypes they are assigned to
+    """
+    dataset = as_shared_dataset(data)
+    items = dataset.items
+    if items is None:
+        items = range(len(dataset))
+
+    prototypes = SharedDataset.from_sequences(prototypes)
+
+    worker = partial(_assignment_worker, dataset, prototypes, bounding_boxes(prototypes), compute_paths, dtw_kwargs)
+    pool = WorkerPool(worker, n_processes=n_processes)
+
+    # Keep the chunks small enough for the results to be sent back without too much memory overhead
+    chunk_size = max(1, min(1000, len(dataset) / (pool.n_processes * 4)))
+    chunks = [np.arange(start, min(start + chunk_size, len(dataset)))
+              for start in xrange(0, len(dataset), chunk_size)]
+
+    assigned_prototypes = np.empty(len(dataset), dtype=int)
+    distances = np.empty(len(dataset))
+    n_computed = np.empty(len(dataset), dtype=int)
+    paths = {} if compute_paths else None
+
+    with pool:
+        for chunk_results in pool.map(chunks):
+            for i, best, distance, path, n_dtw_computed in chunk_results:
+                assigned_prototypes[i] = best
+                distances[i] = distance
+                n_computed[i] = n_dtw_computed
+                if compute_paths:
+                    paths[items[i]] = path
+
+    debug('Computed {0} DTW distances to assign {1} items to {2} prototypes'.format(n_computed.sum(), len(dataset),
+                                                                                 len(prototypes)))
+
+    assignments = pd.DataFrame({'prototype': assigned_prototypes, 'distance': distances,
+                                'n_dtw_computed': n_computed},
+                               index=items, columns=['prototype', 'distance', 'n_dtw_computed'])
+    return assignments, paths
+
+def assign_to_clusters(hierarchical_clustering_object, data, t, n_processes=None, **dtw_kwargs):
+    """
+    Assigns each of the items in the data to the cluster whose prototype it is closest to,
+    when the dendrogram of an existing clustering is cut at threshold `t`.
+
+    The clusters are numbered from 1 in the order they appear on the dendrogram,
+    the same as in `HierarchicalClustering.flat_clusters`.
+
+    :param hierarchical_clustering_object: the existing clustering
+    :type hierarchical_clustering_object: `dgw.cluster.analysis.HierarchicalClustering`
+    :param data: `AlignmentsData` of the items to assign, processed the same way as the data of the clustering
+    :param t: threshold to cut the dendrogram at, see `HierarchicalClustering.cut`
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param dtw_kwargs: kwargs to pass to dtw, should be the same as the ones the clustering was made with,
+                       e.g. `Configuration.dtw_kwargs`
+    :return: `pd.DataFrame` indexed by the items, with the number of the cluster (column `cluster`),
+             the distance to its prototype (`distance`) and the number of DTW distances computed (`n_dtw_computed`),
+             and a dictionary `{item: path}` of the warping paths between the items and the prototypes of their
+             clusters
+    """
+    clusters = hierarchical_clustering_object.cut(t)
+    prototypes = [cluster.prototype.values for cluster in clusters]
+
+    assignments, paths = assign_to_prototypes(data, prototypes, n_processes=n_processes, **dtw_kwargs)
+
+    assignments['prototype'] += 1
+    assignments = assignments.rename(columns={'prototype': 'cluster'})
+    return assignments, paths
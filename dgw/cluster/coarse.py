@@ -0,0 +1,156 @@
+"""
+Two-stage, coarse-to-fine, hierarchical clustering.
+
+The regions are clustered at a coarser resolution first, where DTW is much cheaper,
+and the exact distances are computed only between the regions that end up in the same group of the coarse dendrogram.
+"""
+from logging import debug
+import fastcluster
+import numpy as np
+
+from ..dtw.parallel import parallel_pdist, parallel_pdist_groups
+from ..dtw.shared import SharedDataset, as_shared_dataset
+
+__all__ = ['coarsen', 'coarse_to_fine_linkage']
+
+def coarsen(data, factor):
+    """
+    Reduces the resolution of the data by taking the mean of each `factor` consecutive bins of the sequences.
+    The last bin of a sequence is the mean of the bins that remain, if its length is not divisible by the factor.
+
+    :param data: `AlignmentsData` or `SharedDataset` created from it
+    :param factor: number of bins to merge into one
+    :rtype: SharedDataset
+    """
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError('Factor should be at least 1, got {0}'.format(factor))
+
+    dataset = as_shared_dataset(data)
+    lengths = dataset.lengths
+    coarse_lengths = (lengths + factor - 1) // factor
+    coarse = SharedDataset.allocate(coarse_lengths, dataset.ndim, items=dataset.items)
+    if len(coarse.values) == 0:
+        return coarse
+
+    # Position of each coarse bin in the sequence it belongs to
+    item_of_bin = np.repeat(np.arange(len(dataset)), coarse_lengths)
+    position = np.arange(len(coarse.values)) - coarse.offsets[item_of_bin]
+
+    sums = np.add.reduceat(dataset.values, dataset.offsets[item_of_bin] + position * factor, axis=0)
+    counts = np.minimum(factor, lengths[item_of_bin] - position * factor)
+    coarse.values[:] = sums / counts[:, np.newaxis]
+
+    return coarse
+
+def _leaves(linkage, n, node):
+    leaves = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node < n:
+            leaves.append(node)
+        else:
+            row = linkage[node - n]
+            stack.append(int(row[1]))
+            stack.append(int(row[0]))
+    return leaves
+
+def _split_into_groups(linkage, n, max_group_size):
+    """
+    Splits the dendrogram from the top into the largest subtrees that have at most `max_group_size` leaves.
+
+    :return: list of the roots of the subtrees, and set of the nodes above them
+    """
+    groups = []
+    split_nodes = set()
+    stack = [2 * n - 2]
+    while stack:
+        node = stack.pop()
+        if node < n or linkage[node - n, 3] <= max_group_size:
+            groups.append(node)
+        else:
+            split_nodes.add(node)
+            stack.append(int(linkage[node - n, 1]))
+            stack.append(int(linkage[node - n, 0]))
+
+    return groups, split_nodes
+
+def coarse_to_fine_linkage(data, factor, max_group_size, n_processes=None, **dtw_kwargs):
+    """
+    Computes complete linkage clustering of the data in two stages:
+
+        1. The data is coarsened by `factor` (see `coarsen`) and clustered using the pairwise distances at that resolution.
+        2. The coarse dendrogram is split from the top into the largest groups that have at most `max_group_size` items.
+           The exact pairwise distances are computed within each group, and each group is clustered on them.
+
+    The dendrograms of the groups are then joined by the nodes of the coarse dendrogram that are above the groups.
+    The distances of these nodes come from the coarse stage, and are raised, where needed, to the distances of
+    the nodes below them, so the dendrogram stays monotonic.
+    The coarse and exact distances are only comparable when they are normalised by the lengths of the sequences
+    (`normalise=True`), as the raw DTW costs of the coarsened sequences are on a smaller scale.
+
+    :param data: `AlignmentsData` or `SharedDataset` created from it
+    :param factor: number of bins to merge into one at the coarse stage
+    :param max_group_size: maximum number of items in a group to compute the exact distances for
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: linkage matrix, in the same format as the one returned by `fastcluster`
+    """
+    dataset = as_shared_dataset(data)
+    n = len(dataset)
+    if n < 2:
+        return np.empty((0, 4))
+
+    coarse_linkage = fastcluster.complete(parallel_pdist(coarsen(dataset, factor), n_processes, **dtw_kwargs))
+    groups, split_nodes = _split_into_groups(coarse_linkage, n, max(int(max_group_size), 1))
+    debug('Split the coarse dendrogram of {0} items into {1} groups'.format(n, len(groups)))
+
+    # Merges of the final dendrogram as (left, right, distance, count), the ids of the merges start from n
+    merges = []
+    heights = np.zeros(2 * n - 1)
+    counts = np.ones(2 * n - 1)
+    final_ids = {}
+
+    def merge(left, right, distance):
+        node = n + len(merges)
+        heights[node] = max(distance, heights[left], heights[right])
+        counts[node] = counts[left] + counts[right]
+        merges.append((left, right, heights[node], counts[node]))
+        return node
+
+    # The exact distances of all the groups are computed at once, so the small groups are processed in parallel
+    fine_groups = [group for group in groups if group >= n]
+    group_items = dict([(group, _leaves(coarse_linkage, n, group)) for group in fine_groups])
+    group_distances = parallel_pdist_groups(dataset, [group_items[group] for group in fine_groups],
+                                            n_processes, **dtw_kwargs)
+
+    for group in groups:
+        if group < n:
+            final_ids[group] = group
+
+    for group, distances in zip(fine_groups, group_distances):
+        group_linkage = fastcluster.complete(distances)
+
+        ids = list(group_items[group])
+        for left, right, distance, _ in group_linkage:
+            ids.append(merge(ids[int(left)], ids[int(right)], distance))
+        final_ids[group] = ids[-1]
+
+    for row, (left, right, distance, _) in enumerate(coarse_linkage):
+        node = n + row
+        if node in split_nodes:
+            final_ids[node] = merge(final_ids[int(left)], final_ids[int(right)], distance)
+
+    # Sort the merges by distance, as fastcluster does. Children never come after their parents, as their distances
+    # are not larger and they were merged first.
+    merges = np.array(merges)
+    order = np.argsort(merges[:, 2], kind='mergesort')
+    new_ids = np.arange(2 * n - 1)
+    new_ids[n + order] = np.arange(n, 2 * n - 1)
+
+    linkage = merges[order]
+    children = new_ids[linkage[:, :2].astype(int)]
+    linkage[:, 0] = children.min(axis=1)
+    linkage[:, 1] = children.max(axis=1)
+    return linkage
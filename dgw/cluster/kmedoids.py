@@ -0,0 +1,285 @@
+"""
+k-medoids clustering under DTW, for the sets of regions that are too large for hierarchical clustering.
+
+The medoids are found using CLARA: PAM is run on the pairwise distances of small random samples of the regions,
+and the medoids of the sample that assign all of the regions with the lowest total distance are kept.
+Only the distances within the samples and the distances from the regions to the medoids are computed,
+the latter are pruned using lower bounds (see `dgw.cluster.assignment.assign_to_prototypes`).
+"""
+from logging import debug
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import squareform
+
+from .analysis import DTWClusterNode
+from .assignment import assign_to_prototypes
+from ..dtw.distance import parametrised_dtw_wrapper
+from ..dtw.parallel import parallel_pdist
+from ..dtw.shared import SharedDataset, as_shared_dataset
+
+__all__ = ['pam', 'clara', 'KMedoidsCluster', 'KMedoidsClustering']
+
+def _pam_build(distance_matrix, k):
+    """
+    Greedily selects k initial medoids, each one reducing the total distance the most.
+    """
+    medoids = [int(np.argmin(distance_matrix.sum(axis=0)))]
+    nearest = distance_matrix[:, medoids[0]].copy()
+    for _ in xrange(1, k):
+        gains = np.maximum(nearest[:, np.newaxis] - distance_matrix, 0).sum(axis=0)
+        gains[medoids] = -1
+        medoid = int(np.argmax(gains))
+        medoids.append(medoid)
+        nearest = np.minimum(nearest, distance_matrix[:, medoid])
+    return medoids
+
+def pam(distance_matrix, k, max_iterations=100):
+    """
+    Partitioning Around Medoids: finds the k items that minimise the total distance of all of the items
+    to the medoid closest to them.
+
+    :param distance_matrix: square `[n x n]` matrix of distances
+    :param k: number of medoids
+    :param max_iterations: maximum number of swaps of the medoids to make
+    :return: sorted list of the positions of the medoids in the matrix, and the total distance to them
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    n = len(distance_matrix)
+    if not 0 < k <= n:
+        raise ValueError('Number of medoids should be between 1 and {0}, got {1}'.format(n, k))
+
+    medoids = _pam_build(distance_matrix, k)
+    for iteration in xrange(max_iterations):
+        medoid_distances = distance_matrix[:, medoids]
+        order = np.argsort(medoid_distances, axis=1, kind='mergesort')
+        closest = order[:, 0]
+        nearest = medoid_distances[np.arange(n), closest]
+        if k > 1:
+            second_nearest = medoid_distances[np.arange(n), order[:, 1]]
+        else:
+            second_nearest = np.repeat(np.inf, n)
+        cost = nearest.sum()
+
+        # Total distance after replacing the i-th medoid with each of the items
+        best_swap = None
+        best_cost = cost
+        for i in xrange(k):
+            without_medoid = np.where(closest == i, second_nearest, nearest)
+            swap_costs = np.minimum(without_medoid[:, np.newaxis], distance_matrix).sum(axis=0)
+            swap_costs[medoids] = np.inf
+            candidate = int(np.argmin(swap_costs))
+            if swap_costs[candidate] < best_cost:
+                best_swap = i, candidate
+                best_cost = swap_costs[candidate]
+
+        if best_swap is None or not best_cost < cost * (1 - 1e-12):
+            break
+
+        i, candidate = best_swap
+        medoids[i] = candidate
+        debug('PAM iteration {0}: total distance {1}'.format(iteration, best_cost))
+
+    medoids = sorted(medoids)
+    cost = distance_matrix[:, medoids].min(axis=1).sum()
+    return medoids, cost
+
+def clara(data, k, n_samples=5, sample_size=None, max_iterations=100, n_processes=None, random_state=None,
+          **dtw_kwargs):
+    """
+    Clustering LARge Applications: finds k medoids of the data by running PAM on random samples of it.
+
+    Each sample contains the best medoids found so far, and the medoids of each sample are evaluated by
+    assigning all of the items in the data to them.
+
+    :param data: `AlignmentsData` or `SharedDataset` created from it
+    :param k: number of medoids
+    :param n_samples: number of samples to run PAM on
+    :param sample_size: number of items in each sample, defaults to `40 + 2k`
+    :param max_iterations: maximum number of iterations of PAM
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param random_state: seed of the random number generator used to draw the samples
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: sorted array of the positions of the medoids in the data,
+             and `pd.DataFrame` of the assignments of the items to them (see `assign_to_prototypes`)
+    """
+    dataset = as_shared_dataset(data)
+    n = len(dataset)
+    if not 0 < k <= n:
+        raise ValueError('Number of medoids should be between 1 and {0}, got {1}'.format(n, k))
+
+    if sample_size is None:
+        sample_size = 40 + 2 * k
+    sample_size = min(max(sample_size, k), n)
+
+    random = np.random.RandomState(random_state)
+
+    best_medoids = None
+    best_assignments = None
+    best_cost = np.inf
+    for sample_number in xrange(n_samples):
+        if best_medoids is None:
+            sample = random.choice(n, sample_size, replace=False)
+        else:
+            others = np.setdiff1d(np.arange(n), best_medoids)
+            sample = np.concatenate((best_medoids, random.choice(others, sample_size - k, replace=False)))
+        sample = np.sort(sample)
+
+        sample_dataset = SharedDataset.from_sequences([dataset[i] for i in sample])
+        distance_matrix = squareform(parallel_pdist(sample_dataset, n_processes, **dtw_kwargs))
+        sample_medoids, _ = pam(distance_matrix, k, max_iterations=max_iterations)
+        medoids = sample[sample_medoids]
+
+        assignments, _ = assign_to_prototypes(dataset, [dataset[i] for i in medoids], n_processes=n_processes,
+                                              compute_paths=False, **dtw_kwargs)
+        cost = assignments['distance'].sum()
+        debug('CLARA sample {0}: total distance {1}'.format(sample_number, cost))
+
+        if cost < best_cost or best_medoids is None:
+            best_medoids, best_assignments, best_cost = medoids, assignments, cost
+
+        if sample_size == n:
+            # All of the data is in the sample, other samples would be the same
+            break
+
+    return best_medoids, best_assignments
+
+class KMedoidsCluster(DTWClusterNode):
+    """
+    A cluster of `KMedoidsClustering`, with the medoid as its prototype.
+    Provides the same interface as the clusters of `dgw.cluster.analysis.ClusterAssignments`.
+    """
+    _medoid = None
+
+    def __init__(self, kmedoids_clustering_object, id, medoid, prototype, index):
+        DTWClusterNode.__init__(self, kmedoids_clustering_object, id, prototype, count=len(index), index=index)
+        self._medoid = medoid
+
+    def is_leaf(self):
+        # The cluster has no children, but its items are aligned to the medoid just like the items of
+        # the inner nodes of a tree are aligned to their prototypes, so the projections use the warping paths
+        return False
+
+    @property
+    def medoid(self):
+        """
+        The item that is the prototype of the cluster
+        """
+        return self._medoid
+
+class KMedoidsClustering(object):
+    """
+    k-medoids clustering of the data under DTW, see `clara`.
+
+    The object provides the same interface as `dgw.cluster.analysis.ClusterAssignments`,
+    and the warping paths of the items to the medoids of their clusters are computed for all of the clusters.
+    """
+    _data = None
+    _regions = None
+    _dtw_kwargs = None
+    _assignments = None
+    _clusters = None
+
+    def __init__(self, data, regions, k, n_samples=5, sample_size=None, n_processes=None, random_state=None,
+                 **dtw_kwargs):
+        """
+        Clusters the data into `k` clusters.
+
+        :param data: the data to cluster
+        :type data: `AlignmentsData`
+        :param regions: regions of the data, if available
+        :param k: number of clusters
+        :param n_samples: number of samples to run PAM on, see `clara`
+        :param sample_size: number of items in each sample, see `clara`
+        :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+        :param random_state: seed of the random number generator used to draw the samples
+        :param dtw_kwargs: kwargs to pass to dtw, e.g. `Configuration.dtw_kwargs`
+        """
+        self._data = data
+        self._regions = regions
+        self._dtw_kwargs = dtw_kwargs
+
+        dataset = as_shared_dataset(data)
+        medoids, _ = clara(dataset, k, n_samples=n_samples, sample_size=sample_size, n_processes=n_processes,
+                           random_state=random_state, **dtw_kwargs)
+
+        # Assign the items again, this time computing the warping paths to the medoids
+        assignments, paths = assign_to_prototypes(dataset, [dataset[i] for i in medoids], n_processes=n_processes,
+                                                  **dtw_kwargs)
+
+        items = data.items
+        clusters = []
+        for cluster_number, medoid in enumerate(medoids):
+            index = items[(assignments['prototype'] == cluster_number).values]
+            cluster = KMedoidsCluster(self, cluster_number, items[medoid], np.array(dataset[medoid]), index)
+            cluster.warping_paths = dict([(item, paths[item]) for item in index])
+            clusters.append(cluster)
+
+        assignments['prototype'] += 1
+        self._assignments = assignments.rename(columns={'prototype': 'cluster'})
+        self._clusters = clusters
+
+    @property
+    def data(self):
+        """
+        :rtype: AlignmentsData
+        """
+        return self._data
+
+    @property
+    def regions(self):
+        return self._regions
+
+    @property
+    def dtw_function(self):
+        return parametrised_dtw_wrapper(**self._dtw_kwargs)
+
+    @property
+    def lazy_warping_paths(self):
+        # All of the warping paths are computed when clustering
+        return None
+
+    @property
+    def dataset_names(self):
+        return self.data.dataset_axis
+
+    @property
+    def assignments(self):
+        """
+        `pd.DataFrame` of the cluster numbers of the items (column `cluster`), the distances to the medoids
+        of the clusters (`distance`), and the number of DTW distances computed to assign them (`n_dtw_computed`)
+        """
+        return self._assignments
+
+    @property
+    def medoids(self):
+        return pd.Index([cluster.medoid for cluster in self.clusters])
+
+    @property
+    def n(self):
+        return len(self._clusters)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def cluster_sizes(self):
+        return pd.Series(map(len, self.clusters))
+
+    def flatten(self):
+        """
+        Flattens the data into a `pd.Series` object that gives a cluster number to every element in original data.
+        """
+        return self._assignments['cluster'].copy()
+
+    @property
+    def clusters(self):
+        return self._clusters
+
+    def __iter__(self):
+        return iter(self.clusters)
+
+    def __getitem__(self, key):
+        return self.clusters[key]
+
+    def __repr__(self):
+        return '<{0} n={1}>'.format(self.__class__.__name__, self.n)
@@ -0,0 +1,191 @@
+"""
+Memory-efficient hierarchical clustering of condensed distance matrices.
+
+`fastcluster` needs a working copy of the condensed distance matrix next to the matrix itself.
+The nearest-neighbour chain algorithm implemented here updates the distances in the matrix it is given instead,
+so the matrix can be clustered in place, converted to `float32` first, or memory-mapped from disk.
+"""
+from logging import debug
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from ..dtw.parallel import _items_count, _condensed_row_start
+
+__all__ = ['nn_chain_linkage']
+
+# Smallest number of columns worth handing to a separate thread
+MIN_BLOCK_SIZE = 1024
+
+_UPDATE_FUNCTIONS = {
+    'complete': lambda a, b, size_a, size_b: np.maximum(a, b),
+    'average': lambda a, b, size_a, size_b: (a * size_a + b * size_b) / (size_a + size_b),
+}
+
+class _CondensedMatrix(object):
+    """
+    Row access to the condensed distance matrix, split into blocks of columns that are processed in parallel.
+    """
+    def __init__(self, distances, n, n_threads):
+        self.distances = distances
+        self.n = n
+        # Distance between i < j is at distances[row_starts[i] + j]
+        i = np.arange(n, dtype=np.int64)
+        self.row_starts = _condensed_row_start(i, n) - i - 1
+        self.active = np.ones(n, dtype=bool)
+
+        n_blocks = max(1, min(n_threads, n // MIN_BLOCK_SIZE))
+        self.blocks = [(block[0], block[-1] + 1) for block in np.array_split(np.arange(n), n_blocks) if len(block)]
+        self.pool = ThreadPool(n_blocks) if n_blocks > 1 else None
+
+    def _map(self, function):
+        if self.pool is None:
+            return [function(block) for block in self.blocks]
+        return self.pool.map(function, self.blocks)
+
+    def _positions(self, i, start, end):
+        """
+        Positions of the distances between i and the items in [start, end) in the condensed matrix, split in two:
+        the items before i (scattered through the matrix) and the items after i (contiguous).
+        """
+        before = self.row_starts[start:min(end, i)] + i
+        after = slice(self.row_starts[i] + max(start, i + 1), self.row_starts[i] + max(end, i + 1))
+        return before, after
+
+    def _row_block(self, i, start, end):
+        before, after = self._positions(i, start, end)
+        row = np.empty(end - start)
+        row[:len(before)] = self.distances[before]
+        row[end - start - (after.stop - after.start):] = self.distances[after]
+        if start <= i < end:
+            row[i - start] = np.inf
+        row[~self.active[start:end]] = np.inf
+        return row
+
+    def nearest(self, i, previous=None):
+        """
+        Returns the active item nearest to i. Ties are resolved in favour of `previous`.
+        """
+        def _block_nearest(block):
+            row = self._row_block(i, *block)
+            position = np.argmin(row)
+            return row[position], block[0] + position
+
+        distance, nearest = min(self._map(_block_nearest))
+        if previous is not None and self.distance(i, previous) <= distance:
+            nearest = previous
+        return nearest
+
+    def distance(self, i, j):
+        i, j = min(i, j), max(i, j)
+        return self.distances[self.row_starts[i] + j]
+
+    def update(self, a, b, new_distance_function):
+        """
+        Stores the distances of the cluster made by merging a and b in the row of b, and deactivates a.
+        """
+        self.active[a] = False
+
+        def _block_update(block):
+            row_a = self._row_block(a, *block)
+            row_b = self._row_block(b, *block)
+            row = new_distance_function(row_a, row_b)
+
+            before, after = self._positions(b, *block)
+            self.distances[before] = row[:len(before)]
+            self.distances[after] = row[len(row) - (after.stop - after.start):]
+
+        self._map(_block_update)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def _sort_and_label(merges, n):
+    """
+    Sorts the merges found by the nearest-neighbour chain by their distances,
+    and relabels the clusters in the same way as `fastcluster` does.
+    """
+    merges = sorted(merges, key=lambda merge: merge[2])
+    parent = range(n)
+    labels = range(n)
+    sizes = [1] * n
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    linkage = np.empty((n - 1, 4))
+    for row, (a, b, distance) in enumerate(merges):
+        a, b = find(a), find(b)
+        linkage[row] = [min(labels[a], labels[b]), max(labels[a], labels[b]), distance, sizes[a] + sizes[b]]
+        parent[a] = b
+        labels[b] = n + row
+        sizes[b] += sizes[a]
+
+    return linkage
+
+def nn_chain_linkage(condensed_distances, method='complete', copy=True, dtype=None, n_threads=1):
+    """
+    Computes the hierarchical clustering of the condensed distance matrix provided using the nearest-neighbour
+    chain algorithm.
+
+    The result is in the same format as the linkage returned by `fastcluster`.
+
+    :param condensed_distances: condensed distance matrix, e.g. memory-mapped using `np.load(..., mmap_mode='r')`
+    :param method: `complete` or `average`
+    :param copy: if set to false, the distances are updated in place, and the matrix provided is overwritten.
+                 This avoids keeping another copy of the matrix in memory,
+                 and allows clustering a matrix memory-mapped with `mode='r+'` without reading all of it into memory.
+    :param dtype: dtype to compute the linkage in, e.g. `np.float32` to halve the memory needed.
+                  A copy of the distances is always made if it is different from the dtype of the matrix
+    :param n_threads: number of threads to search the rows of the matrix and update them with
+    :return: linkage matrix
+    """
+    try:
+        new_distance_function = _UPDATE_FUNCTIONS[method]
+    except KeyError:
+        raise ValueError('Unsupported linkage method {0!r}, '
+                         'only {1} supported'.format(method, ', '.join(sorted(_UPDATE_FUNCTIONS))))
+
+    n = _items_count(condensed_distances)
+    if dtype is None:
+        dtype = condensed_distances.dtype
+
+    if copy or np.dtype(dtype) != condensed_distances.dtype:
+        distances = np.array(condensed_distances, dtype=dtype)
+    else:
+        distances = condensed_distances
+
+    matrix = _CondensedMatrix(distances, n, n_threads)
+    sizes = np.ones(n)
+
+    merges = []
+    chain = []
+    try:
+        while len(merges) < n - 1:
+            if not chain:
+                chain.append(int(np.flatnonzero(matrix.active)[0]))
+
+            a = chain[-1]
+            previous = chain[-2] if len(chain) > 1 else None
+            b = matrix.nearest(a, previous)
+
+            if b != previous:
+                chain.append(b)
+                continue
+
+            # a and b are each other's nearest neighbours, so they can be merged
+            chain = chain[:-2]
+            merges.append((a, b, float(matrix.distance(a, b))))
+
+            size_a, size_b = sizes[a], sizes[b]
+            matrix.update(a, b, lambda row_a, row_b: new_distance_function(row_a, row_b, size_a, size_b))
+            sizes[b] += size_a
+    finally:
+        matrix.close()
+
+    debug('Found {0} merges of {1} items'.format(len(merges), n))
+    return _sort_and_label(merges, n)
@@ -0,0 +1,129 @@
+"""
+Clustering from a sparse graph of DTW distances, for the region sets that are too large for all pairwise distances.
+
+Instead of computing the distances between all pairs of regions, only the distances from each region to its
+k nearest neighbours are computed (see `dgw.dtw.search.DTWIndex`), and the dendrogram is built using single linkage
+on the resulting graph, which does not need the distances that were not computed.
+"""
+from logging import debug
+import numpy as np
+
+from ..dtw.search import DTWIndex
+from ..dtw.shared import as_shared_dataset
+
+__all__ = ['knn_distances', 'sparse_single_linkage']
+
+def knn_distances(data, k, n_processes=None, **dtw_kwargs):
+    """
+    Computes the DTW distances between each of the items in the data and its `k` nearest neighbours.
+
+    :param data: `AlignmentsData` or `SharedDataset` created from it
+    :param k: number of nearest neighbours of each item to compute the distances to
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: `(rows, cols, distances)` arrays of the edges of the nearest neighbour graph.
+             Each edge is listed once, with `rows < cols` being the positions of the items in the data
+    """
+    dataset = as_shared_dataset(data)
+    index = DTWIndex(dataset, **dtw_kwargs)
+    items = index.items
+    n = len(dataset)
+
+    if n == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
+
+    neighbours = index.search_many(dataset, k=k, n_processes=n_processes, exclude_self=True)
+
+    rows = []
+    cols = []
+    distances = []
+    for position, item in enumerate(items):
+        nearest = neighbours[item]
+        rows.append(np.repeat(position, len(nearest)))
+        cols.append(items.get_indexer(nearest.index))
+        distances.append(nearest.values)
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    distances = np.concatenate(distances)
+
+    # Items that are each other's neighbours give the same edge twice
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    keys = rows * n + cols
+    order = np.lexsort((distances, keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[order[1:]] != keys[order[:-1]]
+    order = order[first]
+
+    debug('{0} distinct edges in the {1} nearest neighbour graph of {2} items'.format(len(order), k, n))
+    return rows[order], cols[order], distances[order]
+
+def sparse_single_linkage(n_items, rows, cols, distances, disconnected_distance=None):
+    """
+    Computes single linkage clustering of the graph of distances provided, as a minimum spanning tree.
+
+    The distances that are missing from the graph are treated as larger than any of the ones provided,
+    therefore the result is the same as the one of `fastcluster.single` on the full distance matrix
+    if all of the pairs are in the graph.
+    The connected components of the graph are joined at `disconnected_distance` at the top of the dendrogram.
+
+    :param n_items: number of items clustered
+    :param rows: positions of the first items of the edges
+    :param cols: positions of the second items of the edges
+    :param distances: distances between the items of the edges. Edges with non-finite distances are ignored.
+    :param disconnected_distance: distance to join the connected components of the graph at.
+                                  Defaults to twice the largest distance in the graph
+    :return: linkage matrix, in the same format as the one returned by `fastcluster`
+    """
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    distances = np.asarray(distances, dtype=float)
+
+    finite = np.isfinite(distances)
+    rows, cols, distances = rows[finite], cols[finite], distances[finite]
+
+    if disconnected_distance is None:
+        max_distance = distances.max() if len(distances) > 0 else 0
+        disconnected_distance = 2 * max_distance if max_distance > 0 else 1.0
+
+    # Union-find over cluster ids: items are 0 .. n_items - 1, merged clusters are numbered from n_items on
+    parent = range(2 * n_items - 1)
+    sizes = [1] * n_items + [0] * (n_items - 1)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    linkage = np.empty((max(n_items - 1, 0), 4))
+    next_id = n_items
+
+    def merge(a, b, distance):
+        sizes[next_id] = sizes[a] + sizes[b]
+        linkage[next_id - n_items] = [min(a, b), max(a, b), distance, sizes[next_id]]
+        parent[a] = parent[b] = next_id
+
+    for edge in np.argsort(distances, kind='mergesort'):
+        if next_id == 2 * n_items - 1:
+            break
+
+        a, b = find(rows[edge]), find(cols[edge])
+        if a == b:
+            continue
+
+        merge(a, b, distances[edge])
+        next_id += 1
+
+    if next_id < 2 * n_items - 1:
+        components = sorted(set([find(x) for x in xrange(n_items)]))
+        debug('Joining {0} disconnected components at distance {1}'.format(len(components), disconnected_distance))
+        current = components[0]
+        for component in components[1:]:
+            merge(current, component, disconnected_distance)
+            current = next_id
+            next_id += 1
+
+    return linkage
@@ -56,8 +56,9 @@ class AlignmentsData(object):
     _poi = None
     _scale = None
     _resolution = None
+    _shared_dataset = None
 
-    def __init__(self, panel, resolution, poi=None, scale='raw'):
+    def __init__(self, panel, resolution, poi=None, scale='raw', shared_dataset=None):
         """
         Initialises `AlignmentsData` with a `panel` provided.
         The panel is assumed to have data sets on the minor axis
@@ -68,6 +69,8 @@ class AlignmentsData(object):
         :param resolution: resolution of data
         :param poi: points of interest
         :param scale: the scale of data
+        :param shared_dataset: `dgw.dtw.shared.SharedDataset` holding the same values as the panel, in the same order,
+                               if they are already in shared memory (see `read_bam`)
 
         :return:
         """
@@ -84,7 +87,13 @@ class AlignmentsData(object):
 
         self.points_of_interest = poi
         self._resolution = resolution
+        self._shared_dataset = shared_dataset
 
+    def __getstate__(self):
+        # The values in shared memory are the same as in the panel, do not store them twice
+        state = self.__dict__.copy()
+        state.pop('_shared_dataset', None)
+        return state
 
     def reset_poi(self):
         self._poi = {}
@@ -101,6 +110,14 @@ class AlignmentsData(object):
     def resolution(self):
         return self._resolution
 
+    @property
+    def shared_dataset(self):
+        """
+        The values of the data in shared memory, if they were read into it directly, None otherwise.
+        See `dgw.dtw.shared.as_shared_dataset`.
+        """
+        return self._shared_dataset
+
     @points_of_interest.setter
     def points_of_interest(self, value):
         if value is None:
@@ -150,11 +167,12 @@ class AlignmentsData(object):
 
     @property
     def lengths(self):
-        a = []
-        for _, row in self.data.iteritems():
-            a.append(no_nans_len(row.values))
+        values = self.values
+        not_padding = ~np.all(np.isnan(values), axis=2)
+        if np.any(np.isnan(values[not_padding])):
+            raise ValueError('Inconsistent NaNs between dimensions')
 
-        return pd.Series(a, index=self.items)
+        return pd.Series(not_padding.sum(axis=1), index=self.items)
 
 
     @property
@@ -175,6 +193,21 @@ class AlignmentsData(object):
     def __getitem__(self, item):
         return self.data.__getitem__(item)
 
+    def take(self, indices):
+        """
+        Returns the items at the positions provided, in that order.
+        Unlike `AlignmentsData.ix`, this keeps the `shared_dataset`, as a view of the same shared memory.
+
+        :param indices: positions of the items to take
+        :rtype: AlignmentsData
+        """
+        shared_dataset = self._shared_dataset
+        if shared_dataset is not None:
+            shared_dataset = shared_dataset.take(indices)
+
+        return AlignmentsData(self.data.take(indices, axis=0), self.resolution, poi=self.points_of_interest,
+                              scale=self._scale, shared_dataset=shared_dataset)
+
     def head(self, n=5):
         return self.ix[:n]
 
@@ -192,7 +225,14 @@ class AlignmentsData(object):
             return self
 
         new_data = (self.data + 2).apply(np.log)  # Adding +2 so we have no zeros in log output
-        ad = AlignmentsData(new_data, self.resolution, scale='log')
+
+        # The values in shared memory are transformed in place and passed on to the new object
+        shared_dataset = self._shared_dataset
+        if shared_dataset is not None:
+            np.log(shared_dataset.values + 2, out=shared_dataset.values)
+            self._shared_dataset = None
+
+        ad = AlignmentsData(new_data, self.resolution, scale='log', shared_dataset=shared_dataset)
         ad.points_of_interest = self.points_of_interest
         return ad
 
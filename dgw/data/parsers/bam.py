@@ -1,7 +1,10 @@
 # coding=utf-8
-from itertools import imap
+from functools import partial
+from itertools import imap, izip
 from dgw.data.parsers.filters import MinNumberOfReadsFilter
 from dgw.dtw import reverse_sequence
+from dgw.dtw.parallel import WorkerPool
+from dgw.dtw.shared import SharedDataset
 
 __author__ = 'saulius'
 from logging import debug
@@ -12,6 +15,9 @@ import pysam
 import numpy as np
 from ..containers import AlignmentsData, Regions
 
+# Maximum number of base pairs to fetch from a samfile at once when sweeping through the regions of a chromosome
+MAX_SWEEP_LENGTH = 1000000
+
 def _alignments_that_fall_within_a_region(samfile, chromosome, start, end, extend_to=200):
     """
     Returns raw alignments that fall within the region of interest in samfile.
@@ -69,31 +75,126 @@ def _read_samfile_region(samfile, chromosome, start, end, resolution=50, extend_
     :param resolution:
     :return:
     """
-    if (end - start) % resolution != 0:
-        raise ValueError('The resolution {0} is not valid for region of length {1}'.format(resolution, end-start))
-
-    # Initialise
-    data_len = (end - start) / resolution
-    data_buffer = np.zeros(data_len)
+    return _read_samfile_regions(samfile, chromosome, [start], [end], resolution=resolution, extend_to=extend_to)[0]
 
-    # Fetch all alignments from SamFile
-    alignments = _alignments_that_fall_within_a_region(samfile, chromosome, start, end, extend_to=extend_to)
-    for alignment in alignments:
+def _sweep_chunks(starts, ends, extend_to, max_length=MAX_SWEEP_LENGTH):
+    """
+    Groups the regions, sorted by their starts, into chunks that can be fetched from the samfile at once.
+    The regions are in the same chunk if the windows `_alignments_that_fall_within_a_region` would fetch for them
+    overlap or touch, as long as the chunk does not get longer than `max_length` base pairs.
 
-        if extend_to is not None and extend_to > 0:
-            alignment_start, alignment_end = _extend_read_to(alignment, extend_to)
-            if alignment_end < start or alignment_start >= end:
-                continue
+    :return: list of lists of the positions of the regions in each chunk
+    """
+    if extend_to:
+        window_starts = starts - extend_to + 1
+        window_ends = ends + extend_to - 1
+    else:
+        window_starts, window_ends = starts, ends
+
+    chunks = []
+    chunk = None
+    for i, (window_start, window_end) in enumerate(izip(window_starts, window_ends)):
+        if chunk is not None and window_start <= chunk_end and max(chunk_end, window_end) - chunk_start <= max_length:
+            chunk.append(i)
+            chunk_end = max(chunk_end, window_end)
         else:
-            alignment_start = alignment.pos
-            alignment_end   = alignment.aend
+            chunk = [i]
+            chunks.append(chunk)
+            chunk_start, chunk_end = window_start, window_end
+
+    return chunks
+
+def _read_samfile_regions(samfile, chromosome, starts, ends, resolution=50, extend_to=200):
+    """
+    Returns piled up read counts for each of the regions of a chromosome, see `_read_samfile_region`.
+
+    The regions are read in a single sweep through the chromosome:
+    they are sorted by their starts, and the neighbouring regions are fetched at once (see `_sweep_chunks`),
+    so the same alignments are not fetched and decompressed again for each region they overlap.
+    The alignments of each chunk are sorted by their starts, so the ones that overlap a region are found by a binary search.
+
+    :param samfile:
+    :param chromosome:
+    :param starts: starts of the regions
+    :param ends: ends of the regions
+    :param resolution:
+    :param extend_to:
+    :return: list of read counts of the regions, in the same order as `starts` and `ends`
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+
+    invalid = lengths % resolution != 0
+    if np.any(invalid):
+        raise ValueError('The resolution {0} is not valid for region of length {1}'.format(resolution,
+                                                                                         lengths[invalid][0]))
+
+    order = np.argsort(starts, kind='mergesort')
+    counts = [None] * len(starts)
+    for chunk in _sweep_chunks(starts[order], ends[order], extend_to):
+        chunk = order[chunk]
+
+        # Fetch all alignments of the chunk from SamFile
+        alignments = _alignments_that_fall_within_a_region(samfile, chromosome, starts[chunk].min(), ends[chunk].max(),
+                                                           extend_to=extend_to)
+        alignment_starts, alignment_ends = _alignment_intervals(alignments, extend_to)
+
+        by_start = np.argsort(alignment_starts, kind='mergesort')
+        alignment_starts = alignment_starts[by_start]
+        alignment_ends = alignment_ends[by_start]
+        max_length = (alignment_ends - alignment_starts).max() if len(by_start) > 0 else 0
+
+        # Alignments that overlap the region start after start - max_length and before its end
+        first = np.searchsorted(alignment_starts, starts[chunk] - max_length)
+        last = np.searchsorted(alignment_starts, ends[chunk])
+
+        for region, first_alignment, last_alignment in izip(chunk, first, last):
+            counts[region] = _binned_read_counts(alignment_starts[first_alignment:last_alignment],
+                                                 alignment_ends[first_alignment:last_alignment],
+                                                 starts[region], lengths[region] // resolution, resolution)
+
+    return counts
+
+def _alignment_intervals(alignments, extend_to):
+    """
+    Returns the starts and ends of all of the alignments, extended to `extend_to` as in `_extend_read_to`.
 
-        start_bin = max(0, (alignment_start-start) / resolution)
-        end_bin   = min(data_len -1, (alignment_end-start - 1) / resolution)
+    :param alignments: the alignments, e.g. as returned by `_alignments_that_fall_within_a_region`
+    :param extend_to: length to extend the reads to, if not None or 0
+    :return: `(starts, ends)` arrays
+    """
+    reads = np.array([(alignment.pos, alignment.aend, alignment.alen, alignment.is_reverse)
+                      for alignment in alignments], dtype=np.int64).reshape(-1, 4)
+    positions, aends, alens, is_reverse = reads.T
 
-        data_buffer[start_bin:end_bin+1] += 1
+    if extend_to is None or extend_to == 0:
+        return positions, aends
+
+    too_long = alens > extend_to
+    if np.any(too_long):
+        raise ValueError('Alignment length, alen={0} greater than extend_to parameter ({1})'.format(
+            alens[too_long][0], extend_to))
 
-    return data_buffer
+    is_reverse = is_reverse.astype(bool)
+    starts = np.where(is_reverse, aends - extend_to, positions)
+    ends = np.where(is_reverse, aends, positions + extend_to)
+    return starts, ends
+
+def _binned_read_counts(alignment_starts, alignment_ends, start, data_len, resolution):
+    """
+    Counts the alignments that overlap each of the `data_len` bins of `resolution` base pairs, starting at `start`.
+
+    The bins each alignment overlaps are marked in a difference array, whose cumulative sum gives the counts.
+    """
+    start_bins = np.maximum(0, (alignment_starts - start) // resolution)
+    end_bins = np.minimum(data_len - 1, (alignment_ends - start - 1) // resolution)
+
+    overlapping = end_bins >= start_bins
+    deltas = np.bincount(start_bins[overlapping], minlength=data_len + 1)[:data_len + 1] - \
+             np.bincount(end_bins[overlapping] + 1, minlength=data_len + 1)[:data_len + 1]
+
+    return np.cumsum(deltas)[:data_len].astype(float)
 
 def _extend_read_to(aligned_read, extend_to):
 
@@ -116,8 +217,32 @@ def _extend_read_to(aligned_read, extend_to):
 
     return alignment_start, alignment_end
 
+def _read_shard(alignment_filenames, chromosome_positions, starts, ends, read_counts, resolution, extend_to, shard):
+    """
+    Reads the regions of one chromosome from one of the files, and stores their read counts in `read_counts`.
+
+    The file is opened in the process that reads it, as the file handles cannot be shared between processes.
+
+    :param shard: `(file_number, chromosome)` tuple
+    """
+    file_number, chromosome = shard
+    alignments_file = alignment_filenames[file_number]
+    positions = chromosome_positions[chromosome]
+
+    samfile = pysam.Samfile(alignments_file)
+    try:
+        chromosome_counts = _read_samfile_regions(samfile, chromosome, starts[positions], ends[positions],
+                                                  resolution=resolution, extend_to=extend_to)
+    except Exception, e:
+        raise IOError('Could not read the regions in {0} from {2}, got: {1!r}'.format(chromosome, e, alignments_file))
+    finally:
+        samfile.close()
+
+    for position, region_counts in izip(positions, chromosome_counts):
+        read_counts[position][:, file_number] = region_counts
+
 def read_bam(alignment_filenames, regions, resolution=50, extend_to=200, data_filters=[MinNumberOfReadsFilter(1)],
-            output_removed_indices=False, reverse_negative_strand_regions=False):
+            output_removed_indices=False, reverse_negative_strand_regions=False, n_processes=1):
     """
     Reads provided bam files for the data in the specified regions
     :param alignment_filenames: Filenames of the files to read
@@ -127,6 +252,8 @@ def read_bam(alignment_filenames, regions, resolution=50, extend_to=200, data_fi
     :param data_filters:    Data filters that will be run on data to determine whether to include the value to list or not
     :param output_removed_indices: function outputs both indices in regions that were not found in dataset, and regions removed by filters
     :param reverse_negative_strand_regions: whether to reverse the regions on negative strand or not
+    :param n_processes: number of processes to read the files in, each process reads the regions of one chromosome
+                        from one file at a time. Set to None to use all available CPU cores
     :return: dataset, [regions_not_in_dataset, regions_removed_by_filter] -- the latter two only if output_removed_indices is set
 
     :rtype: pd.Panel
@@ -157,7 +284,7 @@ def read_bam(alignment_filenames, regions, resolution=50, extend_to=200, data_fi
     # TODO: make sure the regions removed are somewhere accounted for
     dataset_regions = regions[regions.chromosome.isin(references)]
 
-    indices_not_in_dataset = regions.index - dataset_regions.index
+    indices_not_in_dataset = regions.index[~regions.index.isin(dataset_regions.index)]
 
     # Make sure the regions play nicely with the resolution
     dataset_regions = dataset_regions.clip_to_resolution(resolution)
@@ -165,47 +292,66 @@ def read_bam(alignment_filenames, regions, resolution=50, extend_to=200, data_fi
     # find the maximum length of a region (we'll use this to initialise numpy arrays)
     max_len = dataset_regions.lengths.max() / resolution
 
-    dataset = {}
-
     if reverse_negative_strand_regions:
         if not dataset_regions.has_strand_data:
             raise ValueError('reverse_negative_strand_regions is set to true, yet the regions provided have no strand information.')
 
-    for index, region in dataset_regions.iterrows():
-        chromosome = region['chromosome']
-        start = region['start']
-        end = region['end']
-        if reverse_negative_strand_regions:
-            strand = region['strand']
-
-        data_arr = np.empty((max_len, len(samfiles)))
-
-        for i, samfile in enumerate(samfiles):
-            try:
-                region_data = _read_samfile_region(samfile,
-                                                   chromosome, start, end,
-                                                   resolution=resolution,
-                                                   extend_to=extend_to)
-            except Exception, e:
-                raise IOError('Could not read {0}:{1}-{2} from {4}, got: {3!r}'.format(chromosome, start, end, e, alignment_filenames[i]))
-
-            if reverse_negative_strand_regions and strand == '-':
-                region_data = reverse_sequence(region_data)
-
-            padding = [np.nan] * (max_len - len(region_data))
-            data_arr[:, i] = np.concatenate((region_data, padding))
+    # Store the regions in the order the items of the resulting panel will be in
+    try:
+        dataset_regions = dataset_regions.ix[sorted(dataset_regions.index)]
+    except TypeError:
+        pass
+
+    # Read each of the files in one sweep through each chromosome, rather than fetching each region separately.
+    # The read counts of the regions are stored in shared memory, in the same order as the regions,
+    # so the (file, chromosome) shards can be read in parallel.
+    regions_data = dataset_regions.data
+    read_counts = SharedDataset.allocate((dataset_regions.lengths // resolution).values, len(samfiles))
+    chromosome_positions = regions_data.groupby('chromosome').indices
+    shards = [(i, chromosome) for i in xrange(len(samfiles)) for chromosome in sorted(chromosome_positions)]
+
+    shard_reader = partial(_read_shard, alignment_filenames, chromosome_positions,
+                           regions_data['start'].values, regions_data['end'].values, read_counts, resolution, extend_to)
+    if n_processes == 1:
+        for shard in shards:
+            shard_reader(shard)
+    else:
+        with WorkerPool(shard_reader, n_processes=n_processes) as pool:
+            pool.map(shards)
 
-        valid = all(imap(lambda f: f.is_valid(data_arr), data_filters))
+    # Filters are applied once all of the files have been read.
+    # The regions that pass them are moved to the front of the shared buffer, in place,
+    # so the dataset in shared memory can be passed on without copying it again.
+    if reverse_negative_strand_regions:
+        strands = regions_data['strand'].values
+    values = read_counts.values
+    kept = []
+    kept_length = 0
+    for position in xrange(len(read_counts)):
+        region_data = read_counts[position]
+        if reverse_negative_strand_regions and strands[position] == '-':
+            region_data[:] = region_data[::-1].copy()
+
+        valid = all(imap(lambda f: f.is_valid(region_data), data_filters))
         if not valid:
             continue
 
-        df = pd.DataFrame(data_arr, columns=columns)
-        dataset[index] = df
+        values[kept_length:kept_length + len(region_data)] = region_data
+        kept_length += len(region_data)
+        kept.append(position)
+
+    items = dataset_regions.index[kept]
+    shared_dataset = SharedDataset(values[:kept_length], read_counts.lengths[kept], items=items)
+
+    panel_values = np.empty((len(kept), max_len, len(samfiles)))
+    panel_values[:] = np.nan
+    for i in xrange(len(kept)):
+        panel_values[i, :shared_dataset.lengths[i]] = shared_dataset[i]
 
-    panel = pd.Panel(dataset)
-    data = AlignmentsData(panel, resolution=resolution)
+    panel = pd.Panel(panel_values, items=items, major_axis=range(max_len), minor_axis=columns)
+    data = AlignmentsData(panel, resolution=resolution, shared_dataset=shared_dataset)
 
-    filtered_out_indices = dataset_regions.index - data.items
+    filtered_out_indices = dataset_regions.index[~dataset_regions.index.isin(data.items)]
 
     if output_removed_indices:
         return data, indices_not_in_dataset, filtered_out_indices
@@ -1,5 +1,9 @@
-__all__ = ['parallel', 'distance', 'visualisation', 'transformations']
+__all__ = ['parallel', 'distance', 'visualisation', 'transformations', 'shared', 'cache', 'lower_bounds', 'search']
 
+from cache import *
 from distance import *
+from lower_bounds import *
 from parallel import *
+from search import *
+from shared import *
 from transformations import  *
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from logging import debug
+import numpy as np
+
+__all__ = ['DistanceCache', 'sequence_digest']
+
+def sequence_digest(sequence):
+    """
+    Returns a hash of the sequence contents that can be used to recognise the same sequence across different runs.
+
+    :param sequence: one or two dimensional sequence
+    :return: hexadecimal digest of the sequence
+    """
+    sequence = np.ascontiguousarray(sequence, dtype=float)
+    if sequence.ndim == 1:
+        sequence = sequence.reshape(-1, 1)
+
+    digest = hashlib.sha1(str(sequence.shape))
+    digest.update(sequence.tostring())
+    return digest.hexdigest()
+
+class DistanceCache(object):
+    """
+    An on-disk store of DTW distances between pairs of sequences, backed by SQLite.
+
+    The distances are addressed by the contents of both of the sequences and the parameters of DTW,
+    therefore the same cache file can be shared between runs on different subsets of the regions,
+    or runs with different DTW parameters.
+
+    The cache is safe to use from multiple processes at once: each process opens its own connection to the database
+    when it is first needed, and the database uses write-ahead logging, so readers are not blocked by the writers.
+    Call `DistanceCache.close` before forking the processes, if the cache has been used in the parent process.
+    """
+    _filename = None
+    _timeout = None
+
+    _connection = None
+    _connection_pid = None
+
+    # SQLite limits the number of variables in a single query to 999
+    BATCH_SIZE = 500
+    MAX_RETRIES = 10
+
+    def __init__(self, filename, timeout=60.0):
+        """
+        Opens the cache stored in `filename`, creating it if it does not exist.
+
+        :param filename: SQLite database to store the distances in
+        :param timeout: number of seconds to wait for the other processes to release the lock on the database
+        """
+        self._filename = filename
+        self._timeout = timeout
+
+        connection = self._get_connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS distances (key TEXT PRIMARY KEY, distance REAL NOT NULL)')
+        connection.commit()
+        # Do not keep the connection open, so it is not inherited by forked processes
+        self.close()
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def _get_connection(self):
+        # Connections cannot be shared across forked processes, so each process gets its own
+        pid = os.getpid()
+        if self._connection is None or self._connection_pid != pid:
+            self._connection = sqlite3.connect(self._filename, timeout=self._timeout)
+            self._connection_pid = pid
+        return self._connection
+
+    def _retry(self, function, *args):
+        for attempt in xrange(self.MAX_RETRIES):
+            try:
+                return function(*args)
+            except sqlite3.OperationalError, e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                debug('Distance cache {0!r} is locked, retrying'.format(self._filename))
+                self._get_connection().rollback()
+                time.sleep(0.1 * (attempt + 1))
+
+        return function(*args)
+
+    @staticmethod
+    def key_prefix(dtw_args, dtw_kwargs):
+        """
+        Returns the part of the key that identifies the DTW parameters.
+
+        :param dtw_args: positional arguments passed to `dtw_std`
+        :param dtw_kwargs: keyword arguments passed to `dtw_std`
+        :return:
+        """
+        return json.dumps([list(dtw_args), dtw_kwargs], sort_keys=True)
+
+    @staticmethod
+    def key(prefix, digest_a, digest_b):
+        """
+        Returns the key the distance between the sequences with digests `digest_a` and `digest_b` is stored under.
+        The key does not depend on the order of the sequences.
+
+        :param prefix: see `DistanceCache.key_prefix`
+        :param digest_a: `sequence_digest` of the first sequence
+        :param digest_b: `sequence_digest` of the second sequence
+        :return:
+        """
+        if digest_b < digest_a:
+            digest_a, digest_b = digest_b, digest_a
+        return hashlib.sha1('{0}|{1}|{2}'.format(prefix, digest_a, digest_b)).hexdigest()
+
+    def _lookup(self, keys):
+        cursor = self._get_connection().execute('SELECT key, distance FROM distances WHERE key IN ({0})'
+                                                .format(','.join(['?'] * len(keys))), keys)
+        return dict(cursor.fetchall())
+
+    def lookup(self, keys):
+        """
+        Returns the distances stored under the keys provided.
+
+        :param keys: list of keys, see `DistanceCache.key`
+        :return: dictionary `{key: distance}` of the keys that were found in the cache
+        """
+        keys = list(keys)
+        answer = {}
+        for start in xrange(0, len(keys), self.BATCH_SIZE):
+            answer.update(self._retry(self._lookup, keys[start:start + self.BATCH_SIZE]))
+        return answer
+
+    def _store(self, items):
+        connection = self._get_connection()
+        connection.executemany('INSERT OR IGNORE INTO distances (key, distance) VALUES (?, ?)', items)
+        connection.commit()
+
+    def store(self, items):
+        """
+        Stores the distances in the cache. Distances that are already in the cache are left unchanged.
+
+        :param items: list of `(key, distance)` tuples
+        """
+        items = [(key, float(distance)) for key, distance in items]
+        if items:
+            self._retry(self._store, items)
+
+    def __len__(self):
+        return self._get_connection().execute('SELECT COUNT(*) FROM distances').fetchone()[0]
+
+    def close(self):
+        if self._connection is not None and self._connection_pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+        self._connection_pid = None
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(self.__class__.__name__, self._filename)
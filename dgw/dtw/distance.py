@@ -123,46 +123,55 @@ def warping_conservation_vector(warping_path):
     :param warping_path:
     :return:
     """
-    path_a, path_b = warping_path
-
-    n = max(path_b[0], path_b[-1]) + 1  # Number of points on the second sequence is, either the last point
-                                           # .. or the first point (if reversed), plus one
-
-    conservation_vector = np.zeros(n-1)
-
-    prev_i = None
-    prev_j = None
-    diag_path_taken_until_current_point = True
-    for i, j in zip(path_a, path_b):
-        if prev_j is None:
-            prev_j = j
-            prev_i = i
-            diag_path_taken_until_current_point = True
-            continue
-        elif j == prev_j:
-            diag_path_taken_until_current_point = False
-            prev_i = i
-        else:
-            if diag_path_taken_until_current_point and prev_i != i:
-                conservation_vector[min(prev_j, j)] = 1
-
-            diag_path_taken_until_current_point = True
-            prev_j = j
-            prev_i = i
-
-    first_one_in_set = -1
-    number_of_ones_in_set = 0
-    for i in range(n-1):
-        if conservation_vector[i] == 0 and first_one_in_set > -1:
-            conservation_vector[first_one_in_set:i] = number_of_ones_in_set
-            number_of_ones_in_set = 0
-            first_one_in_set = -1
-        elif conservation_vector[i] == 1:
-            if number_of_ones_in_set == 0:
-                first_one_in_set = i
-            number_of_ones_in_set += 1
-
-    if number_of_ones_in_set > 0 and first_one_in_set > -1:
-        conservation_vector[first_one_in_set:] = number_of_ones_in_set
-
-    return conservation_vector
+    return warping_conservation_vectors([warping_path])[0]
+
+def warping_conservation_vectors(warping_paths):
+    """
+    Computes the warping conservation vectors (see `warping_conservation_vector`) of many warping paths at once.
+
+    A step of the path between two points on the second sequence is conserved if the path moves diagonally,
+    and the point it moves from has been reached diagonally as well (or is the start of the path).
+    Each of the conserved bins then gets the length of the conserved run it belongs to.
+
+    :param warping_paths: list of warping paths, usually to the same base sequence
+    :return: `[len(warping_paths) x n-1]` array of conservation vectors, where `n` is the length of the longest
+             second sequence. Vectors of the paths to shorter sequences are padded with zeros.
+    """
+    n_paths = len(warping_paths)
+    if not n_paths:
+        return np.zeros((0, 0))
+
+    path_lengths = np.array([len(path[0]) for path in warping_paths], dtype=int)
+    path_a = np.concatenate([path[0] for path in warping_paths]).astype(int)
+    path_b = np.concatenate([path[1] for path in warping_paths]).astype(int)
+    path_ids = np.repeat(np.arange(n_paths), path_lengths)
+
+    # Number of points on the second sequence is, either the last point
+    # .. or the first point (if reversed), plus one
+    path_ends = np.cumsum(path_lengths)
+    path_starts = path_ends - path_lengths
+    n = max(np.max(np.maximum(path_b[path_starts], path_b[path_ends - 1])) + 1, 1)
+
+    # Steps between consecutive points, the steps that cross the boundaries between the paths are masked out
+    step_within_path = path_ids[1:] == path_ids[:-1]
+    moves_a = np.diff(path_a) != 0
+    moves_b = np.diff(path_b) != 0
+    # Whether the point each step moves from has been reached diagonally
+    moved_b_before = np.concatenate(([True], moves_b[:-1] | ~step_within_path[:-1]))
+
+    conserved = step_within_path & moves_a & moves_b & moved_b_before
+    conservation_vectors = np.zeros((n_paths, n - 1))
+    conservation_vectors[path_ids[1:][conserved], np.minimum(path_b[:-1], path_b[1:])[conserved]] = 1
+
+    # Replace each run of ones with its length
+    padded = np.zeros((n_paths, n + 1))
+    padded[:, 1:-1] = conservation_vectors
+    run_rows, run_starts = np.nonzero(np.diff(padded, axis=1) == 1)
+    _, run_ends = np.nonzero(np.diff(padded, axis=1) == -1)
+    run_lengths = run_ends - run_starts
+
+    deltas = np.zeros((n_paths, n))
+    deltas[run_rows, run_starts] = run_lengths
+    deltas[run_rows, run_ends] = -run_lengths
+
+    return np.cumsum(deltas, axis=1)[:, :-1]
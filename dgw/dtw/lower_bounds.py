@@ -0,0 +1,163 @@
+"""
+Cheap lower bounds of the DTW distances computed by `dgw.dtw.distance.dtw_std`.
+
+The bounds are used to skip the DTW computations that cannot beat the best distance found so far.
+They hold for all of the constraints `dtw_std` supports, as the constraints can only increase the distance.
+"""
+import numpy as np
+from dgw.dtw.shared import SharedDataset
+from dgw.dtw.utilities import _strip_nans
+
+__all__ = ['dtw_lower_bounds', 'bounding_boxes']
+
+BOX_BLOCK_SIZE = 1024
+
+def _local_distances(x, y, metric):
+    """
+    Returns the local distances between the points of x and y, the same way DTW computes them.
+    The arrays are broadcast against each other, points are in the last axis.
+    """
+    if metric == 'sqeuclidean':
+        return np.sum((x - y) ** 2, axis=-1)
+    elif metric == 'euclidean':
+        return np.sqrt(np.sum((x - y) ** 2, axis=-1))
+    elif metric == 'cosine':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 1.0 - np.sum(x * y, axis=-1) / (np.sqrt(np.sum(x ** 2, axis=-1)) *
+                                                  np.sqrt(np.sum(y ** 2, axis=-1)))
+    else:
+        raise ValueError('Unsupported distance metric provided: {0!r}.'.format(metric))
+
+def _distances_to_boxes(points, lower, upper, metric):
+    """
+    Returns the smallest local distances between the points and any point of the boxes `[lower, upper]`.
+    The arrays are broadcast against each other, points are in the last axis.
+    """
+    outside = np.maximum(lower - points, 0) + np.maximum(points - upper, 0)
+    squared = np.sum(outside ** 2, axis=-1)
+    if metric == 'sqeuclidean':
+        return squared
+    else:
+        return np.sqrt(squared)
+
+def bounding_boxes(candidates):
+    """
+    Returns the bounding boxes of each of the sequences in the dataset, so they can be reused across the calls of
+    `dtw_lower_bounds`.
+
+    :param candidates: the sequences to compute the bounding boxes of
+    :type candidates: `SharedDataset`
+    :return: `(lower, upper)` tuple of `[len(candidates) x n_datasets]` arrays
+    """
+    if len(candidates) == 0:
+        empty = np.empty((0, candidates.ndim))
+        return empty, empty
+
+    values = candidates.values
+    offsets = candidates.offsets
+
+    # Reduce over [start, end) of each sequence in the order they are stored in, the values between the sequences
+    # (if the dataset is a view, see `SharedDataset.take`) are reduced into the odd rows that are discarded
+    order = np.argsort(offsets, kind='mergesort')
+    boundaries = np.column_stack((offsets[order], offsets[order] + candidates.lengths[order])).ravel()
+    if boundaries[-1] == len(values):
+        # The last sequence is reduced up to the end of the values anyway
+        boundaries = boundaries[:-1]
+
+    lower = np.empty((len(candidates), candidates.ndim))
+    upper = np.empty((len(candidates), candidates.ndim))
+    lower[order] = np.minimum.reduceat(values, boundaries)[::2]
+    upper[order] = np.maximum.reduceat(values, boundaries)[::2]
+    return lower, upper
+
+def dtw_lower_bounds(sequence, candidates, boxes=None, metric='sqeuclidean', try_reverse=True, normalise=False,
+                     scale_first=False, warping_penalty=0, **kwargs):
+    """
+    Returns lower bounds of the DTW distances between the sequence and each of the candidates.
+
+    Two bounds are computed, and the larger one is returned:
+
+        Endpoint bound (similar to LB_Kim)
+            the warping path always matches the first points and the last points of both sequences.
+            For reversed sequences, the first point of one sequence is matched to the last point of the other one.
+        Bounding box bound (similar to LB_Yi)
+            every point of either sequence is matched to at least one point of the other sequence,
+            so it costs at least as much as its distance to the bounding box of the other sequence.
+            Only available for `sqeuclidean` and `euclidean` metrics.
+
+    The parameters are the same as the ones of `dtw_std`, so the DTW keyword arguments can be passed in directly.
+
+    :param sequence: the query sequence
+    :param candidates: the sequences to bound the distances to
+    :type candidates: `SharedDataset`, or anything `SharedDataset.from_sequences` takes
+    :param boxes: bounding boxes of the candidates, as returned by `bounding_boxes`. Computed if not provided.
+    :return: array of lower bounds, one for each of the candidates
+    """
+    sequence = _strip_nans(np.asarray(sequence, dtype=float))
+    sequence = sequence.reshape(len(sequence), -1)
+
+    if not isinstance(candidates, SharedDataset):
+        candidates = SharedDataset.from_sequences(candidates)
+
+    n_candidates = len(candidates)
+    bounds = np.zeros(n_candidates)
+    if n_candidates == 0 or len(sequence) == 0 or warping_penalty < 0:
+        # Negative warping penalties can make the distance smaller than the cost of any of the points
+        return bounds
+
+    values = candidates.values
+    lengths = candidates.lengths
+    offsets = candidates.offsets
+    length = len(sequence)
+
+    if not scale_first:
+        # Uniform scaling does not keep the last point of the stretched sequence
+        first_points = values[offsets]
+        last_points = values[offsets + lengths - 1]
+
+        first_distances = _local_distances(sequence[0], first_points, metric)
+        single_point = (length == 1) & (lengths == 1)
+
+        forward = first_distances + _local_distances(sequence[-1], last_points, metric)
+        if try_reverse:
+            reverse = _local_distances(sequence[-1], first_points, metric) + \
+                      _local_distances(sequence[0], last_points, metric)
+            endpoint_bounds = np.minimum(forward, reverse)
+        else:
+            endpoint_bounds = forward
+
+        # There is only one point to match if both sequences are of length one
+        endpoint_bounds[single_point] = first_distances[single_point]
+        bounds = np.maximum(bounds, endpoint_bounds)
+
+    if metric in ['sqeuclidean', 'euclidean']:
+        # Bounding boxes do not depend on the order of the points, so these bounds also hold for reversed sequences
+        if boxes is None:
+            boxes = bounding_boxes(candidates)
+        lower, upper = boxes
+
+        # Compare the sequence to the boxes in blocks, so the [length x block x n_datasets] array stays small
+        sequence_to_candidates = np.empty(n_candidates)
+        for start in xrange(0, n_candidates, BOX_BLOCK_SIZE):
+            end = start + BOX_BLOCK_SIZE
+            sequence_to_candidates[start:end] = _distances_to_boxes(sequence[:, np.newaxis, :],
+                                                                    lower[np.newaxis, start:end, :],
+                                                                    upper[np.newaxis, start:end, :],
+                                                                    metric).sum(axis=0)
+        candidates_to_sequence = np.add.reduceat(_distances_to_boxes(values, sequence.min(axis=0),
+                                                                     sequence.max(axis=0), metric),
+                                                 offsets)
+
+        if scale_first:
+            # Only the longer sequence keeps its points when the shorter one is stretched to its length.
+            # The stretched sequence has the same bounding box though.
+            box_bounds = np.where(length >= lengths, sequence_to_candidates, candidates_to_sequence)
+        else:
+            box_bounds = np.maximum(sequence_to_candidates, candidates_to_sequence)
+
+        bounds = np.maximum(bounds, box_bounds)
+
+    if normalise:
+        bounds /= np.maximum(length, lengths)
+
+    return bounds
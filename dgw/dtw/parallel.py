@@ -1,14 +1,19 @@
-from multiprocessing import cpu_count, Array, Process, Queue
-from Queue import Empty, Full
-from math import factorial
+from multiprocessing import cpu_count, Array, Process, Pipe
+from collections import deque
+from functools import partial
+from math import sqrt
 import itertools
+import select
 import numpy as np
 import ctypes
-from logging import debug
+from logging import debug, warning
 
 from dgw.dtw.distance import dtw_std
+from dgw.dtw.shared import SharedDataset, as_shared_dataset
+from dgw.dtw.cache import sequence_digest
 
-__all__ = ['parallel_pdist']
+__all__ = ['parallel_pdist', 'parallel_pdist_update', 'parallel_pdist_groups', 'normalise_condensed_distances',
+           'unique_sequences', 'parallel_dtw_paths', 'WorkerPool']
 
 def combinations_count(n_items):
     """
@@ -17,271 +22,702 @@ def combinations_count(n_items):
     :param n_items:
     :return:
     """
-    return factorial(n_items) / (2 * factorial(n_items - 2))
+    return n_items * (n_items - 1) / 2
 
-def _parallel_dtw_worker(data_buffer, operations_generator, data_buffer_shape, result_buffer,
-                         scheduling_queue, exception_queue,
-                         dtw_args, dtw_kwargs):
+def _condensed_row_start(i, n_items):
     """
-    A worker function for parallel_pdist that is executed on a separate process.
+    Returns the position in the condensed distance matrix of `n_items` where the distances of item `i`
+    to the items `i+1, i+2, ...` start.
+    """
+    return i * n_items - i * (i + 1) / 2
 
-    The function takes a shared memory buffer to read the data from.
-    A shared memory buffer to save the data into, `result_buffer` is also passed to the function.
+def _items_count(condensed_distances):
+    """
+    Returns the number of items the condensed distance matrix provided was computed for
+    """
+    n_distances = len(condensed_distances)
+    n_items = int(round((1 + sqrt(1 + 8 * n_distances)) / 2))
+    if combinations_count(n_items) != n_distances:
+        raise ValueError('{0} is not a valid length for a condensed distance matrix'.format(n_distances))
+    return n_items
 
-    The function takes the regions of the result function to compute from the scheduling queue `scheduling_queue` and performs
-    these calculations until the scheduling function becomes empty.
+def subset_condensed_distances(condensed_distances, indices):
+    """
+    Returns the condensed distance matrix of only the items at the indices provided,
+    without converting the matrix to its square form first.
 
-    Any exceptions that occur are pushed to `exception_queue` and the process exits.
+    :param condensed_distances: condensed distance matrix (as returned by `parallel_pdist`)
+    :param indices: indices of the items to keep. The items will be ordered in the same way as the indices are.
+                    The indices can repeat, in which case the distance between the copies of the item is zero.
+    :return:
+    """
+    n_items = _items_count(condensed_distances)
+    indices = np.asarray(indices, dtype=int)
+
+    result = np.zeros(combinations_count(len(indices)))
+    position = 0
+    for a, i in enumerate(indices):
+        others = indices[a+1:]
+        # Distance (i, j) is stored in row min(i, j)
+        rows = np.minimum(i, others)
+        columns = np.maximum(i, others)
+        different = rows != columns
+
+        segment = result[position:position + len(others)]
+        segment[different] = condensed_distances[_condensed_row_start(rows[different], n_items)
+                                                 + columns[different] - rows[different] - 1]
+        position += len(others)
+
+    return result
+
+def _validate_n_processes(n_processes):
+    """
+    Returns the number of processes to use, defaulting to the number of CPU cores available
 
-    :param data_buffer: shared memory buffer where data is read from
-    :param data_buffer_shape: shape of this buffer -- used to convert it to np array
-    :param result_buffer: shared memory buffer to store result in
-    :param scheduling_queue: multiprocessing-safe queue to read processing schedule from
-    :type scheduling_queue: multiprocessing.Queue
-    :param exception_queue: queue that any exceptions that occur will be pushed into
-    :param dtw_args: args passed into `dtw_std` or `uniform_scaled_distance`
-    :param dtw_kwargs: kwargs passed into `dtw_std` or `uniform_scaled_distance`
+    :param n_processes: number of processes requested, or None
     :return:
     """
+    if n_processes is None:
+        return cpu_count()
+
+    n_processes = int(n_processes)
+    if n_processes <= 0:
+        raise ValueError('N_processes should be > 0')
+    elif n_processes > cpu_count():
+        raise ValueError('The specified number of CPUs to use, {0} is greater than the number of available CPUs, {1}'
+        .format(n_processes, cpu_count()))
+    return n_processes
+
+def normalise_condensed_distances(raw_distances, lengths):
+    """
+    Divides each of the distances in the condensed distance matrix by the length of the longer sequence in the pair,
+    giving the same result as computing the distances with `normalise=True` in `dtw_std`.
+
+    :param raw_distances: condensed distance matrix computed with `normalise=False`
+    :param lengths: lengths of the sequences (without NaN padding), e.g. `SharedDataset.lengths`
+    :return: normalised condensed distance matrix
+    """
+    lengths = np.asarray(lengths, dtype=float)
+    n_items = len(lengths)
+    if combinations_count(n_items) != len(raw_distances):
+        raise ValueError('The distance matrix of length {0} does not match the number of sequences {1}'
+                         .format(len(raw_distances), n_items))
+
+    normalised = np.empty(len(raw_distances))
+    for i in xrange(n_items - 1):
+        start = _condensed_row_start(i, n_items)
+        end = start + n_items - i - 1
+        normalised[start:end] = raw_distances[start:end] / np.maximum(lengths[i], lengths[i+1:])
+
+    return normalised
+
+def _pool_worker(function, task_connection, result_connection):
+    """
+    The loop that is executed in each of the processes of `WorkerPool`.
+
+    Receives `(chunk_id, chunk)` tuples from `task_connection`, applies `function` to the chunk and sends the result
+    back through `result_connection`. Stops when `None` is received.
+
+    Any exceptions that occur are sent back to the parent process and the process exits.
+
+    :param function: function to apply to each of the chunks
+    :param task_connection: connection to read the chunks from
+    :param result_connection: connection to send the results to
+    """
     import sys
     import traceback
     import os
+    import cPickle as pickle
 
+    pid = os.getpid()
+    debug('PROCESS {0}: Spawned'.format(pid))
+    chunk_id = None
     try:
-        pid = os.getpid()
-        debug('PROCESS {0}: Spawned'.format(pid))
-
-        data_view = np.frombuffer(data_buffer).reshape(data_buffer_shape)  # Point numpy array to memory
         while True:
-            schedule = scheduling_queue.get()
-            if schedule is None:
-                break  # This indicates there is nothing else will be put in the queue. Kind of a "stop" marker
-            else:
-                debug('PROCESS {0}: Iteration start'.format(pid))
-                start, end = schedule
+            task = task_connection.recv()
+            if task is None:
+                break  # Stop marker
+
+            chunk_id, chunk = task
+            debug('PROCESS {0}: Chunk {1!r} start'.format(pid, chunk_id))
+            result = function(chunk)
+            result_connection.send(('done', chunk_id, result))
+            debug('PROCESS {0}: Chunk {1!r} end'.format(pid, chunk_id))
 
-            # Create the combinations object inside the Process so we can just pass start/end locations in the queue
-            # Will need to recreate object every time as we use absolute positions to slice
-            combs = operations_generator(xrange(data_buffer_shape[0]))
-            data_indices = itertools.islice(combs, start, end)
+        debug('PROCESS {0}: Work complete'.format(pid))
+    except:
+        e = sys.exc_info()[1]
+        traceback.print_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # Make sure the parent gets something it can unpickle
+            e = Exception('{0!r} in worker process {1}'.format(e, pid))
+        result_connection.send(('error', chunk_id, e))
+
+class _PoolProcess(object):
+    """
+    Book-keeping for a single process of the `WorkerPool`
+    """
+    def __init__(self, function):
+        task_receiver, self.task_connection = Pipe(duplex=False)
+        self.result_connection, result_sender = Pipe(duplex=False)
 
-            # Actual data processing work
-            for i, (x, y) in enumerate(data_indices):
-                a = data_view[x]
-                b = data_view[y]
-                result = dtw_std(a, b, *dtw_args, **dtw_kwargs)
-                result_buffer[start + i] = result
+        self.process = Process(target=_pool_worker, args=(function, task_receiver, result_sender))
+        self.process.daemon = True
+        self.process.start()
 
-            debug('PROCESS {0}: Iteration end'.format(pid))
+        # Close the ends of the pipes the parent does not use, so a dead child shows up as EOF
+        task_receiver.close()
+        result_sender.close()
 
+        self.chunk_id = None
 
-        debug('PROCESS {0}: Work complete'.format(pid))
+    def fileno(self):
+        return self.result_connection.fileno()
 
-    except Exception as e:
-        exception_queue.put(e)
-        traceback.print_exc()
-    except:
-        e = sys.exc_info()[0]
-        exception_queue.put(e)
-        traceback.print_exc()
+class WorkerPool(object):
+    """
+    A pool of worker processes that apply a function to chunks of work.
+
+    The pool keeps track of which process works on which chunk. If a process dies without finishing its chunk
+    (e.g. it gets killed by the out-of-memory killer), the chunk is handed to a replacement process.
+    A chunk is attempted at most `max_retries + 1` times before the whole computation is aborted, so a computation
+    either finishes with all chunks processed or raises an exception.
+
+    Exceptions raised by the function itself are not retried, but are re-raised in the parent process.
+
+    The function is inherited by the forked processes, therefore it can reference shared memory buffers
+    (see `SharedDataset`), while the chunks and results are pickled and sent between the processes.
+
+    Example::
+
+        pool = WorkerPool(function, n_processes=4)
+        with pool:
+            results = pool.map(chunks)
+    """
+    _function = None
+    _n_processes = None
+    _max_retries = None
+    _poll_interval = None
+
+    _processes = None
+    _pending = None
+    _chunks = None
+    _attempts = None
+
+    def __init__(self, function, n_processes=None, max_retries=3, poll_interval=1.0):
+        """
+        :param function: function taking a single chunk of work as its argument. Results are returned to the parent
+        :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+        :param max_retries: number of times a chunk will be re-queued after the process working on it died
+        :param poll_interval: how often (in seconds) to check whether the processes are still alive
+        """
+        self._function = function
+        self._n_processes = _validate_n_processes(n_processes)
+        self._max_retries = int(max_retries)
+        self._poll_interval = poll_interval
+
+        self._processes = []
+        self._pending = deque()
+        self._chunks = {}
+        self._attempts = {}
+
+    @property
+    def n_processes(self):
+        return self._n_processes
+
+    def start(self):
+        """
+        Starts the worker processes
+        """
+        debug('Using {0} processes for parallel computation'.format(self._n_processes))
+        while len(self._processes) < self._n_processes:
+            self._processes.append(_PoolProcess(self._function))
+
+    def submit(self, chunk_id, chunk):
+        """
+        Schedules the chunk for processing.
+
+        :param chunk_id: unique (hashable, picklable) identifier of the chunk
+        :param chunk: picklable chunk of work that will be passed to the function
+        """
+        if chunk_id in self._chunks:
+            raise ValueError('Chunk {0!r} is already scheduled'.format(chunk_id))
+        self._chunks[chunk_id] = chunk
+        self._attempts[chunk_id] = 0
+        self._pending.append(chunk_id)
+
+    @property
+    def n_outstanding(self):
+        """
+        Number of chunks submitted, but not yet processed
+        """
+        return len(self._chunks)
+
+    def _dispatch(self):
+        for process in self._processes:
+            if not self._pending:
+                break
+            if process.chunk_id is None:
+                chunk_id = self._pending.popleft()
+                self._attempts[chunk_id] += 1
+                process.chunk_id = chunk_id
+                process.task_connection.send((chunk_id, self._chunks[chunk_id]))
+
+    def _handle_dead_process(self, process):
+        process.process.join()
+        exitcode = process.process.exitcode
+        self._processes.remove(process)
+        process.result_connection.close()
+        process.task_connection.close()
+
+        chunk_id = process.chunk_id
+        if chunk_id is None or chunk_id not in self._chunks:
+            debug('Process {0} exited with code {1} while idle'.format(process.process.pid, exitcode))
+        else:
+            warning('Process {0} died (exit code {1}) while working on chunk {2!r}'.format(process.process.pid,
+                                                                                          exitcode, chunk_id))
+            if self._attempts[chunk_id] > self._max_retries:
+                self.terminate()
+                raise RuntimeError('Chunk {0!r} failed {1} times, the last process working on it exited with '
+                                   'code {2}. Giving up'.format(chunk_id, self._attempts[chunk_id], exitcode))
+            self._pending.appendleft(chunk_id)
+
+        if self._chunks:
+            debug('Starting a replacement process')
+            self._processes.append(_PoolProcess(self._function))
+
+    def _receive(self, process):
+        try:
+            message = process.result_connection.recv()
+        except (EOFError, IOError):
+            # The process is dead, or died while sending the message
+            self._handle_dead_process(process)
+            return None
+
+        kind, chunk_id, payload = message
+        if kind == 'error':
+            self.terminate()
+            raise payload
+
+        if process.chunk_id == chunk_id:
+            process.chunk_id = None
+
+        if chunk_id not in self._chunks:
+            # Duplicate result of a chunk that was re-queued
+            return None
+
+        del self._chunks[chunk_id]
+        del self._attempts[chunk_id]
+        return chunk_id, payload
+
+    def completed(self):
+        """
+        Yields `(chunk_id, result)` tuples as the chunks get processed, until there are no outstanding chunks left.
+        More chunks can be submitted while iterating.
+        """
+        self.start()
+
+        while self._chunks:
+            self._dispatch()
+
+            ready, _, _ = select.select(self._processes, [], [], self._poll_interval)
+            for process in ready:
+                answer = self._receive(process)
+                if answer is not None:
+                    yield answer
+
+            for process in list(self._processes):
+                if process not in ready and not process.process.is_alive():
+                    if process.result_connection.poll():
+                        # Collect whatever the process managed to send before dying first
+                        continue
+                    self._handle_dead_process(process)
+
+    def map(self, chunks):
+        """
+        Processes all the chunks and returns the results as a list in the same order.
+
+        :param chunks: list of chunks to process
+        :return:
+        """
+        for i, chunk in enumerate(chunks):
+            self.submit(i, chunk)
+
+        results = [None] * len(chunks)
+        for i, result in self.completed():
+            results[i] = result
+        return results
+
+    def close(self):
+        """
+        Stops the worker processes once they are idle
+        """
+        for process in self._processes:
+            try:
+                process.task_connection.send(None)
+            except IOError:
+                pass
+
+        for process in self._processes:
+            process.process.join()
+            process.result_connection.close()
+            process.task_connection.close()
+
+        self._processes = []
+
+    def terminate(self):
+        """
+        Stops the worker processes immediately
+        """
+        for process in self._processes:
+            process.process.terminate()
+        for process in self._processes:
+            process.process.join()
+            process.result_connection.close()
+            process.task_connection.close()
+        self._processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+def _split_into_slices(n_operations, number_of_slices):
+    """
+    Splits `n_operations` into `(start, end)` slices of roughly equal size
+    """
+    buffer_size, remainder = divmod(n_operations, number_of_slices)
+
+    slices = []
+    for i in xrange(number_of_slices):
+        start = i * buffer_size
+        end = start + buffer_size
+        if end > start:
+            slices.append((start, end))
+    if remainder:
+        last_start = number_of_slices * buffer_size
+        last_end = n_operations
+        slices.append((last_start, last_end))
+
+    return slices
+
+def _parallel_dtw_worker(dataset, operations_generator, result_buffer, dtw_args, dtw_kwargs, distance_cache, digests,
+                         schedule):
+    """
+    A worker function for parallel_pdist that is executed on a separate process.
+
+    The function takes a `SharedDataset` to read the data from.
+    A shared memory buffer to save the data into, `result_buffer` is also passed to the function.
+
+    The function computes the operations `[start, end)` from `schedule` and writes them to the same locations
+    in the `result_buffer`.
+
+    :param dataset: dataset in shared memory where data is read from
+    :type dataset: `SharedDataset`
+    :param operations_generator: factory function that generates the operations, see `_parallel_dtw`
+    :param result_buffer: shared memory buffer to store result in
+    :param dtw_args: args passed into `dtw_std` or `uniform_scaled_distance`
+    :param dtw_kwargs: kwargs passed into `dtw_std` or `uniform_scaled_distance`
+    :param distance_cache: `DistanceCache` to look the distances up in before computing them, or None
+    :param digests: `sequence_digest` of each of the items in dataset, if `distance_cache` is used
+    :param schedule: `(start, end)` tuple of operations to compute
+    :return:
+    """
+    start, end = schedule
+
+    # Create the combinations object inside the Process so we can just pass start/end locations in the queue
+    # Will need to recreate object every time as we use absolute positions to slice
+    combs = operations_generator(xrange(len(dataset)))
+    data_indices = itertools.islice(combs, start, end)
+
+    if distance_cache is None:
+        # Actual data processing work
+        for i, (x, y) in enumerate(data_indices):
+            a = dataset[x]
+            b = dataset[y]
+            result = dtw_std(a, b, *dtw_args, **dtw_kwargs)
+            result_buffer[start + i] = result
+        return
+
+    key_prefix = distance_cache.key_prefix(dtw_args, dtw_kwargs)
+    position = start
+    while position < end:
+        batch = list(itertools.islice(data_indices, distance_cache.BATCH_SIZE))
+        keys = [distance_cache.key(key_prefix, digests[x], digests[y]) for x, y in batch]
+        cached = distance_cache.lookup(keys)
+
+        new_distances = []
+        for i, ((x, y), key) in enumerate(itertools.izip(batch, keys)):
+            try:
+                result = cached[key]
+            except KeyError:
+                result = dtw_std(dataset[x], dataset[y], *dtw_args, **dtw_kwargs)
+                new_distances.append((key, result))
+            result_buffer[position + i] = result
+
+        distance_cache.store(new_distances)
+        position += len(batch)
 
 def _pdist_operations_generator_factory(indices):
     return itertools.combinations(indices, 2)
 
-def _parallel_dtw(three_dim_array, _operations_generator_factory, n_operations, n_processes=None, *dtw_args, **dtw_kwargs):
+def _parallel_dtw(dataset, _operations_generator_factory, n_operations, n_processes=None, distance_cache=None,
+                  *dtw_args, **dtw_kwargs):
     """
     Runs DTW on parallel
-    :param three_dim_array: three-dimensional numpy array of data
+    :param dataset: `SharedDataset` containing the data
     :param _operations_generator_factory: factory function that generates the operations required.
        Should take one argument -- all indices in the data and return a generator of [(i1, j1), (i1,j2), ...]
        where is and js are the operations that need to be computed. See e.g. `_pdist_operations_generator_factory`
     :param n_operations: length of _operations_generator (as generators should not have __len__ method)
     :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param distance_cache: `DistanceCache` to reuse the distances computed in the previous runs from
     :param dtw_args: args to pass to dtw
     :param dtw_kwargs: kwargs to pass to dtw
     :return:
     """
 
-    three_dim_array = np.asarray(three_dim_array)
-    if n_processes is None:
-        n_processes = cpu_count()
-    else:
-        n_processes = int(n_processes)
-        if n_processes <= 0:
-            raise ValueError('N_processes should be > 0')
-        elif n_processes > cpu_count():
-            raise ValueError('The specified number of CPUs to use, {0} is greater than the number of available CPUs, {1}'
-            .format(n_processes, cpu_count()))
-
-    debug('Using {0} processes for parallel computation'.format(n_processes))
-
     # Create a shared memory array to store result
-    # Do not lock it as the worker should make sure processes do not overlap the data
+    # Do not lock it as the pool makes sure processes do not overlap the data
     result_buffer = Array(ctypes.c_double, n_operations, lock=False)
 
-    # Create a shared memory buffer for the data array
-    shape = three_dim_array.shape
-    data_buffer = Array(ctypes.c_double, np.product(shape), lock=False)  # Allocate memory
-    data_view = np.frombuffer(data_buffer).reshape(shape)  # Point numpy array to memory
-    data_view[:] = three_dim_array  # Copy the contents into the new memory location
-
-    number_of_slices = n_processes * 4
-
-    buffer_size, remainder = divmod(n_operations, number_of_slices)
+    if distance_cache is not None:
+        digests = [sequence_digest(dataset[i]) for i in xrange(len(dataset))]
+        # Make sure each of the processes opens its own connection
+        distance_cache.close()
+    else:
+        digests = None
 
-    scheduling_queue = Queue()
+    worker = partial(_parallel_dtw_worker, dataset, _operations_generator_factory, result_buffer, dtw_args, dtw_kwargs,
+                     distance_cache, digests)
+    pool = WorkerPool(worker, n_processes=n_processes)
 
     # Split the data in slices
-    for i in xrange(number_of_slices):
-        start = i * buffer_size
-        end = start + buffer_size
-        scheduling_queue.put((start, end))
-    if remainder:
-        last_start = number_of_slices * buffer_size
-        last_end = n_operations
-        scheduling_queue.put((last_start, last_end))
-
-    for i in xrange(n_processes):
-        scheduling_queue.put(None)  # Add stop items to the queue so we know when its empty for sure
-
-    # Create queue for exceptions
-    exception_queue = Queue()
-
-    processes = []
-    for i in xrange(n_processes):
-        p = Process(target=_parallel_dtw_worker,
-                    args=(data_buffer, _operations_generator_factory, shape, result_buffer, scheduling_queue,
-                          exception_queue, dtw_args, dtw_kwargs))
-        processes.append(p)
-
-    # Start all processes
-    for p in processes:
-        p.start()
+    slices = _split_into_slices(n_operations, pool.n_processes * 4)
 
-    # Join all processes
-    for p in processes:
-        p.join()
-
-    try:
-        exception = exception_queue.get(block=False)
-        raise exception
-    except Empty:
-        pass
+    with pool:
+        pool.map(slices)
 
     # Convert the result to numpy array in the end
     return np.frombuffer(result_buffer)
 
-def parallel_pdist(three_dim_array, n_processes=None, *dtw_args, **dtw_kwargs):
+def unique_sequences(dataset):
+    """
+    Finds the sequences in the dataset that are identical to each other.
+
+    :param dataset: `SharedDataset`
+    :return: `(representatives, inverse)` tuple, where `representatives` are the indices of the first occurrences
+             of each distinct sequence, and `inverse[i]` is the position in `representatives` of the sequence
+             identical to the i-th one.
+    """
+    digest_positions = {}
+    representatives = []
+    inverse = np.empty(len(dataset), dtype=int)
+    for i in xrange(len(dataset)):
+        digest = sequence_digest(dataset[i])
+        try:
+            inverse[i] = digest_positions[digest]
+        except KeyError:
+            digest_positions[digest] = inverse[i] = len(representatives)
+            representatives.append(i)
+
+    return np.array(representatives, dtype=int), inverse
+
+def parallel_pdist(three_dim_array, n_processes=None, distance_cache=None, deduplicate=False, *dtw_args, **dtw_kwargs):
     """
     Calculates pairwise DTW distance for all the rows in three_dim_array provided.
     This module is similar to scipy.spatial.distance.pdist, but uses all CPU cores available, rather than one.
-    :param three_dim_array: numpy data array [observations x max(sequence_lengths) x ndim ]
+    :param three_dim_array: numpy data array [observations x max(sequence_lengths) x ndim ] padded with NaNs,
+                            or a `SharedDataset` which will be used without copying the data again
     :param n_processes: number of processes to spawn usage to the number specified.
                         Will default to the number of (virtual) CPUs available if not set
+    :param distance_cache: `DistanceCache` to look the distances up in before computing them.
+                           The newly computed distances are added to it.
+    :param deduplicate: if set to true, the distances will be computed only once for each group of identical
+                        sequences, the distances within the group will be set to zero.
     :param dtw_args: `args` to be passed into `dtw_std`
-    :param dtw_kwargs: `kwargs` to be passed into `dtw_std`
+    :param dtw_kwargs: `kwargs` to be passed into `dtw_std`.
+                       The DTW costs are always computed without normalisation, if `normalise` is set they are
+                       normalised afterwards using `normalise_condensed_distances`.
     :return: condensed distance matrix (just as `scipy.spatial.distance.pdist`)
     """
-    three_dim_array = np.asarray(three_dim_array)
-    n_items = three_dim_array.shape[0]
-    number_of_combinations = combinations_count(n_items)
+    dataset = as_shared_dataset(three_dim_array)
 
-    return _parallel_dtw(three_dim_array, _pdist_operations_generator_factory, number_of_combinations,
-                         n_processes=n_processes, *dtw_args, **dtw_kwargs)
+    if deduplicate:
+        representatives, inverse = unique_sequences(dataset)
+        debug('{0} out of {1} sequences are unique'.format(len(representatives), len(dataset)))
+        unique_dataset = SharedDataset.from_sequences([dataset[i] for i in representatives])
+    else:
+        unique_dataset = dataset
 
+    number_of_combinations = combinations_count(len(unique_dataset))
 
-def _path_calculation_worker(data_buffer, shape, prototypes_buffer, prototypes_shape,
-                             scheduling_queue, results_queue, exception_queue,
-                             dtw_args, dtw_kwargs):
-    import sys
-    import traceback
-    import os
+    # Always compute the raw DTW costs, and normalise them afterwards if needed
+    normalise = dtw_kwargs.pop('normalise', False)
+    raw_distances = _parallel_dtw(unique_dataset, _pdist_operations_generator_factory, number_of_combinations,
+                                  n_processes=n_processes, distance_cache=distance_cache, *dtw_args, **dtw_kwargs)
 
-    try:
-        pid = os.getpid()
-        debug('PROCESS {0}: Spawned'.format(pid))
-        data_view = np.frombuffer(data_buffer).reshape(shape)  # Point numpy array to memory
+    if deduplicate:
+        raw_distances = subset_condensed_distances(raw_distances, inverse)
 
-        prototypes_view = np.frombuffer(prototypes_buffer).reshape(prototypes_shape)
-        answers = []
-        while True:
-            work_id = scheduling_queue.get()
-            if work_id is None:
-                break
-            data_i, base_i = work_id
-            x = data_view[data_i]
-            base = prototypes_view[base_i]
+    if normalise:
+        return normalise_condensed_distances(raw_distances, dataset.lengths)
+    else:
+        return raw_distances
 
-            _, _, path = dtw_std(x, base, dist_only=False, *dtw_args, **dtw_kwargs)
 
-            results_queue.put((work_id, path))
+def _pdist_update_operations_generator_factory(n_previous_items, indices):
+    # Same order as the condensed distance matrix, skipping the pairs of previous items
+    n_items = len(indices)
+    for i in xrange(n_items):
+        for j in xrange(max(i + 1, n_previous_items), n_items):
+            yield indices[i], indices[j]
 
-        debug('PROCESS {0}: finished computation'.format(pid))
-        debug('PROCESS {0}: finished'.format(pid))
+def parallel_pdist_update(three_dim_array, previous_distances, n_processes=None, distance_cache=None,
+                          *dtw_args, **dtw_kwargs):
+    """
+    Extends the condensed pairwise distance matrix of the first items in the dataset to all the items in it.
 
-    except Exception as e:
-        exception_queue.put(e)
-        traceback.print_exc()
-    except:
-        e = sys.exc_info()[0]
-        exception_queue.put(e)
-        traceback.print_exc()
+    Only the distances between the new items and the previous ones, and between the new items themselves are computed,
+    therefore adding `k` items to a dataset of `N` items requires `O(kN)` rather than `O(N^2)` DTW computations.
 
-def parallel_dtw_paths(full_data, nodes, n_processes=None, *dtw_args, **dtw_kwargs):
-    def _read_results_of_queue_till_empty(queue, ans_dict):
-        debug('Queue full, reading results till can proceed further')
-        number_of_answers = 0
-        while number_of_answers < 100:
-            try:
-                (i, j), ps = queue.get(block=False)
-            except Empty:
-                debug('Answers queue empty, continuing')
-                break
-            ans_dict[node_id_lookup[j]][data_index[i]] = ps
-            number_of_answers += 1
+    :param three_dim_array: numpy data array [observations x max(sequence_lengths) x ndim ] padded with NaNs,
+                            or a `SharedDataset`. The items the `previous_distances` were computed for must come first,
+                            in the same order.
+    :param previous_distances: condensed distance matrix of the first items in the dataset,
+                               computed with the same `dtw_args` and `dtw_kwargs`
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param distance_cache: `DistanceCache` to look the new distances up in before computing them
+    :param dtw_args: `args` to be passed into `dtw_std`
+    :param dtw_kwargs: `kwargs` to be passed into `dtw_std`
+    :return: condensed distance matrix of all the items in the dataset (just as `scipy.spatial.distance.pdist`)
+    """
+    dataset = as_shared_dataset(three_dim_array)
+    n_items = len(dataset)
+    n_previous_items = _items_count(previous_distances)
+    if n_previous_items > n_items:
+        raise ValueError('Previous distances were computed for {0} items, but the dataset has only {1}'
+                         .format(n_previous_items, n_items))
+
+    number_of_combinations = combinations_count(n_items) - combinations_count(n_previous_items)
+    debug('Computing {0} new pairwise distances for {1} new items'.format(number_of_combinations,
+                                                                           n_items - n_previous_items))
+
+    normalise = dtw_kwargs.pop('normalise', False)
+    lengths = dataset.lengths.astype(float)
+
+    factory = partial(_pdist_update_operations_generator_factory, n_previous_items)
+    new_distances = _parallel_dtw(dataset, factory, number_of_combinations,
+                                  n_processes=n_processes, distance_cache=distance_cache, *dtw_args, **dtw_kwargs)
+
+    # Interleave the previous and the new distances row by row
+    result = np.empty(combinations_count(n_items))
+    new_position = 0
+    for i in xrange(n_items - 1):
+        start = _condensed_row_start(i, n_items)
+        if i < n_previous_items:
+            n_previous_in_row = n_previous_items - i - 1
+            previous_start = _condensed_row_start(i, n_previous_items)
+            result[start:start + n_previous_in_row] = previous_distances[previous_start:
+                                                                         previous_start + n_previous_in_row]
+            start += n_previous_in_row
+
+        first_new = max(i + 1, n_previous_items)
+        n_new_in_row = n_items - first_new
+        result[start:start + n_new_in_row] = new_distances[new_position:new_position + n_new_in_row]
+        if normalise:
+            result[start:start + n_new_in_row] /= np.maximum(lengths[i], lengths[first_new:])
+        new_position += n_new_in_row
+
+    return result
+
+def _pdist_groups_operations_generator_factory(groups, indices):
+    # The condensed distance matrices of the groups, one after another
+    for group in groups:
+        for pair in itertools.combinations(group, 2):
+            yield pair
+
+def parallel_pdist_groups(three_dim_array, groups, n_processes=None, distance_cache=None, *dtw_args, **dtw_kwargs):
+    """
+    Calculates the pairwise DTW distances within each of the groups of items provided.
+
+    The distances of all the groups are computed by a single pool of processes,
+    so many small groups are processed in parallel, rather than one after another.
 
-        debug('Got {0} answers back'.format(number_of_answers))
-        return number_of_answers
+    :param three_dim_array: numpy data array [observations x max(sequence_lengths) x ndim ] padded with NaNs,
+                            or a `SharedDataset` which will be used without copying the data again
+    :param groups: list of lists of the positions of the items in each group
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param distance_cache: `DistanceCache` to look the distances up in before computing them
+    :param dtw_args: `args` to be passed into `dtw_std`
+    :param dtw_kwargs: `kwargs` to be passed into `dtw_std`, the costs are normalised afterwards if `normalise` is set
+    :return: list of condensed distance matrices of the groups, in the same order as the groups
+    """
+    dataset = as_shared_dataset(three_dim_array)
+    groups = [list(group) for group in groups]
+    group_sizes = [combinations_count(len(group)) for group in groups]
+    if sum(group_sizes) == 0:
+        return [np.empty(0) for _ in groups]
+
+    normalise = dtw_kwargs.pop('normalise', False)
+    factory = partial(_pdist_groups_operations_generator_factory, groups)
+    raw_distances = _parallel_dtw(dataset, factory, sum(group_sizes),
+                                  n_processes=n_processes, distance_cache=distance_cache, *dtw_args, **dtw_kwargs)
+
+    distances = np.split(raw_distances, np.cumsum(group_sizes)[:-1])
+    if normalise:
+        distances = [normalise_condensed_distances(group_distances, dataset.lengths[group])
+                     for group, group_distances in itertools.izip(groups, distances)]
+    return distances
+
+def _path_calculation_worker(dataset, prototypes, dtw_args, dtw_kwargs, work_ids):
+    """
+    Computes the DTW warping paths for the `(data_i, prototype_i)` pairs in `work_ids`.
 
+    :return: list of `((data_i, prototype_i), path)` tuples
+    """
+    answers = []
+    for work_id in work_ids:
+        data_i, base_i = work_id
+        x = dataset[data_i]
+        base = prototypes[base_i]
 
-    if n_processes is None:
-        n_processes = cpu_count()
-    else:
-        n_processes = int(n_processes)
-        if n_processes <= 0:
-            raise ValueError('N_processes should be > 0')
-        elif n_processes > cpu_count():
-            raise ValueError('The specified number of CPUs to use, {0} is greater than the number of available CPUs, {1}'
-            .format(n_processes, cpu_count()))
+        _, _, path = dtw_std(x, base, dist_only=False, *dtw_args, **dtw_kwargs)
+        answers.append((work_id, path))
 
-    debug('Using {0} processes for parallel computation'.format(n_processes))
+    return answers
 
-    max_prototype_len = 0
-    for node in nodes:
-        prototype_len = len(node.prototype)
-        if prototype_len > max_prototype_len:
-            max_prototype_len = prototype_len
-    ndims = full_data.values.shape[2]
-    nan = [np.nan] * ndims
-    prototypes = np.empty((len(nodes), max_prototype_len, ndims))
-    for i, node in enumerate(nodes):
-        prototype = node.prototype
-        prototype_len = len(prototype)
-        if prototype_len < max_prototype_len:
-            padding = np.asarray([nan] * (max_prototype_len - prototype_len))
-            padded_prototype = np.concatenate((prototype, padding))
-            prototypes[i] = padded_prototype
-        else:
-            prototypes[i] = prototype
+def parallel_dtw_paths(full_data, nodes, n_processes=None, *dtw_args, **dtw_kwargs):
+    """
+    Computes DTW warping paths between each of the items in the nodes provided and the prototypes of these nodes.
 
-    # Create shared memory buffer fro prototypes array
-    prototypes_shape = prototypes.shape
-    prototypes_buffer = Array(ctypes.c_double, np.product(prototypes_shape), lock=False)
-    prototypes_view = np.frombuffer(prototypes_buffer).reshape(prototypes_shape)
-    prototypes_view[:] = prototypes
+    :param full_data: `AlignmentsData` containing all the items in the nodes,
+                      or `SharedDataset` created from it (in which case the data is not copied again)
+    :param nodes: list of `DTWClusterNode` objects to compute the paths for
+    :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+    :param dtw_args: args to pass to dtw
+    :param dtw_kwargs: kwargs to pass to dtw
+    :return: dictionary of dictionaries {node.id: {item: path}}
+    """
+    if not nodes:
+        return {}
+
+    dataset = as_shared_dataset(full_data)
+    data_index = dataset.items
+    if data_index is None:
+        data_index = range(len(dataset))
+
+    # Pack the prototypes straight into shared memory
+    prototypes = SharedDataset.from_sequences([node.prototype for node in nodes])
 
     # Generate lookup for indices
-    data_index = full_data.items
     ix_lookup = {}
     for i, ix in enumerate(data_index):
         ix_lookup[ix] = i
@@ -290,83 +726,28 @@ def parallel_dtw_paths(full_data, nodes, n_processes=None, *dtw_args, **dtw_kwar
     for j, node in enumerate(nodes):
         node_id_lookup[j] = node.id
 
-    full_data = np.asarray(full_data)
-
-    # Create a shared memory buffer for the data array
-    shape = full_data.shape
-    data_buffer = Array(ctypes.c_double, np.product(shape), lock=False)  # Allocate memory
-    data_view = np.frombuffer(data_buffer).reshape(shape)  # Point numpy array to memory
-    data_view[:] = full_data  # Copy the contents into the new memory location
-
+    work_ids = []
+    for j, node in enumerate(nodes):
+        for ix in node.index:
+            work_ids.append((ix_lookup[ix], j))
 
-    answers_queue = Queue()
-    exception_queue = Queue()
+    worker = partial(_path_calculation_worker, dataset, prototypes, dtw_args, dtw_kwargs)
+    pool = WorkerPool(worker, n_processes=n_processes)
 
-    scheduling_queue = Queue()
-    processes = []
-    for i in xrange(n_processes):
-        p = Process(target=_path_calculation_worker,
-                    args=(data_buffer, shape, prototypes_buffer, prototypes_shape, scheduling_queue, answers_queue,
-                          exception_queue, dtw_args, dtw_kwargs))
-        processes.append(p)
+    # Keep the chunks small enough for the results to be sent back without too much memory overhead
+    chunk_size = max(1, min(1000, len(work_ids) / (pool.n_processes * 4)))
 
     # Buffer to store results
     paths = {}
     for node in nodes:
         paths[node.id] = {}
 
-    # Start all processes
-    for p in processes:
-        debug('Starting process')
-        p.start()
-
-    # Keep pushing things for the processes to work on
-    n_items = 0
+    with pool:
+        for chunk_start in xrange(0, len(work_ids), chunk_size):
+            pool.submit(chunk_start, work_ids[chunk_start:chunk_start + chunk_size])
 
-    number_of_answers = 0
-
-    for j, node in enumerate(nodes):
-        indices = node.index
-
-        for ix in indices:
-            while True:
-                try:
-                    scheduling_queue.put((ix_lookup[ix], j), block=False)
-                    n_items += 1
-                    break
-                except Full:
-                    # Whoops, our scheduling queue is full
-                    debug('Full at {0} sent'.format(n_items))
-                    number_of_answers += _read_results_of_queue_till_empty(answers_queue, paths)
-                    continue
-
-    # Stop all processes
-    for i in xrange(n_processes):
-        while True:
-            try:
-                scheduling_queue.put(None, block=False)
-                break
-            except Full:
-                debug('Full while sending the Nones')
-                number_of_answers += _read_results_of_queue_till_empty(answers_queue, paths)
-                continue
-
-    debug('Finished scheduling tasks, reading off results')
-    while number_of_answers < n_items:
-        (i, j), ps = answers_queue.get()
-        paths[node_id_lookup[j]][data_index[i]] = ps
-        number_of_answers += 1
-
-    # Join all processes
-    for p in processes:
-        debug('Joining process')
-        p.join()
-
-    debug('Checking exceptions')
-    try:
-        exception = exception_queue.get(block=False)
-        raise exception
-    except Empty:
-        pass
+        for _, answers in pool.completed():
+            for (i, j), path in answers:
+                paths[node_id_lookup[j]][data_index[i]] = path
 
-    return paths
\ No newline at end of file
+    return paths
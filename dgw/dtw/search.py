@@ -0,0 +1,147 @@
+"""
+Nearest neighbour search under Dynamic Time Warping.
+"""
+from functools import partial
+import heapq
+from logging import debug
+import numpy as np
+import pandas as pd
+
+from dgw.dtw.distance import dtw_std
+from dgw.dtw.lower_bounds import dtw_lower_bounds, bounding_boxes
+from dgw.dtw.parallel import WorkerPool
+from dgw.dtw.shared import as_shared_dataset
+
+__all__ = ['DTWIndex']
+
+def _search_worker(index, queries, k, exclude, query_ids):
+    results = []
+    for i in query_ids:
+        results.append((i, index._nearest(queries[i], k, exclude=exclude[i])))
+    return results
+
+class DTWIndex(object):
+    """
+    An index of the sequences in a dataset that answers "which k sequences are the most similar to this one" queries.
+
+    The lengths and bounding boxes of the sequences are computed once, when the index is created.
+    For each query, the sequences are visited in the increasing order of the lower bounds of their DTW distances
+    to it (see `dgw.dtw.lower_bounds.dtw_lower_bounds`), and the search is abandoned as soon as the next lower bound
+    is larger than the distance to the k-th closest sequence found so far.
+    The results are the same as if DTW was computed for all of the sequences in the dataset.
+    """
+    _dataset = None
+    _boxes = None
+    _dtw_kwargs = None
+
+    def __init__(self, data, **dtw_kwargs):
+        """
+        Creates an index of the data provided.
+
+        :param data: `AlignmentsData` to index, or `SharedDataset` created from it
+        :param dtw_kwargs: kwargs to pass to dtw, e.g. `Configuration.dtw_kwargs`
+        """
+        self._dataset = as_shared_dataset(data)
+        self._boxes = bounding_boxes(self._dataset)
+        self._dtw_kwargs = dtw_kwargs
+
+    @property
+    def items(self):
+        items = self._dataset.items
+        if items is None:
+            items = range(len(self._dataset))
+        return pd.Index(items)
+
+    @property
+    def dtw_kwargs(self):
+        return self._dtw_kwargs
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def _nearest(self, sequence, k, exclude=None):
+        """
+        Returns `(distance, position)` tuples of the `k` nearest sequences in increasing order of distance.
+        Ties are broken by position in the dataset.
+        """
+        dataset = self._dataset
+        dtw_kwargs = self._dtw_kwargs
+
+        bounds = dtw_lower_bounds(sequence, dataset, self._boxes, **dtw_kwargs)
+
+        # Max-heap of the k best (distance, position) pairs found so far, with the worst one at the top
+        heap = []
+        n_computed = 0
+        for position in np.argsort(bounds, kind='mergesort'):
+            if position == exclude:
+                continue
+            if len(heap) == k and bounds[position] > -heap[0][0]:
+                break
+
+            distance = dtw_std(sequence, dataset[position], dist_only=True, **dtw_kwargs)
+            n_computed += 1
+
+            entry = (-distance, -position)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+        debug('Computed {0} DTW distances out of {1}'.format(n_computed, len(dataset)))
+        return sorted([(-distance, -position) for distance, position in heap])
+
+    def _as_series(self, nearest):
+        items = self.items
+        return pd.Series([distance for distance, _ in nearest],
+                         index=items[[position for _, position in nearest]], name='distance')
+
+    def search(self, sequence, k=10, exclude=None):
+        """
+        Finds the `k` sequences in the index that are the closest to the sequence provided.
+
+        :param sequence: the query sequence
+        :param k: number of sequences to return
+        :param exclude: item of the index that should not be returned, e.g. the query itself
+        :return: `pd.Series` of the distances to the `k` closest items in increasing order, indexed by the items
+        """
+        if exclude is not None:
+            exclude = self.items.get_loc(exclude)
+
+        return self._as_series(self._nearest(sequence, k, exclude=exclude))
+
+    def search_many(self, queries, k=10, n_processes=None, exclude_self=False):
+        """
+        Finds the `k` closest sequences in the index for each of the queries, in parallel.
+
+        :param queries: `AlignmentsData` of the query sequences, or `SharedDataset` created from it
+        :param k: number of sequences to return for each of the queries
+        :param n_processes: number of processes to use (defaults to maximum number of CPU cores)
+        :param exclude_self: do not return the query itself, if it is one of the items in the index
+        :return: dictionary `{query_item: pd.Series}`, see `DTWIndex.search`
+        """
+        queries = as_shared_dataset(queries)
+        query_items = queries.items
+        if query_items is None:
+            query_items = range(len(queries))
+
+        if exclude_self:
+            exclude = [position if position >= 0 else None for position in self.items.get_indexer(query_items)]
+        else:
+            exclude = [None] * len(queries)
+
+        worker = partial(_search_worker, self, queries, k, exclude)
+        pool = WorkerPool(worker, n_processes=n_processes)
+
+        chunk_size = max(1, min(100, len(queries) / (pool.n_processes * 4)))
+        chunks = [range(start, min(start + chunk_size, len(queries))) for start in xrange(0, len(queries), chunk_size)]
+
+        answer = {}
+        with pool:
+            for chunk_results in pool.map(chunks):
+                for i, nearest in chunk_results:
+                    answer[query_items[i]] = self._as_series(nearest)
+
+        return answer
+
+    def __repr__(self):
+        return '<{0} of {1} sequences>'.format(self.__class__.__name__, len(self))
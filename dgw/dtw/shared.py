@@ -0,0 +1,268 @@
+from multiprocessing import Array
+import ctypes
+import os
+import numpy as np
+from dgw.dtw.utilities import _strip_nans
+
+__all__ = ['SharedDataset']
+
+def _lengths_filename(filename):
+    root, ext = os.path.splitext(filename)
+    return '{0}_lengths{1}'.format(root, ext or '.npy')
+
+class SharedDataset(object):
+    """
+    A dataset of sequences of varying length stored in memory that can be read by worker processes without copying it.
+
+    The sequences are stored back to back in a single `[sum(lengths) x n_datasets]` buffer, so no memory is spent on
+    padding the shorter sequences to the length of the longest one. `dataset[i]` returns an exact-length view of
+    the i-th sequence. `SharedDataset.take` returns views of a subset of the sequences in the same buffer.
+
+    The values are either stored in a shared memory buffer (see `SharedDataset.allocate`)
+    or in a read-only memory-mapped `.npy` file (see `SharedDataset.from_file`).
+    In both cases the processes forked after the dataset is created share the same physical memory pages.
+
+    The object is a drop-in replacement for the three-dimensional `[items x max_length x n_datasets]` NaN-padded arrays
+    that the functions in `dgw.dtw.parallel` take.
+    """
+    _values = None
+    _lengths = None
+    _offsets = None
+    _items = None
+
+    def __init__(self, values, lengths, items=None, offsets=None):
+        """
+        Initialises the dataset on the values provided. The values are not copied.
+        Use `SharedDataset.from_array`, `SharedDataset.from_sequences` or `SharedDataset.from_alignments`
+        to copy data into shared memory.
+
+        :param values: two-dimensional `[sum(lengths) x n_datasets]` array of concatenated sequences
+                       that is already in memory shared between processes
+        :param lengths: lengths of each of the sequences in `values`
+        :param items: labels of the items in the dataset, e.g. `AlignmentsData.items`
+        :param offsets: rows of `values` each of the sequences starts at. If not provided, the sequences are assumed
+                        to be stored back to back in the order of `lengths`, see `SharedDataset.take`
+        """
+        values = np.asarray(values)
+        if values.ndim != 2:
+            raise ValueError('Expected a two-dimensional array of values, got {0} dimensions'.format(values.ndim))
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if offsets is None:
+            if lengths.sum() != len(values):
+                raise ValueError('Sum of lengths {0} does not match the number of values {1}'.format(lengths.sum(),
+                                                                                                     len(values)))
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        else:
+            offsets = np.asarray(offsets, dtype=np.int64)
+            if len(offsets) != len(lengths):
+                raise ValueError('Number of offsets {0} does not match number of items {1}'.format(len(offsets),
+                                                                                                  len(lengths)))
+            if np.any(offsets < 0) or np.any(offsets + lengths > len(values)):
+                raise ValueError('Sequences do not fit into the {0} values provided'.format(len(values)))
+
+        self._values = values
+        self._lengths = lengths
+        self._offsets = offsets
+
+        if items is not None and len(items) != len(lengths):
+            raise ValueError('Number of item labels {0} does not match number of items {1}'.format(len(items),
+                                                                                                   len(lengths)))
+        self._items = items
+
+    @classmethod
+    def allocate(cls, lengths, ndim, items=None):
+        """
+        Allocates a new, NaN-filled, dataset for sequences of the specified lengths in shared memory.
+
+        :param lengths: lengths of the sequences that will be stored in the dataset
+        :param ndim: number of dimensions (datasets) in each sequence
+        :param items: labels of the items
+        :rtype: SharedDataset
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        shape = (int(lengths.sum()), int(ndim))
+        buffer_ = Array(ctypes.c_double, int(np.prod(shape)), lock=False)
+        values = np.frombuffer(buffer_).reshape(shape)
+        values[:] = np.nan
+
+        return cls(values, lengths, items=items)
+
+    @classmethod
+    def from_array(cls, array, items=None):
+        """
+        Copies the three-dimensional NaN-padded array provided into shared memory, removing the padding.
+
+        :param array: `[items x max_length x n_datasets]` array
+        :param items: labels of the items
+        :rtype: SharedDataset
+        """
+        array = np.asarray(array, dtype=float)
+        if array.ndim != 3:
+            raise ValueError('Expected a three-dimensional array, got {0} dimensions'.format(array.ndim))
+
+        not_padding = ~np.all(np.isnan(array), axis=2)
+        dataset = cls.allocate(not_padding.sum(axis=1), array.shape[2], items=items)
+
+        # Copy the non-padded rows straight into shared memory
+        np.compress(not_padding.ravel(), array.reshape(-1, array.shape[2]), axis=0, out=dataset.values)
+
+        if np.any(np.isnan(dataset.values)):
+            raise ValueError('Inconsistent NaNs between dimensions')
+
+        return dataset
+
+    @classmethod
+    def from_sequences(cls, sequences, items=None):
+        """
+        Copies the sequences provided into shared memory. NaN padding of the sequences is removed.
+
+        :param sequences: list of one or two-dimensional sequences, all with the same number of dimensions
+        :param items: labels of the items
+        :rtype: SharedDataset
+        """
+        sequences = [_strip_nans(np.asarray(sequence, dtype=float)) for sequence in sequences]
+        ndims = set([sequence.shape[1] if sequence.ndim > 1 else 1 for sequence in sequences])
+        if len(ndims) != 1:
+            raise ValueError('All sequences should have the same number of dimensions')
+
+        ndim = ndims.pop()
+        dataset = cls.allocate([len(sequence) for sequence in sequences], ndim, items=items)
+        for i, sequence in enumerate(sequences):
+            dataset[i][:] = sequence.reshape(-1, ndim)
+
+        return dataset
+
+    @classmethod
+    def from_alignments(cls, alignments_data):
+        """
+        Copies the `AlignmentsData` (or `pd.Panel`) provided into shared memory.
+
+        The underlying block of the panel is copied directly, without creating an intermediate copy of it first.
+        The panel itself still needs to be in memory, so the data is held twice afterwards.
+        Use `as_shared_dataset` to reuse the values `read_bam` reads into shared memory instead.
+
+        :param alignments_data: the data to copy
+        :type alignments_data: `dgw.data.containers.AlignmentsData`
+        :rtype: SharedDataset
+        """
+        return cls.from_array(alignments_data.values, items=alignments_data.items)
+
+    @classmethod
+    def from_file(cls, filename, items=None):
+        """
+        Memory-maps a dataset that was previously saved using `SharedDataset.save`.
+        The values are opened read-only, so they are never copied into the memory of the process.
+
+        :param filename: `.npy` file to read
+        :param items: labels of the items
+        :rtype: SharedDataset
+        """
+        return cls(np.load(filename, mmap_mode='r'), np.load(_lengths_filename(filename)), items=items)
+
+    def take(self, indices):
+        """
+        Returns the sequences at the positions provided, in that order.
+        The values are not copied, the new dataset is a view of the same (shared) memory.
+
+        :param indices: positions of the sequences to take
+        :rtype: SharedDataset
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        items = self._items
+        if items is not None:
+            items = items.take(indices) if hasattr(items, 'take') else np.take(items, indices)
+
+        return self.__class__(self._values, self._lengths[indices], items=items, offsets=self._offsets[indices])
+
+    def save(self, filename):
+        """
+        Saves the dataset to `.npy` file, so it can be memory-mapped using `SharedDataset.from_file`.
+        The lengths of the sequences are stored in a separate file next to it, with `_lengths` appended to its name.
+
+        :param filename:
+        """
+        values = self.values
+        if not self.is_compact:
+            # Store only the sequences of this view, back to back
+            compact_offsets = np.concatenate(([0], np.cumsum(self._lengths)[:-1]))
+            values = values[np.arange(self._lengths.sum()) + np.repeat(self._offsets - compact_offsets, self._lengths)]
+
+        np.save(filename, values)
+        np.save(_lengths_filename(filename), self.lengths)
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def lengths(self):
+        return self._lengths
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def is_compact(self):
+        """
+        True if the sequences are stored back to back in `values`, in the order of the dataset, with no other values
+        between them. Views returned by `SharedDataset.take` usually are not.
+        """
+        return self._lengths.sum() == len(self._values) and \
+               np.array_equal(self._offsets, np.concatenate(([0], np.cumsum(self._lengths)[:-1])))
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def ndim(self):
+        return self._values.shape[1]
+
+    @property
+    def max_length(self):
+        if len(self._lengths) == 0:
+            return 0
+        return int(self._lengths.max())
+
+    def as_padded(self):
+        """
+        Returns the dataset as a three-dimensional `[items x max_length x n_datasets]` array padded with NaNs.
+        """
+        padded = np.empty((len(self), self.max_length, self.ndim))
+        padded[:] = np.nan
+        for i in xrange(len(self)):
+            padded[i, :self._lengths[i]] = self[i]
+        return padded
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __getitem__(self, i):
+        offset = self._offsets[i]
+        return self._values[offset:offset + self._lengths[i]]
+
+    def __array__(self, *args, **kwargs):
+        return np.asarray(self.as_padded(), *args, **kwargs)
+
+    def __repr__(self):
+        return '<{0} of {1} sequences, {2} dimensions>'.format(self.__class__.__name__, len(self), self.ndim)
+
+
+def as_shared_dataset(data):
+    """
+    Returns the data as `SharedDataset`, copying it into shared memory only if it is not already there.
+
+    :param data: `SharedDataset`, `AlignmentsData`, `pd.Panel` or a three-dimensional NaN-padded array
+    :rtype: SharedDataset
+    """
+    if isinstance(data, SharedDataset):
+        return data
+    elif getattr(data, 'shared_dataset', None) is not None:
+        # `AlignmentsData` read directly into shared memory
+        return data.shared_dataset
+    elif hasattr(data, 'items') and hasattr(data, 'values'):
+        return SharedDataset.from_alignments(data)
+    else:
+        return SharedDataset.from_array(data)
@@ -7,7 +7,7 @@ import numpy as np
 from dgw.data.containers import AlignmentsData
 from dgw.dtw.scaling import uniform_scaling_to_length, uniform_shrinking_to_length
 from dgw.dtw.utilities import _strip_nans, no_nans_len
-from distance import dtw_std
+from distance import dtw_std, dtw_path_is_reversed
 
 
 def points_mapped_to(points_on_original_sequence, dtw_path, sequence_a=True):
@@ -24,10 +24,105 @@ def points_mapped_to(points_on_original_sequence, dtw_path, sequence_a=True):
     else:
         path_theirs, path_ours = dtw_path
 
-    indices = set()
-    for p in points_on_original_sequence:
-        indices.update(np.nonzero(path_ours == p)[0])
-    return path_theirs[sorted(indices)]
+    path_ours = np.asarray(path_ours)
+    path_theirs = np.asarray(path_theirs)
+
+    return path_theirs[np.in1d(path_ours, points_on_original_sequence)]
+
+def points_mapped_to_batch(points, dtw_paths, sequence_a=True):
+    """
+    Maps many sets of points through their DTW warping paths at once.
+    The result is the same as calling `points_mapped_to` for each of the sets of points and its path.
+
+    The points and the paths are concatenated, and each of them is offset by the position of its set times the
+    length of the longest sequence, so the points of all the sets are matched in a single `np.in1d` call.
+
+    :param points: list of arrays of indices of points on the original sequences
+    :param dtw_paths: DTW warping paths between `sequence_a` and `sequence_b`, in the same order as the points
+    :param sequence_a: whether the query points are on `sequence_a` or not. (Will swap sequences otherwise)
+    :return: list of arrays of the indices the points are mapped to, in the same order as the points
+    """
+    if len(points) != len(dtw_paths):
+        raise ValueError('Number of paths {0} does not match the number of sets of points {1}'.format(len(dtw_paths),
+                                                                                                   len(points)))
+    if not points:
+        return []
+
+    ours, theirs = (0, 1) if sequence_a else (1, 0)
+    points = [np.asarray(set_points, dtype=np.int64).ravel() for set_points in points]
+    # Negative indices are never on the paths, and would be confused with the points of the previous set
+    points = [set_points[set_points >= 0] for set_points in points]
+    path_ours = [np.asarray(path[ours], dtype=np.int64) for path in dtw_paths]
+
+    path_lengths = np.array([len(path) for path in path_ours], dtype=np.int64)
+    points_lengths = np.array([len(set_points) for set_points in points], dtype=np.int64)
+    set_ids = np.arange(len(points), dtype=np.int64)
+
+    path_ours = np.concatenate(path_ours)
+    path_theirs = np.concatenate([np.asarray(path[theirs]) for path in dtw_paths])
+    all_points = np.concatenate(points)
+
+    # Key the points by the set they belong to, so points of different sets never match
+    stride = max(path_ours.max() if len(path_ours) else 0, all_points.max() if len(all_points) else 0) + 1
+    path_set_ids = np.repeat(set_ids, path_lengths)
+    mapped = np.in1d(path_set_ids * stride + path_ours, np.repeat(set_ids, points_lengths) * stride + all_points)
+
+    counts = np.bincount(path_set_ids[mapped], minlength=len(points))
+    return np.split(path_theirs[mapped], np.cumsum(counts)[:-1])
+
+def compose_warping_paths(path_ab, path_bc):
+    """
+    Composes the DTW warping path between sequences a and b with the warping path between sequences b and c
+    to obtain an approximate warping path between sequences a and c without running DTW again.
+
+    The points of a and c are matched if they are both matched to some point of b.
+    Each point of c is then matched to a contiguous interval of points of a, which is thinned down so the result
+    is a valid warping path: it moves by at most one step in each of the sequences and prefers the diagonal moves.
+    If exactly one of the paths is reversed (see `dtw_path_is_reversed`), the resulting path is reversed as well.
+
+    :param path_ab: warping path between sequences a and b, as returned by `dtw_std`
+    :param path_bc: warping path between sequences b and c, as returned by `dtw_std`
+    :return: warping path between sequences a and c
+    """
+    a, b_ab = np.asarray(path_ab[0]), np.asarray(path_ab[1])
+    b_bc, c = np.asarray(path_bc[0]), np.asarray(path_bc[1])
+
+    len_a = a.max() + 1
+    len_b = max(b_ab.max(), b_bc.max()) + 1
+    len_c = c.max() + 1
+
+    reversed_ = dtw_path_is_reversed(path_ab) != dtw_path_is_reversed(path_bc)
+    if reversed_:
+        # Work in the coordinates of reversed a, so the intervals are non-decreasing
+        a = len_a - 1 - a
+
+    # Interval of a matched to each point of b
+    a_low_for_b = np.empty(len_b, dtype=a.dtype)
+    a_low_for_b.fill(len_a)
+    a_high_for_b = np.zeros(len_b, dtype=a.dtype)
+    np.minimum.at(a_low_for_b, b_ab, a)
+    np.maximum.at(a_high_for_b, b_ab, a)
+
+    # Interval of a matched to each point of c
+    low = np.empty(len_c, dtype=a.dtype)
+    low.fill(len_a)
+    high = np.zeros(len_c, dtype=a.dtype)
+    np.minimum.at(low, c, a_low_for_b[b_bc])
+    np.maximum.at(high, c, a_high_for_b[b_bc])
+
+    # Start each interval one step after the end of the previous one, if possible
+    start = low.copy()
+    start[1:] = np.maximum(low[1:], np.minimum(high[:-1] + 1, high[1:]))
+    counts = high - start + 1
+
+    composed_c = np.repeat(np.arange(len_c, dtype=c.dtype), counts)
+    composed_a = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+    composed_a = composed_a.astype(a.dtype)
+
+    if reversed_:
+        composed_a = len_a - 1 - composed_a
+
+    return composed_a, composed_c
 
 def dtw_projection(sequence, base_sequence, dtw_function=dtw_std, path=None):
     """
@@ -75,6 +170,60 @@ def dtw_projection(sequence, base_sequence, dtw_function=dtw_std, path=None):
 
     return current_average
 
+def dtw_projection_batch(sequences, base_sequence, paths):
+    """
+    Projects many sequences onto the same base sequence using their pre-computed DTW warping paths.
+    The result is the same as calling `dtw_projection` for each of the sequences,
+    but the sums and counts of the points mapped to each of the base locations are accumulated for all
+    the sequences at once.
+
+    :param sequences: three-dimensional `[items x length x n_datasets]` NaN-padded array of the sequences to project,
+                      e.g. `AlignmentsData.values`. Two-dimensional arrays are treated as one-dimensional sequences.
+    :param base_sequence: base sequence to project onto
+    :param paths: DTW warping paths between each of the sequences and the base sequence, in the same order as the
+                  sequences
+    :return: `[items x len(base_sequence) x n_datasets]` array of projections
+             (`[items x len(base_sequence)]` if `sequences` was two-dimensional)
+    """
+    sequences = np.asarray(sequences, dtype=float)
+    base_length = len(base_sequence)
+
+    one_dimensional = sequences.ndim == 2
+    if one_dimensional:
+        sequences = sequences.reshape(sequences.shape + (1,))
+
+    n_items, _, ndim = sequences.shape
+    if len(paths) != n_items:
+        raise ValueError('Number of paths {0} does not match the number of sequences {1}'.format(len(paths),
+                                                                                               n_items))
+
+    path_lengths = np.array([len(path[0]) for path in paths], dtype=int)
+    item_ids = np.repeat(np.arange(n_items), path_lengths)
+    if n_items:
+        path_other = np.concatenate([path[0] for path in paths]).astype(int)
+        path_base = np.concatenate([path[1] for path in paths]).astype(int)
+    else:
+        path_other = path_base = np.array([], dtype=int)
+
+    # Location of each of the path points in the flattened [items x base_length] output
+    targets = item_ids * base_length + path_base
+    values = sequences[item_ids, path_other]
+
+    size = n_items * base_length
+    counts = np.bincount(targets, minlength=size).astype(float)
+    sums = np.empty((size, ndim))
+    for dim in xrange(ndim):
+        sums[:, dim] = np.bincount(targets, weights=values[:, dim], minlength=size)
+
+    # Base locations no point is mapped to, e.g. the NaN padding of the base, become NaN
+    with np.errstate(invalid='ignore'):
+        projections = (sums / counts[:, np.newaxis]).reshape(n_items, base_length, ndim)
+
+    if one_dimensional:
+        projections = projections.reshape(n_items, base_length)
+
+    return projections
+
 def dtw_projection_multi(alignments, base, *args, **kwargs):
     """
     DTW Projects given alignments onto the given base
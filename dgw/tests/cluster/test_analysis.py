@@ -0,0 +1,327 @@
+import cPickle as pickle
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as hierarchy
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.cluster.analysis import HierarchicalClustering, parallel_prototypes, compute_paths, \
+    compute_paths_by_composition, LazyWarpingPaths, mean_prototypes, add_path_data
+from dgw.cluster.assignment import assign_to_clusters
+from dgw.data.containers import AlignmentsData
+from dgw.dtw import transformations
+from dgw.dtw.distance import dtw_std, warping_conservation_vector
+from dgw.dtw.parallel import parallel_pdist
+
+def sample_alignments_data(n_items=12, length=15, seed=42):
+    np.random.seed(seed)
+    values = np.random.rand(n_items, length, 2)
+    # Make the sequences different lengths
+    for i in xrange(n_items):
+        values[i, length - i % 5:] = np.nan
+    panel = pd.Panel(values, items=['item{0}'.format(i) for i in xrange(n_items)],
+                     minor_axis=['a', 'b'])
+    return AlignmentsData(panel, resolution=1)
+
+class TestPrototypes(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data()
+        self.linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+
+    def test_parallel_prototypes_same_as_serial(self):
+        hc = HierarchicalClustering(self.data, None, self.linkage, prototyping_method='standard')
+        averaging_func = lambda x, y, wx, wy: transformations.dtw_path_averaging(x, y, wx, wy)
+
+        prototypes = parallel_prototypes(self.linkage, self.data.values, averaging_func, n_processes=1)
+
+        n = len(self.data)
+        self.assertEqual(range(n, 2 * n - 1), sorted(prototypes.keys()))
+        for node in hc.tree_nodes_list[n:]:
+            assert_array_equal(node.prototype.values, prototypes[node.id])
+
+class TestCompactTree(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data()
+        self.linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, self.linkage, prototyping_method='mean')
+
+    def test_node_indices_are_leaves_under_the_node_in_dendrogram_order(self):
+        leaf_order = self.data.items[hierarchy.leaves_list(self.linkage)]
+        for node in self.hc.tree_nodes_list:
+            self.assertEqual(node.pre_order(lambda x: x.id), list(node.index))
+            # Index is a contiguous slice of the leaf order
+            start = list(leaf_order).index(node.index[0])
+            self.assertEqual(list(leaf_order[start:start + node.count]), list(node.index))
+
+    def test_mean_prototypes(self):
+        for node in self.hc.tree_nodes_list:
+            # Means are accumulated in a different order, so they are only equal up to rounding errors
+            assert_array_almost_equal(self.data.ix[node.index].mean().values, node.prototype.values)
+
+    def test_mean_prototypes_of_ragged_sequences_keep_full_length(self):
+        n = len(self.data)
+        prototypes = mean_prototypes(self.linkage, self.data.values)
+        self.assertEqual(n - 1, len(prototypes))
+        for prototype in prototypes:
+            self.assertEqual(self.data.values.shape[1:], prototype.shape)
+
+class TestCuts(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data(n_items=30)
+        self.linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, self.linkage, prototyping_method='mean')
+        # Thresholds in between the merge distances, so fcluster agrees on which side of the cut each merge is
+        distances = np.sort(self.linkage[:, 2])
+        self.thresholds = list((distances[:-1] + distances[1:]) / 2.0) + [distances[-1] + 1]
+
+    def _assert_same_partition(self, a, b):
+        self.assertEqual(len(set(a)), len(set(b)))
+        self.assertEqual(len(set(a)), len(set(zip(a, b))))
+
+    def test_cut_same_as_fcluster(self):
+        for t in self.thresholds:
+            assignments = self.hc.cut(t)
+            correct_ans = hierarchy.fcluster(self.linkage, t, criterion='distance')
+            self._assert_same_partition(correct_ans, assignments.flatten().values)
+            for i, cluster in enumerate(assignments):
+                self.assertTrue(cluster.dist < t)
+                self.assertEqual(set(self.data.items[assignments.flatten().values == i + 1]), set(cluster.index))
+
+    def test_flat_clusters_for_many_thresholds(self):
+        flat_clusters = self.hc.flat_clusters(thresholds=self.thresholds)
+        self.assertEqual(self.thresholds, list(flat_clusters.columns))
+        for t in self.thresholds:
+            assert_array_equal(self.hc.cut(t).flatten().values, flat_clusters[t].values)
+
+    def test_flat_clusters_for_many_cluster_counts(self):
+        flat_clusters = self.hc.flat_clusters(n_clusters=[1, 2, 5, 30])
+        for k in [1, 2, 5, 30]:
+            self.assertEqual(k, len(set(flat_clusters[k])))
+
+    def test_cut_and_resort_keeps_order_of_index(self):
+        index = self.data.items[::-1]
+        assignments = self.hc.cut_and_resort(self.thresholds[20], index)
+        for cluster in assignments:
+            self.assertEqual([ix for ix in index if ix in cluster.index], list(cluster.index))
+
+class TestAssignment(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data(n_items=12)
+        linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, linkage, prototyping_method='standard')
+        self.new_data = sample_alignments_data(n_items=10, seed=7)
+
+    def test_assigned_to_closest_prototype(self):
+        t = self.hc.distance_threshold_for_n_clusters(4)
+        prototypes = [cluster.prototype.values for cluster in self.hc.cut(t)]
+
+        assignments, paths = assign_to_clusters(self.hc, self.new_data, t, n_processes=1)
+        self.assertEqual(list(self.new_data.items), list(assignments.index))
+
+        for ix in self.new_data.items:
+            distances = [dtw_std(self.new_data.ix[ix].values, prototype) for prototype in prototypes]
+            self.assertEqual(np.argmin(distances) + 1, assignments['cluster'][ix])
+            self.assertAlmostEqual(min(distances), assignments['distance'][ix])
+            self.assertTrue(assignments['n_dtw_computed'][ix] <= len(prototypes))
+
+            _, _, path = dtw_std(self.new_data.ix[ix].values, prototypes[assignments['cluster'][ix] - 1],
+                                 dist_only=False)
+            assert_array_equal(path[0], paths[ix][0])
+            assert_array_equal(path[1], paths[ix][1])
+
+class TestPathComposition(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data()
+        linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, linkage, prototyping_method='standard')
+        self.n = len(self.data)
+
+    def test_exact_threshold_of_zero_gives_exact_paths(self):
+        nodes = self.hc.tree_nodes_list
+        exact = compute_paths(self.data, nodes, self.n, n_processes=1)
+        composed = compute_paths_by_composition(self.data, nodes, self.n, exact_threshold=0, n_processes=1)
+
+        self.assertEqual(sorted(exact.keys()), sorted(composed.keys()))
+        for node_id, node_paths in exact.iteritems():
+            for ix, path in node_paths.iteritems():
+                assert_array_equal(path[0], composed[node_id][ix][0])
+                assert_array_equal(path[1], composed[node_id][ix][1])
+
+    def test_composed_paths_cover_all_items_and_prototype(self):
+        nodes = self.hc.tree_nodes_list
+        composed = compute_paths_by_composition(self.data, nodes, self.n, n_processes=1)
+        lengths = self.data.lengths
+
+        for node in nodes[self.n:]:
+            self.assertEqual(set(node.index), set(composed[node.id].keys()))
+            for ix, path in composed[node.id].iteritems():
+                self.assertEqual(set(range(lengths[ix])), set(path[0]))
+                self.assertEqual(set(range(len(node.prototype))), set(path[1]))
+
+class TestWarpingConservation(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data()
+        linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, linkage, prototyping_method='standard')
+        self.n = len(self.data)
+        add_path_data(self.hc.tree_nodes_list, self.n,
+                      compute_paths(self.data, self.hc.tree_nodes_list, self.n, n_processes=1))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_conservation_data_same_as_for_individual_paths(self):
+        node = self.hc.tree_nodes_list[-1]
+        for ix in node.index:
+            assert_array_equal(warping_conservation_vector(node.warping_paths[ix]),
+                               node.warping_conservation_data.ix[ix].values)
+
+    def test_conserved_runs_written_to_file(self):
+        node = self.hc.tree_nodes_list[-1]
+        filename = os.path.join(self.directory, 'conservation.gz')
+        node.save_warping_conservation_data_to_file(filename)
+
+        f = gzip.open(filename)
+        try:
+            lines = f.readlines()[1:]
+        finally:
+            f.close()
+
+        conservation_data = node.warping_conservation_data
+        expected = np.zeros(conservation_data.shape)
+        for line in lines:
+            ix, start, end, value = line.split('\t')
+            row = conservation_data.index.get_loc(ix)
+            expected[row, int(start):int(end)] = float(value)
+            self.assertEqual(int(end) - int(start), float(value))
+
+        # Every run is written, including the ones that extend to the last bin
+        assert_array_equal(conservation_data.values, expected)
+
+class TestPointsOfInterest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = sample_alignments_data()
+        self.data.points_of_interest = {'item0': {'a': [0, 3, 3], 'b': [14]},
+                                        'item1': {'a': [2, 3]},
+                                        'item4': {'a': [], 'b': [0, 10]}}
+        linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.hc = HierarchicalClustering(self.data, None, linkage, prototyping_method='standard')
+        self.n = len(self.data)
+        add_path_data(self.hc.tree_nodes_list, self.n,
+                      compute_paths(self.data, self.hc.tree_nodes_list, self.n, n_processes=1))
+
+    def _naive_histogram(self, points_of_interest, number_of_bins, lengths=None):
+        histogram = {}
+        for ix, poi in points_of_interest.iteritems():
+            ratio = float(number_of_bins) / lengths[ix] if lengths is not None else 1
+            for poi_name, points in poi.iteritems():
+                current_histogram = histogram.setdefault(poi_name, np.zeros(number_of_bins))
+                for point in set(points):
+                    for rescaled_point in xrange(int(np.floor(point * ratio)), int(np.floor((point + 1) * ratio))):
+                        current_histogram[rescaled_point] += 1
+        return pd.DataFrame(histogram)
+
+    def test_points_of_interest_histogram(self):
+        root = self.hc.tree_nodes_list[-1]
+        correct_ans = self._naive_histogram(self.data.points_of_interest, max(self.data.lengths), self.data.lengths)
+        assert_array_equal(correct_ans.columns, root.points_of_interest_histogram.columns)
+        assert_array_equal(correct_ans.values, root.points_of_interest_histogram.values)
+
+    def test_tracked_points_histogram(self):
+        root = self.hc.tree_nodes_list[-1]
+        tracked_points = root.tracked_points_of_interest
+        for ix, poi in self.data.points_of_interest.iteritems():
+            path_item, path_prototype = root.warping_paths[ix]
+            for poi_name, points in poi.iteritems():
+                correct_points = [path_prototype[i] for i in xrange(len(path_item)) if path_item[i] in points]
+                assert_array_equal(correct_points, tracked_points[ix][poi_name])
+
+        correct_ans = self._naive_histogram(tracked_points, len(root.prototype))
+        assert_array_equal(correct_ans.values, root.tracked_points_histogram.values)
+
+class TestLazyWarpingPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = sample_alignments_data()
+        self.linkage = hierarchy.complete(parallel_pdist(self.data, n_processes=1))
+        self.n = len(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _hierarchical_clustering(self):
+        hc = HierarchicalClustering(self.data, None, self.linkage.copy(), prototyping_method='standard')
+        hc.lazy_warping_paths = LazyWarpingPaths(os.path.join(self.directory, 'paths'), {}, n_processes=1)
+        return hc
+
+    def test_paths_computed_on_demand_and_cached(self):
+        hc = self._hierarchical_clustering()
+        exact = compute_paths(self.data, hc.tree_nodes_list, self.n, n_processes=1)
+
+        node = hc.tree_nodes_list[-2]
+        cache_file = hc.lazy_warping_paths.filename(node)
+        self.assertFalse(os.path.exists(cache_file))
+
+        paths = node.warping_paths
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertEqual(sorted(exact[node.id].keys()), sorted(paths.keys()))
+        for ix, path in exact[node.id].iteritems():
+            assert_array_equal(path[0], paths[ix][0])
+            assert_array_equal(path[1], paths[ix][1])
+
+        # Only the requested node should have been computed
+        directory = hc.lazy_warping_paths.directory
+        self.assertEqual([os.path.basename(cache_file)],
+                         [filename for filename in os.listdir(directory) if filename.startswith('node-')])
+
+        # Replace the cached paths, so it can be seen whether they are read from the cache or computed again
+        cached_paths = {'cached': True}
+        f = open(cache_file, 'wb')
+        try:
+            pickle.dump(cached_paths, f)
+        finally:
+            f.close()
+
+        # A new session of the same run should read the paths from the cache
+        other_hc = self._hierarchical_clustering()
+        self.assertEqual(cached_paths, other_hc.tree_nodes_list[-2].warping_paths)
+
+        # A run with different DTW parameters should compute them again
+        other_hc = self._hierarchical_clustering()
+        other_hc.lazy_warping_paths = LazyWarpingPaths(directory, {'metric': 'euclidean'}, n_processes=1)
+        self.assertNotEqual(hc.lazy_warping_paths.fingerprint(hc), other_hc.lazy_warping_paths.fingerprint(other_hc))
+        recomputed_paths = other_hc.tree_nodes_list[-2].warping_paths
+        self.assertEqual(sorted(paths.keys()), sorted(recomputed_paths.keys()))
+
+    def test_cached_paths_discarded_when_tree_changes(self):
+        hc = self._hierarchical_clustering()
+        node = hc.tree_nodes_list[-2]
+        paths = node.warping_paths
+
+        f = open(hc.lazy_warping_paths.filename(node), 'wb')
+        try:
+            pickle.dump({'cached': True}, f)
+        finally:
+            f.close()
+
+        # Same data clustered with a different linkage method gives a different tree
+        self.linkage = hierarchy.average(parallel_pdist(self.data, n_processes=1))
+        other_hc = self._hierarchical_clustering()
+        other_node = other_hc.tree_nodes_list[-2]
+        self.assertNotEqual({'cached': True}, other_node.warping_paths)
+
+        # Resetting the cache discards everything computed for the previous run
+        other_hc.lazy_warping_paths.reset(hc)
+        self.assertEqual(['fingerprint'], os.listdir(hc.lazy_warping_paths.directory))
@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import fastcluster
+import scipy.cluster.hierarchy as hierarchy
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.cluster.coarse import coarsen, coarse_to_fine_linkage
+from dgw.dtw.parallel import parallel_pdist
+from dgw.dtw.shared import SharedDataset
+
+__author__ = 'saulius'
+
+class TestCoarsen(unittest.TestCase):
+
+    def test_bins_are_averaged(self):
+        a = np.arange(10, dtype=float).reshape(5, 2)
+        b = np.arange(6, dtype=float).reshape(3, 2) * 10
+        coarse = coarsen(SharedDataset.from_sequences([a, b]), 2)
+
+        assert_array_equal([3, 2], coarse.lengths)
+        assert_array_equal([[1, 2], [5, 6], [8, 9]], coarse[0])
+        assert_array_equal([[10, 20], [40, 50]], coarse[1])
+
+    def test_factor_of_one_keeps_data(self):
+        a = np.random.randn(7, 2)
+        coarse = coarsen(SharedDataset.from_sequences([a]), 1)
+        assert_array_almost_equal(a, coarse[0])
+
+class TestCoarseToFineLinkage(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = np.random.randn(20, 16, 2)
+        for i in xrange(20):
+            data[i, 16 - i % 5:] = np.nan
+        self.data = data
+        self.dataset = SharedDataset.from_array(data)
+
+    def test_single_group_same_as_complete_linkage(self):
+        linkage = coarse_to_fine_linkage(self.dataset, 4, 20, n_processes=1)
+        correct_linkage = fastcluster.complete(parallel_pdist(self.data, n_processes=1))
+
+        assert_array_almost_equal(correct_linkage[:, 2], linkage[:, 2])
+        assert_array_almost_equal(hierarchy.cophenet(correct_linkage), hierarchy.cophenet(linkage))
+
+    def test_groups_are_clustered_on_exact_distances(self):
+        linkage = coarse_to_fine_linkage(self.dataset, 4, 6, n_processes=1)
+        self.assertTrue(hierarchy.is_valid_linkage(linkage))
+        self.assertTrue(hierarchy.is_monotonic(linkage))
+
+        # The largest subtrees of at most 6 items are the groups, clustered on the exact distances
+        root = hierarchy.to_tree(linkage)
+        subtrees = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.count <= 6:
+                subtrees.append(node)
+            else:
+                stack.extend([node.left, node.right])
+
+        self.assertEqual(20, sum([node.count for node in subtrees]))
+        for node in subtrees:
+            if node.is_leaf():
+                continue
+            items = node.pre_order()
+            group_linkage = fastcluster.complete(parallel_pdist(self.data[items], n_processes=1))
+            self.assertAlmostEqual(group_linkage[-1, 2], node.dist)
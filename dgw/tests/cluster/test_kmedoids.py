@@ -0,0 +1,87 @@
+from itertools import combinations
+import unittest
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist, squareform
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.cluster.kmedoids import pam, clara, KMedoidsClustering
+from dgw.data.containers import AlignmentsData
+from dgw.dtw.distance import dtw_std, dtw_path_is_reversed, warping_conservation_vectors
+from dgw.dtw.transformations import dtw_projection
+
+__author__ = 'saulius'
+
+class TestPAM(unittest.TestCase):
+
+    def test_pam_finds_optimal_medoids_of_separated_groups(self):
+        np.random.seed(42)
+        centres = np.array([[0, 0], [10, 0], [0, 10]])
+        points = np.concatenate([centre + np.random.randn(5, 2) for centre in centres])
+        distance_matrix = squareform(pdist(points))
+
+        medoids, cost = pam(distance_matrix, 3)
+
+        costs = [(distance_matrix[:, list(candidate)].min(axis=1).sum(), list(candidate))
+                 for candidate in combinations(range(len(points)), 3)]
+        correct_cost, correct_medoids = min(costs)
+        self.assertEqual(correct_medoids, medoids)
+        self.assertAlmostEqual(correct_cost, cost)
+
+    def test_invalid_number_of_medoids(self):
+        self.assertRaises(ValueError, pam, np.zeros((3, 3)), 4)
+
+class TestKMedoidsClustering(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        values = np.random.rand(15, 12, 2)
+        values[5:10] += 3
+        for i in xrange(15):
+            values[i, 12 - i % 4:] = np.nan
+        panel = pd.Panel(values, items=['item{0}'.format(i) for i in xrange(15)], minor_axis=['a', 'b'])
+        self.data = AlignmentsData(panel, resolution=1)
+
+    def test_items_assigned_to_closest_medoids(self):
+        kmedoids = KMedoidsClustering(self.data, None, 3, sample_size=15, n_processes=1, random_state=0)
+
+        self.assertEqual(3, len(kmedoids))
+        self.assertEqual(15, kmedoids.cluster_sizes.sum())
+
+        medoid_values = [self.data.ix[medoid].dropna(how='all').values for medoid in kmedoids.medoids]
+        labels = kmedoids.flatten()
+        for item in self.data.items:
+            distances = [dtw_std(self.data.ix[item].dropna(how='all').values, medoid) for medoid in medoid_values]
+            self.assertEqual(np.argmin(distances) + 1, labels[item])
+
+        for number, cluster in enumerate(kmedoids, start=1):
+            self.assertEqual(sorted(labels[labels == number].index), sorted(cluster.index))
+            self.assertIn(cluster.medoid, cluster.index)
+            assert_array_equal(medoid_values[number - 1], cluster.prototype.values)
+            self.assertEqual(sorted(cluster.index), sorted(cluster.warping_paths.keys()))
+
+    def test_items_projected_onto_medoids(self):
+        kmedoids = KMedoidsClustering(self.data, None, 3, sample_size=15, n_processes=1, random_state=0)
+
+        for cluster in kmedoids:
+            self.assertFalse(cluster.is_leaf())
+            prototype = cluster.prototype.values
+            paths = cluster.warping_paths
+
+            projected_data = cluster.projected_data
+            self.assertEqual((len(cluster), len(prototype), 2), projected_data.values.shape)
+            for item in cluster.index:
+                correct_projection = dtw_projection(self.data.ix[item].values, prototype, path=paths[item])
+                assert_array_almost_equal(correct_projection, projected_data.ix[item].values)
+
+            correct_conservation = warping_conservation_vectors([paths[item] for item in cluster.index])
+            assert_array_almost_equal(correct_conservation, cluster.warping_conservation_data.values)
+
+            reversal_dictionary = cluster.reversal_dictionary
+            for item in cluster.index:
+                self.assertEqual(dtw_path_is_reversed(paths[item]), reversal_dictionary[item])
+
+    def test_clara_medoids_assigned_to_themselves(self):
+        medoids, assignments = clara(self.data, 2, n_samples=3, sample_size=6, n_processes=1, random_state=0)
+        self.assertEqual(2, len(medoids))
+        assert_array_equal([0, 1], assignments['prototype'].values[medoids])
+        assert_array_equal([0, 0], assignments['distance'].values[medoids])
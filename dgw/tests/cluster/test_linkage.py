@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fastcluster
+import scipy.cluster.hierarchy as hierarchy
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.cluster import linkage as linkage_module
+from dgw.cluster.linkage import nn_chain_linkage
+
+__author__ = 'saulius'
+
+class TestNNChainLinkage(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.distances = np.random.rand(300 * 299 / 2)
+
+    def _assert_same_linkage(self, correct_linkage, linkage):
+        assert_array_almost_equal(correct_linkage[:, 2], linkage[:, 2])
+        assert_array_equal(correct_linkage[:, 3], linkage[:, 3])
+        assert_array_almost_equal(hierarchy.cophenet(correct_linkage), hierarchy.cophenet(linkage))
+
+    def test_same_as_fastcluster(self):
+        for method in ['complete', 'average']:
+            linkage = nn_chain_linkage(self.distances, method=method, n_threads=2)
+            self._assert_same_linkage(getattr(fastcluster, method)(self.distances), linkage)
+
+    def test_same_as_fastcluster_in_many_blocks(self):
+        min_block_size = linkage_module.MIN_BLOCK_SIZE
+        linkage_module.MIN_BLOCK_SIZE = 7
+        try:
+            linkage = nn_chain_linkage(self.distances, n_threads=4)
+        finally:
+            linkage_module.MIN_BLOCK_SIZE = min_block_size
+        self._assert_same_linkage(fastcluster.complete(self.distances), linkage)
+
+    def test_in_place_on_memory_mapped_matrix(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'distances.npy')
+            np.save(filename, self.distances)
+            distances = np.load(filename, mmap_mode='r+')
+
+            linkage = nn_chain_linkage(distances, copy=False)
+            self._assert_same_linkage(fastcluster.complete(self.distances), linkage)
+            # The matrix was used as the working memory
+            self.assertFalse(np.array_equal(self.distances, np.load(filename)))
+            del distances
+        finally:
+            shutil.rmtree(directory)
+
+    def test_float32(self):
+        distances = self.distances.copy()
+        linkage = nn_chain_linkage(distances, copy=False, dtype=np.float32)
+        assert_array_equal(self.distances, distances)
+        assert_array_almost_equal(fastcluster.complete(self.distances)[:, 2], linkage[:, 2], decimal=6)
+
+    def test_unsupported_method(self):
+        self.assertRaises(ValueError, nn_chain_linkage, self.distances, method='ward')
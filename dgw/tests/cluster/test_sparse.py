@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+import fastcluster
+import scipy.cluster.hierarchy as hierarchy
+from scipy.spatial.distance import squareform
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.cluster.sparse import knn_distances, sparse_single_linkage
+from dgw.dtw.distance import dtw_std
+from dgw.dtw.parallel import parallel_pdist
+from dgw.dtw.shared import SharedDataset
+
+__author__ = 'saulius'
+
+class TestKNNDistances(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = np.random.randn(15, 12, 2)
+        for i in xrange(15):
+            data[i, 12 - i % 4:] = np.nan
+        self.data = data
+        self.dataset = SharedDataset.from_array(data, items=['r{0}'.format(i) for i in xrange(15)])
+
+    def test_edges_are_to_nearest_neighbours(self):
+        k = 3
+        rows, cols, distances = knn_distances(self.dataset, k, n_processes=1)
+
+        full = squareform(parallel_pdist(self.data, n_processes=1))
+        edges = set(zip(rows, cols))
+        self.assertEqual(len(edges), len(rows))
+        self.assertTrue(np.all(rows < cols))
+
+        for i in xrange(len(self.data)):
+            others = [j for j in np.argsort(full[i], kind='mergesort') if j != i]
+            for j in others[:k]:
+                self.assertIn((min(i, j), max(i, j)), edges)
+
+        for row, col, distance in zip(rows, cols, distances):
+            self.assertAlmostEqual(dtw_std(self.data[row], self.data[col]), distance)
+
+class TestSparseSingleLinkage(unittest.TestCase):
+
+    def test_full_graph_same_as_single_linkage(self):
+        np.random.seed(42)
+        dm = np.random.rand(45)
+        rows, cols = np.triu_indices(10, 1)
+        # Condensed matrix lists the pairs in the same order as triu_indices
+        linkage = sparse_single_linkage(10, rows, cols, dm)
+        correct_linkage = fastcluster.single(dm)
+
+        assert_array_equal(correct_linkage[:, 2], linkage[:, 2])
+        assert_array_almost_equal(hierarchy.cophenet(correct_linkage), hierarchy.cophenet(linkage))
+
+    def test_disconnected_components_joined_at_the_top(self):
+        rows = [0, 2, 3]
+        cols = [1, 3, 4]
+        distances = [1.0, 2.0, 0.5]
+        linkage = sparse_single_linkage(5, rows, cols, distances)
+
+        self.assertTrue(hierarchy.is_valid_linkage(linkage))
+        assert_array_equal([0.5, 1.0, 2.0, 4.0], linkage[:, 2])
+        self.assertEqual(5, linkage[-1, 3])
+        assert_array_equal([1, 1, 2, 2, 2], hierarchy.fcluster(linkage, 3.0, criterion='distance'))
@@ -1,9 +1,16 @@
 from dgw.data.parsers import bam as bam_parser
+from dgw.data.parsers.filters import HighestPileUpFilter
+from dgw.data.containers import Regions
 
 __author__ = 'saulius'
+import os
+import shutil
+import tempfile
 import unittest
 from numpy.testing import *
 import numpy as np
+import pandas as pd
+import pysam
 
 # -- Stub classes to simulate pysam behaviour ---
 class StubAlignedRead(object):
@@ -198,5 +205,122 @@ class TestReadCountForRegionReading(unittest.TestCase):
         self.assertRaises(ValueError, bam_parser._read_samfile_region, self.samfile, 'chr1', -20, 20, resolution=4, extend_to=15)
         self.assertRaises(ValueError, bam_parser._read_samfile_region, self.samfile, 'chr1', 10, 60, resolution=4, extend_to=15)
 
+class TestSweepReading(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        aligned_reads = [StubAlignedRead(int(pos), int(alen), bool(is_reverse))
+                         for pos, alen, is_reverse in zip(np.random.randint(0, 450, 100),
+                                                          np.random.randint(5, 15, 100),
+                                                          np.random.rand(100) < 0.5)]
+        self.samfile = StubSamfile(sorted(aligned_reads, key=lambda read: read.pos), ['chr1'], [500])
+
+    def test_sweep_chunks_group_overlapping_windows(self):
+        starts = np.array([0, 10, 40, 100, 120])
+        ends = np.array([20, 30, 60, 110, 200])
+
+        self.assertEqual([[0, 1], [2], [3], [4]], bam_parser._sweep_chunks(starts, ends, None))
+        self.assertEqual([[0, 1, 2], [3, 4]], bam_parser._sweep_chunks(starts, ends, 10))
+        self.assertEqual([[0, 1, 2], [3], [4]], bam_parser._sweep_chunks(starts, ends, 10, max_length=100))
+
+    def test_same_as_reading_regions_one_by_one(self):
+        starts = np.random.randint(0, 400, 30)
+        ends = starts + 5 * np.random.randint(1, 20, 30)
+
+        for extend_to in [None, 15]:
+            counts = bam_parser._read_samfile_regions(self.samfile, 'chr1', starts, ends, resolution=5,
+                                                      extend_to=extend_to)
+            for start, end, region_counts in zip(starts, ends, counts):
+                correct = bam_parser._read_samfile_region(self.samfile, 'chr1', start, end, resolution=5,
+                                                          extend_to=extend_to)
+                assert_array_equal(correct, region_counts)
+
+class TestBinnedReadCounts(unittest.TestCase):
+
+    def test_same_as_adding_reads_one_by_one(self):
+        np.random.seed(42)
+        starts = np.random.randint(0, 200, 100)
+        ends = starts + np.random.randint(1, 50, 100)
+        start, data_len, resolution = 30, 20, 7
+
+        correct = np.zeros(data_len)
+        for alignment_start, alignment_end in zip(starts, ends):
+            if alignment_end < start:
+                # Such reads are never fetched
+                continue
+            start_bin = max(0, (alignment_start - start) // resolution)
+            end_bin = min(data_len - 1, (alignment_end - start - 1) // resolution)
+            correct[start_bin:end_bin + 1] += 1
+
+        assert_array_equal(correct, bam_parser._binned_read_counts(starts, ends, start, data_len, resolution))
+
+    def test_no_reads(self):
+        empty = np.array([], dtype=int)
+        assert_array_equal(np.zeros(5), bam_parser._binned_read_counts(empty, empty, 0, 5, 10))
+
+
+class TestParallelReading(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.directory = tempfile.mkdtemp()
+
+        chromosome_lengths = [('chr1', 20000), ('chr2', 10000)]
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                  'SQ': [{'SN': chromosome, 'LN': length} for chromosome, length in chromosome_lengths]}
+
+        self.filenames = []
+        for name in ['a.bam', 'b.bam']:
+            filename = os.path.join(self.directory, name)
+            samfile = pysam.Samfile(filename, 'wb', header=header)
+            for tid, (_, length) in enumerate(chromosome_lengths):
+                for i, pos in enumerate(np.sort(np.random.randint(0, length - 36, 400))):
+                    read = pysam.AlignedRead()
+                    read.qname = 'read{0}'.format(i)
+                    read.seq = 'A' * 36
+                    read.qual = 'I' * 36
+                    read.flag = 16 if np.random.rand() < 0.5 else 0
+                    read.tid = tid
+                    read.pos = int(pos)
+                    read.mapq = 30
+                    read.cigar = [(0, 36)]
+                    samfile.write(read)
+            samfile.close()
+            pysam.index(filename)
+            self.filenames.append(filename)
+
+        # Regions on both chromosomes, in no particular order, and one on a chromosome that is not in the files
+        chromosomes = ['chr1'] * 8 + ['chr2'] * 6 + ['chr3']
+        starts = [np.random.randint(0, 19000) if chromosome == 'chr1' else np.random.randint(0, 9000)
+                  for chromosome in chromosomes]
+        self.regions = Regions(pd.DataFrame({'chromosome': chromosomes,
+                                             'start': starts,
+                                             'end': np.array(starts) + 1000,
+                                             'strand': np.random.choice(['+', '-'], len(chromosomes))},
+                                            index=['region{0}'.format(i) for i in np.random.permutation(15)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_as_serial_reading(self):
+        for reverse in [False, True]:
+            kwargs = dict(data_filters=[HighestPileUpFilter(10)], output_removed_indices=True,
+                          reverse_negative_strand_regions=reverse)
+            data, missing, filtered = bam_parser.read_bam(self.filenames, self.regions, n_processes=1, **kwargs)
+            # n_processes=None reads the shards in the pool of processes, regardless of the number of CPUs
+            pooled_data, pooled_missing, pooled_filtered = bam_parser.read_bam(self.filenames, self.regions,
+                                                                               n_processes=None, **kwargs)
+
+            self.assertEqual(list(data.items), list(pooled_data.items))
+            assert_array_equal(data.values, pooled_data.values)
+            self.assertEqual(list(data.dataset_axis), list(pooled_data.dataset_axis))
+            self.assertEqual(sorted(missing), sorted(pooled_missing))
+            self.assertEqual(sorted(filtered), sorted(pooled_filtered))
+
+            # Make sure the regions of both chromosomes were read, and the filter removed some of them
+            self.assertEqual(1, len(missing))
+            self.assertTrue(len(filtered) > 0)
+            self.assertEqual(set(['chr1', 'chr2']), set(self.regions.ix[data.items].chromosome))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from scipy.spatial.distance import pdist
+import numpy as np
+from numpy.testing import assert_array_equal
+from dgw.dtw.cache import DistanceCache, sequence_digest
+from dgw.dtw.distance import dtw_std
+from dgw.dtw.parallel import parallel_pdist
+
+class TestDistanceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.sqlite')
+
+        np.random.seed(42)
+        self.sample_data = np.random.randn(10, 20)
+        self.sample_data_three_dim = self.sample_data.reshape(10, 20, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_does_not_depend_on_order(self):
+        a = sequence_digest(self.sample_data[0])
+        b = sequence_digest(self.sample_data[1])
+        prefix = DistanceCache.key_prefix([], {'metric': 'sqeuclidean'})
+        self.assertEqual(DistanceCache.key(prefix, a, b), DistanceCache.key(prefix, b, a))
+
+        other_prefix = DistanceCache.key_prefix([], {'metric': 'euclidean'})
+        self.assertNotEqual(DistanceCache.key(prefix, a, b), DistanceCache.key(other_prefix, a, b))
+
+    def test_store_and_lookup(self):
+        cache = DistanceCache(self.filename)
+        cache.store([('a', 1.0), ('b', 2.0)])
+        cache.store([('a', 3.0)])  # Should be ignored
+
+        # Reopen the file to make sure the data is persisted
+        cache = DistanceCache(self.filename)
+        self.assertEqual({'a': 1.0, 'b': 2.0}, cache.lookup(['a', 'b', 'c']))
+        self.assertEqual(2, len(cache))
+
+    def test_pdist_with_cache_same_as_without(self):
+        correct_ans = pdist(self.sample_data, dtw_std)
+        cache = DistanceCache(self.filename)
+
+        assert_array_equal(correct_ans, parallel_pdist(self.sample_data_three_dim, n_processes=1,
+                                                       distance_cache=cache))
+        self.assertEqual(len(correct_ans), len(cache))
+
+        # Second run should give the same results from the cache
+        assert_array_equal(correct_ans, parallel_pdist(self.sample_data_three_dim, n_processes=1,
+                                                       distance_cache=cache))
+
+    def test_pdist_uses_cached_distances(self):
+        cache = DistanceCache(self.filename)
+        digests = [sequence_digest(x.reshape(-1, 1)) for x in self.sample_data]
+        prefix = cache.key_prefix([], {})
+        cache.store([(cache.key(prefix, digests[0], digests[1]), -1.0)])
+
+        ans = parallel_pdist(self.sample_data_three_dim, n_processes=1, distance_cache=cache)
+        self.assertEqual(-1.0, ans[0])
+        self.assertEqual(dtw_std(self.sample_data[0], self.sample_data[2]), ans[1])
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+from dgw.dtw.distance import dtw_std
+from dgw.dtw.lower_bounds import dtw_lower_bounds
+
+__author__ = 'saulius'
+
+class TestDTWLowerBounds(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.candidates = [np.random.randn(length, 2) for length in [1, 5, 12, 20, 30]]
+        self.sequences = [np.random.randn(length, 2) for length in [1, 7, 20, 25]]
+
+    def _assert_bounds_hold(self, **dtw_kwargs):
+        for sequence in self.sequences:
+            bounds = dtw_lower_bounds(sequence, self.candidates, **dtw_kwargs)
+            distances = [dtw_std(sequence, candidate, **dtw_kwargs) for candidate in self.candidates]
+            self.assertTrue(np.all(bounds <= np.asarray(distances) + 1e-9), (dtw_kwargs, bounds, distances))
+
+    def test_bounds_hold_for_all_metrics(self):
+        for metric in ['sqeuclidean', 'euclidean', 'cosine']:
+            for try_reverse in [False, True]:
+                self._assert_bounds_hold(metric=metric, try_reverse=try_reverse)
+
+    def test_bounds_hold_with_normalisation_and_constraints(self):
+        self._assert_bounds_hold(normalise=True)
+        self._assert_bounds_hold(constraint='slanted_band', k=2, warping_penalty=0.5)
+        self._assert_bounds_hold(metric='euclidean', scale_first=True, normalise=True)
+
+    def test_bounds_are_not_trivial(self):
+        bounds = dtw_lower_bounds(self.candidates[3] + 10, self.candidates)
+        self.assertTrue(np.all(bounds > 0))
+
+    def test_nan_padding_is_ignored(self):
+        padded = np.vstack((self.sequences[1], np.nan * np.ones((5, 2))))
+        np.testing.assert_array_equal(dtw_lower_bounds(self.sequences[1], self.candidates),
+                                      dtw_lower_bounds(padded, self.candidates))
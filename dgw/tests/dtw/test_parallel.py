@@ -1,10 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
-from scipy.spatial.distance import pdist
+from scipy.spatial.distance import pdist, squareform
 import numpy as np
 from dgw.dtw.distance import dtw_std
-from dgw.dtw.parallel import parallel_pdist
+from multiprocessing import Value
+from dgw.dtw.parallel import parallel_pdist, parallel_dtw_paths, WorkerPool, parallel_pdist_update, \
+    subset_condensed_distances, normalise_condensed_distances, unique_sequences, parallel_pdist_groups
+from dgw.dtw.shared import SharedDataset
 from itertools import combinations
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 __author__ = 'saulius'
 
@@ -49,3 +55,173 @@ class TestParallelPdist(unittest.TestCase):
 
 
 
+
+    def test_shared_dataset_gives_same_result(self):
+        correct_ans = pdist(self.sample_data, dtw_std)
+        parallel_ans = parallel_pdist(SharedDataset.from_array(self.sample_data_three_dim), n_processes=1)
+        assert_array_equal(correct_ans, parallel_ans)
+
+    def test_memory_mapped_shared_dataset_gives_same_result(self):
+        correct_ans = pdist(self.sample_data, dtw_std)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'dataset.npy')
+            SharedDataset.from_array(self.sample_data_three_dim).save(filename)
+            parallel_ans = parallel_pdist(SharedDataset.from_file(filename), n_processes=1)
+        finally:
+            shutil.rmtree(directory)
+
+        assert_array_equal(correct_ans, parallel_ans)
+
+class TestDeduplicatedPdist(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = np.random.randn(8, 15, 2)
+        self.data[1, 10:] = np.nan
+        self.data[3] = self.data[1]
+        self.data[5] = self.data[0]
+        self.data[7] = self.data[1]
+
+    def test_unique_sequences(self):
+        representatives, inverse = unique_sequences(SharedDataset.from_array(self.data))
+        assert_array_equal([0, 1, 2, 4, 6], representatives)
+        assert_array_equal([0, 1, 2, 1, 3, 0, 4, 1], inverse)
+
+    def test_deduplicated_pdist_same_as_full(self):
+        for normalise in [False, True]:
+            correct_ans = parallel_pdist(self.data, n_processes=1, normalise=normalise)
+            ans = parallel_pdist(self.data, n_processes=1, deduplicate=True, normalise=normalise)
+            # Pairs might be computed in different order, DTW is only symmetric up to rounding errors
+            assert_array_almost_equal(correct_ans, ans)
+
+class TestNormalisedDistances(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.data = np.random.randn(8, 15, 2)
+        self.data[1, 10:] = np.nan
+        self.data[4, 5:] = np.nan
+        self.data[6, 12:] = np.nan
+
+    def test_normalised_pdist_same_as_dtw_std_normalised(self):
+        correct_ans = np.array([dtw_std(x, y, normalise=True) for x, y in combinations(self.data, 2)])
+        parallel_ans = parallel_pdist(self.data, n_processes=1, normalise=True)
+        assert_array_equal(correct_ans, parallel_ans)
+
+    def test_normalise_condensed_distances(self):
+        raw = parallel_pdist(self.data, n_processes=1)
+        lengths = SharedDataset.from_array(self.data).lengths
+        correct_ans = np.array([dtw_std(x, y, normalise=True) for x, y in combinations(self.data, 2)])
+        assert_array_equal(correct_ans, normalise_condensed_distances(raw, lengths))
+
+    def test_normalised_update_same_as_full_pdist(self):
+        correct_ans = parallel_pdist(self.data, n_processes=1, normalise=True)
+        previous = parallel_pdist(self.data[:5], n_processes=1, normalise=True)
+        ans = parallel_pdist_update(self.data, previous, n_processes=1, normalise=True)
+        assert_array_equal(correct_ans, ans)
+
+    def test_pdist_of_groups_same_as_pdist_of_each_group(self):
+        groups = [[0, 4, 6], [7, 1], [2], [5, 3]]
+        for normalise in [False, True]:
+            ans = parallel_pdist_groups(self.data, groups, n_processes=1, normalise=normalise)
+            self.assertEqual(len(groups), len(ans))
+            for group, group_ans in zip(groups, ans):
+                assert_array_equal(parallel_pdist(self.data[group], n_processes=1, normalise=normalise), group_ans)
+
+class TestParallelPdistUpdate(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.sample_data = np.random.randn(10, 20)
+        self.sample_data_three_dim = self.sample_data.reshape(10, 20, 1)
+
+    def test_update_same_as_full_pdist(self):
+        correct_ans = pdist(self.sample_data, dtw_std)
+        for n_previous in [0, 1, 2, 7, 10]:
+            previous = pdist(self.sample_data[:n_previous], dtw_std)
+            ans = parallel_pdist_update(self.sample_data_three_dim, previous, n_processes=1)
+            assert_array_equal(correct_ans, ans)
+
+    def test_update_does_not_recompute_previous_distances(self):
+        previous = np.arange(1, 22, dtype=float)  # 7 items
+        ans = squareform(parallel_pdist_update(self.sample_data_three_dim, previous, n_processes=1))
+        assert_array_equal(squareform(previous), ans[:7, :7])
+
+    def test_subset_condensed_distances_with_repeats(self):
+        dm = pdist(self.sample_data)
+        indices = [7, 2, 7, 3, 2]
+        correct_ans = squareform(squareform(dm)[indices][:, indices], checks=False)
+        assert_array_equal(correct_ans, subset_condensed_distances(dm, indices))
+
+    def test_subset_condensed_distances(self):
+        dm = pdist(self.sample_data)
+        indices = [7, 2, 3, 9]
+        correct_ans = squareform(squareform(dm)[indices][:, indices])
+        assert_array_equal(correct_ans, subset_condensed_distances(dm, indices))
+
+class StubNode(object):
+    def __init__(self, id, index, prototype):
+        self.id = id
+        self.index = index
+        self.prototype = prototype
+
+class TestParallelDTWPaths(unittest.TestCase):
+
+    def test_paths_same_as_sequential(self):
+        np.random.seed(42)
+        data = np.random.randn(6, 10, 2)
+        data[3, 7:] = np.nan
+        dataset = SharedDataset.from_array(data, items=['a', 'b', 'c', 'd', 'e', 'f'])
+
+        nodes = [StubNode(6, ['a', 'b', 'd'], np.random.randn(8, 2)),
+                 StubNode(7, ['c', 'e', 'f'], np.random.randn(10, 2))]
+
+        paths = parallel_dtw_paths(dataset, nodes, n_processes=1)
+
+        for node in nodes:
+            self.assertEqual(set(node.index), set(paths[node.id].keys()))
+            for ix in node.index:
+                _, _, correct_path = dtw_std(data[dataset.items.index(ix)], node.prototype, dist_only=False)
+                assert_array_equal(correct_path[0], paths[node.id][ix][0])
+                assert_array_equal(correct_path[1], paths[node.id][ix][1])
+
+def _square_crashing_first_time(crash_counter, x):
+    # Simulate a process getting killed the first time it sees chunk 3
+    if x == 3 and crash_counter.value == 0:
+        crash_counter.value += 1
+        os._exit(1)
+    return x * x
+
+def _always_crash(x):
+    os._exit(1)
+
+def _raise_error(x):
+    raise ValueError('Bad chunk {0}'.format(x))
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_map_returns_results_in_order(self):
+        with WorkerPool(abs, n_processes=1) as pool:
+            self.assertEqual([1, 2, 3, 0], pool.map([-1, 2, -3, 0]))
+
+    def test_chunk_is_retried_after_process_dies(self):
+        crash_counter = Value('i', 0)
+        worker = lambda x: _square_crashing_first_time(crash_counter, x)
+
+        with WorkerPool(worker, n_processes=1, poll_interval=0.1) as pool:
+            result = pool.map(range(6))
+
+        self.assertEqual(1, crash_counter.value)
+        self.assertEqual([0, 1, 4, 9, 16, 25], result)
+
+    def test_gives_up_after_max_retries(self):
+        pool = WorkerPool(_always_crash, n_processes=1, max_retries=2, poll_interval=0.1)
+        with pool:
+            self.assertRaises(RuntimeError, pool.map, [1, 2])
+
+    def test_exceptions_are_reraised(self):
+        pool = WorkerPool(_raise_error, n_processes=1)
+        with pool:
+            self.assertRaises(ValueError, pool.map, [1, 2])
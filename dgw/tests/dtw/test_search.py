@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from dgw.dtw.distance import dtw_std
+from dgw.dtw.search import DTWIndex
+from dgw.dtw.shared import SharedDataset
+
+__author__ = 'saulius'
+
+class TestDTWIndex(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        data = np.random.randn(40, 20, 2)
+        for i in xrange(40):
+            data[i, 20 - i % 7:] = np.nan
+        self.data = data
+        self.items = ['r{0}'.format(i) for i in xrange(40)]
+        self.dataset = SharedDataset.from_array(data, items=self.items)
+
+    def _brute_force(self, query, k, exclude=None, **dtw_kwargs):
+        distances = [(dtw_std(query, sequence, **dtw_kwargs), i) for i, sequence in enumerate(self.data)
+                     if i != exclude]
+        return sorted(distances)[:k]
+
+    def test_search_same_as_brute_force(self):
+        for dtw_kwargs in [{}, {'normalise': True, 'metric': 'euclidean'}, {'metric': 'cosine', 'try_reverse': False}]:
+            index = DTWIndex(self.dataset, **dtw_kwargs)
+            query = np.random.randn(15, 2)
+            correct_ans = self._brute_force(query, 5, **dtw_kwargs)
+            ans = index.search(query, k=5)
+
+            self.assertEqual([self.items[i] for _, i in correct_ans], list(ans.index))
+            assert_array_equal([d for d, _ in correct_ans], ans.values)
+
+    def test_search_excludes_item(self):
+        index = DTWIndex(self.dataset)
+        ans = index.search(self.data[3], k=3, exclude='r3')
+        correct_ans = self._brute_force(self.data[3], 3, exclude=3)
+        self.assertEqual([self.items[i] for _, i in correct_ans], list(ans.index))
+
+    def test_search_many_same_as_search(self):
+        index = DTWIndex(self.dataset, normalise=True)
+        queries = SharedDataset.from_array(self.data[:6], items=self.items[:6])
+        answers = index.search_many(queries, k=4, n_processes=1, exclude_self=True)
+
+        self.assertEqual(set(self.items[:6]), set(answers.keys()))
+        for i, ix in enumerate(self.items[:6]):
+            correct_ans = index.search(self.data[i], k=4, exclude=ix)
+            self.assertEqual(list(correct_ans.index), list(answers[ix].index))
+            assert_array_almost_equal(correct_ans.values, answers[ix].values)
+            self.assertNotIn(ix, answers[ix].index)
@@ -0,0 +1,119 @@
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+from dgw.data.containers import AlignmentsData
+from dgw.dtw.lower_bounds import bounding_boxes
+from dgw.dtw.shared import SharedDataset, as_shared_dataset
+
+class TestSharedDataset(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        self.padded = np.random.randn(4, 6, 2)
+        self.padded[0, 3:] = np.nan
+        self.padded[2, 5:] = np.nan
+
+    def test_padding_is_removed(self):
+        dataset = SharedDataset.from_array(self.padded)
+
+        assert_array_equal([3, 6, 5, 6], dataset.lengths)
+        self.assertEqual(20, len(dataset.values))
+        self.assertFalse(np.any(np.isnan(dataset.values)))
+
+        assert_array_equal(self.padded[0, :3], dataset[0])
+        assert_array_equal(self.padded[1], dataset[1])
+        assert_array_equal(self.padded[2, :5], dataset[2])
+
+    def test_as_padded_reverses_from_array(self):
+        dataset = SharedDataset.from_array(self.padded)
+        assert_array_equal(self.padded, dataset.as_padded())
+
+    def test_from_sequences(self):
+        sequences = [np.array([1, 2, 3.0]), np.array([4, 5, np.nan])]
+        dataset = SharedDataset.from_sequences(sequences, items=['a', 'b'])
+
+        self.assertEqual(1, dataset.ndim)
+        assert_array_equal([3, 2], dataset.lengths)
+        assert_array_equal([[4], [5]], dataset[1])
+
+    def test_inconsistent_nans_raise_exception(self):
+        self.padded[1, 2, 0] = np.nan
+        self.assertRaises(ValueError, SharedDataset.from_array, self.padded)
+
+    def test_save_and_load_from_file(self):
+        dataset = SharedDataset.from_array(self.padded)
+
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'dataset.npy')
+            dataset.save(filename)
+            loaded = SharedDataset.from_file(filename)
+
+            assert_array_equal(dataset.lengths, loaded.lengths)
+            assert_array_equal(dataset.values, loaded.values)
+            del loaded
+        finally:
+            shutil.rmtree(directory)
+
+    def test_take_returns_view_of_the_same_values(self):
+        dataset = SharedDataset.from_array(self.padded, items=pd.Index(list('abcd')))
+        view = dataset.take([3, 0, 2])
+
+        self.assertIs(dataset.values, view.values)
+        self.assertFalse(view.is_compact)
+        self.assertTrue(dataset.is_compact)
+        self.assertEqual(['d', 'a', 'c'], list(view.items))
+        assert_array_equal([6, 3, 5], view.lengths)
+        assert_array_equal(self.padded[[3, 0, 2]], view.as_padded())
+
+        # Bounding boxes are computed over each of the sequences of the view only
+        lower, upper = bounding_boxes(view)
+        assert_array_equal([np.nanmin(self.padded[i], axis=0) for i in [3, 0, 2]], lower)
+        assert_array_equal([np.nanmax(self.padded[i], axis=0) for i in [3, 0, 2]], upper)
+
+        # Only the sequences of the view are saved
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'dataset.npy')
+            view.save(filename)
+            loaded = SharedDataset.from_file(filename)
+            self.assertTrue(loaded.is_compact)
+            assert_array_equal(self.padded[[3, 0, 2]], loaded.as_padded())
+            del loaded
+        finally:
+            shutil.rmtree(directory)
+
+    def test_offsets_outside_values_raise_exception(self):
+        dataset = SharedDataset.from_array(self.padded)
+        self.assertRaises(ValueError, SharedDataset, dataset.values, [3, 6], offsets=[0, 15])
+
+    def test_values_read_into_shared_memory_are_reused(self):
+        shared = SharedDataset.from_array(self.padded, items=list('abcd'))
+        panel = pd.Panel(self.padded, items=list('abcd'))
+        data = AlignmentsData(panel, resolution=1, shared_dataset=shared)
+        self.assertIs(shared, as_shared_dataset(data))
+
+        # Subsets of the data are copied
+        subset = as_shared_dataset(data.ix[['a', 'c']])
+        self.assertIsNot(shared, subset)
+        assert_array_equal(self.padded[[0, 2], :5], subset.as_padded())
+
+        # Taking items by position keeps the values in shared memory
+        taken = data.take([2, 0])
+        self.assertIs(shared.values, as_shared_dataset(taken).values)
+        self.assertEqual(['c', 'a'], list(taken.items))
+        assert_array_equal(taken.values[:, :5], as_shared_dataset(taken).as_padded())
+
+        log_data = data.to_log_scale()
+        self.assertIs(shared, as_shared_dataset(log_data))
+        self.assertIsNone(data.shared_dataset)
+        assert_array_equal(log_data.values, shared.as_padded())
+
+        # The values in shared memory are not pickled along with the panel
+        unpickled = pickle.loads(pickle.dumps(log_data, pickle.HIGHEST_PROTOCOL))
+        self.assertIsNone(unpickled.shared_dataset)
@@ -5,6 +5,7 @@ from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from dgw.dtw import parametrised_dtw_wrapper, uniform_scaling_to_length, reverse_sequence
 from dgw.dtw.scaling import uniform_shrinking_to_length
+from dgw.dtw.distance import dtw_std, dtw_path_is_reversed
 from dgw.dtw.transformations import *
 
 
@@ -284,6 +285,41 @@ class TestProjection(unittest.TestCase):
 
         assert_array_equal(reverse_sequence(ans_norm), ans_reverse)
 
+    def test_batch_projection_same_as_individual_projections(self):
+        data = np.random.randn(5, 12, 2)
+        data[1, 8:] = np.nan
+        data[3, 5:] = np.nan
+        base = np.random.randn(15, 2)
+        base[13:] = np.nan
+
+        dtw_function = parametrised_dtw_wrapper(try_reverse=True)
+        paths = [dtw_function(sequence, base, dist_only=False)[2] for sequence in data]
+
+        correct_ans = np.array([dtw_projection(sequence, base, path=path) for sequence, path in zip(data, paths)])
+        assert_array_equal(correct_ans, dtw_projection_batch(data, base, paths))
+
+    def test_batch_projection_of_one_dimensional_sequences(self):
+        data = np.random.randn(3, 10)
+        base = np.random.randn(12)
+        paths = [dtw_std(sequence, base, dist_only=False)[2] for sequence in data]
+
+        correct_ans = np.array([dtw_projection(sequence, base, path=path) for sequence, path in zip(data, paths)])
+        assert_array_equal(correct_ans, dtw_projection_batch(data, base, paths))
+
+    def test_batch_mapping_of_points_same_as_individual_mappings(self):
+        np.random.seed(42)
+        data = [np.random.randn(length) for length in [10, 14, 7, 12]]
+        base = np.random.randn(11)
+        dtw_function = parametrised_dtw_wrapper(try_reverse=True)
+        paths = [dtw_function(sequence, base, dist_only=False)[2] for sequence in data]
+        points = [[0, 3, 9], [], [6], [2, 2, 11]]
+
+        for sequence_a in [True, False]:
+            ans = points_mapped_to_batch(points, paths, sequence_a=sequence_a)
+            self.assertEqual(len(points), len(ans))
+            for set_points, path, mapped in zip(points, paths, ans):
+                assert_array_equal(points_mapped_to(set_points, path, sequence_a=sequence_a), mapped)
+
 class TestSdtwAveraging(unittest.TestCase):
 
     def test_one_dim_weights_set_to_one(self):
@@ -388,3 +424,54 @@ class TestSdtwAveraging(unittest.TestCase):
         average_shrinked_path = sdtw_averaging(a, b, 3, 7, path=path, shrink=True)
         assert_array_equal(shrinked_ans, average_shrinked_path, 'Arrays not equal after shrinking')
 
+
+class TestPathComposition(unittest.TestCase):
+
+    def _assert_valid_path(self, path, len_a, len_c):
+        a, c = np.asarray(path[0]), np.asarray(path[1])
+        self.assertEqual(set(range(len_a)), set(a))
+        self.assertEqual(set(range(len_c)), set(c))
+
+        steps_c = np.diff(c)
+        steps_a = np.abs(np.diff(a))
+        self.assertTrue(np.all((steps_c >= 0) & (steps_c <= 1)))
+        self.assertTrue(np.all(steps_a <= 1))
+        self.assertTrue(np.all(steps_a + steps_c > 0))
+
+    def test_composition_with_identity_path(self):
+        path = (np.array([0, 1, 1, 2, 3]), np.array([0, 0, 1, 2, 2]))
+        identity = (np.arange(3), np.arange(3))
+
+        composed = compose_warping_paths(path, identity)
+        assert_array_equal(path[0], composed[0])
+        assert_array_equal(path[1], composed[1])
+
+    def test_composition_of_dtw_paths_is_valid_path(self):
+        np.random.seed(42)
+        a, b, c = np.random.randn(12), np.random.randn(9), np.random.randn(15)
+
+        _, _, path_ab = dtw_std(a, b, dist_only=False, try_reverse=False)
+        _, _, path_bc = dtw_std(b, c, dist_only=False, try_reverse=False)
+
+        composed = compose_warping_paths(path_ab, path_bc)
+        self._assert_valid_path(composed, len(a), len(c))
+        self.assertFalse(dtw_path_is_reversed(composed))
+
+    def test_composition_with_reversed_path(self):
+        np.random.seed(42)
+        a, b, c = np.random.randn(12), np.random.randn(9), np.random.randn(15)
+
+        _, _, path_ab = dtw_std(a, b, dist_only=False, try_reverse=False)
+        _, _, path_bc = dtw_std(b, c, dist_only=False, try_reverse=False)
+        _, _, path_rev_ab = dtw_std(reverse_sequence(a), b, dist_only=False, try_reverse=False)
+        path_rev_ab = (len(a) - 1 - path_rev_ab[0], path_rev_ab[1])
+
+        composed = compose_warping_paths(path_rev_ab, path_bc)
+        self._assert_valid_path(composed, len(a), len(c))
+        self.assertTrue(dtw_path_is_reversed(composed))
+
+        # Reversing a should give the same path, just mirrored
+        forward = compose_warping_paths(dtw_std(reverse_sequence(a), b, dist_only=False, try_reverse=False)[2],
+                                        path_bc)
+        assert_array_equal(len(a) - 1 - forward[0], composed[0])
+        assert_array_equal(forward[1], composed[1])
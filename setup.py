@@ -32,7 +32,7 @@ setup(
     name='dgw',
     version='0.1.1',
     packages=['dgw', 'dgw.bin', 'dgw.cli', 'dgw.cluster', 'dgw.data', 'dgw.data.parsers', 'dgw.data.visualisation', 'dgw._mlpy',
-              'dgw.dtw', 'dgw.tests.data.parsers', 'dgw.tests.data', 'dgw.tests.dtw', 'dgw.tests', 'dgw'],
+              'dgw.dtw', 'dgw.tests.cluster', 'dgw.tests.data.parsers', 'dgw.tests.data', 'dgw.tests.dtw', 'dgw.tests', 'dgw'],
     install_requires=['argparse',
                       'numpy>=1.6.1', 'scipy>=0.9.0', 'pandas>=0.10.1', 'pysam>=0.7.4',
                       'fastcluster>=1.1.7'],
@@ -43,6 +43,7 @@ setup(
     },
     entry_points={
         'console_scripts': [
+            'dgw-assign = dgw.bin.assign:main',
             'dgw-extract-gene-regions = dgw.bin.extract_gene_regions:main',
             'dgw-overlaps2poi = dgw.bin.overlaps2poi:main',
             'dgw-prototypes2dot = dgw.bin.prototypes2dot:main [visualisation]',